@@ -10,7 +10,16 @@ load_dotenv()
 from config import config
 from modules.routes import register_routes
 from modules.converter import MOEXConverter
-from modules.utils import TemporaryFileManager
+from modules.bundle import load_stylesheet_bundle, warm_up
+from modules.utils import TemporaryFileManager, artifact_compression
+from modules.cache import ResultCache
+from modules.janitor import CleanupJanitor
+from modules.jobs import JobQueue
+from modules.upload import UploadRequest
+from modules.search import SearchIndex, fts5_available
+from modules.admission import AdmissionControl
+from modules.metrics import (ConversionMetrics, MetricsStore, CacheEventCounter, cache_collector,
+                             worker_cache_collector)
 
 def create_app(config_name=None):
     """Фабрика приложения Flask"""
@@ -27,32 +36,223 @@ def create_app(config_name=None):
     app.config.from_object(config[config_name])
     config[config_name].init_app(app)
     
+    # За обратным прокси адрес клиента (для лимитов допуска), схема и хост - из X-Forwarded-*
+    if app.config['TRUSTED_PROXIES']:
+        from werkzeug.middleware.proxy_fix import ProxyFix
+        proxies = app.config['TRUSTED_PROXIES']
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxies, x_proto=proxies, x_host=proxies)
+    
+    # Загружаемые XML пишутся на диск и разбираются по мере поступления
+    app.request_class = UploadRequest
+    
     # Инициализируем компоненты
-    converter = MOEXConverter(
+    # Параметры конвертера (те же используются в процессах пула заданий)
+    converter_options = dict(
         xslt_base_url=app.config['MOEX_XSLT_BASE'],
         xsd_base_url=app.config.get('MOEX_XSD_BASE'),
-        timeout=app.config['REQUEST_TIMEOUT']
+        timeout=app.config['REQUEST_TIMEOUT'],
+        cache_size=app.config['XSLT_CACHE_SIZE'],
+        cache_ttl=app.config['XSLT_CACHE_TTL'],
+        cache_dir=app.config['XSLT_CACHE_DIR'],
+        offline=app.config['XSLT_OFFLINE'],
+        connect_timeout=app.config['HTTP_CONNECT_TIMEOUT'],
+        retries=app.config['HTTP_RETRIES'],
+        backoff=app.config['HTTP_BACKOFF'],
+        pool_size=app.config['HTTP_POOL_SIZE'],
+        fetch_workers=app.config['XSLT_FETCH_WORKERS'],
+        shared_cache_path=app.config['SHARED_CACHE_PATH'] if app.config['SHARED_CACHE_ENABLED'] else None
+    )
+    converter = MOEXConverter(**converter_options)
+    
+    # Загружаем локальный набор стилей и прогреваем кэш.
+    # При запуске через gunicorn с preload_app это выполняется один раз в мастере,
+    # и скомпилированные стили достаются воркерам через copy-on-write.
+    preload_stylesheets(app, converter)
+    
+    # Результаты хранятся сжатыми; без пакета zstandard - gzip
+    try:
+        compression = artifact_compression(app.config['ARTIFACT_COMPRESSION'])
+    except Exception as e:
+        app.logger.warning(f"{e}, используется gzip")
+        compression = 'gzip'
+    
+    temp_manager = TemporaryFileManager(
+        app.config['UPLOAD_FOLDER'],
+        bucket_seconds=app.config['EXPIRY_BUCKET_SECONDS'],
+        compression=compression,
+        compression_level=app.config['ARTIFACT_COMPRESSION_LEVEL'],
+        page_rows=app.config['RESULT_PAGE_ROWS']
+    )
+    
+    result_cache = ResultCache(
+        temp_manager,
+        max_bytes=app.config['RESULT_CACHE_MAX_BYTES'],
+        max_entries=app.config['RESULT_CACHE_MAX_ENTRIES'],
+        store=converter.shared_store
     )
     
-    temp_manager = TemporaryFileManager(app.config['UPLOAD_FOLDER'])
+    # Поисковый индекс результатов
+    search_index = None
+    if app.config['SEARCH_ENABLED']:
+        if fts5_available():
+            search_index = SearchIndex(app.config['SEARCH_DB_PATH'], temp_manager)
+        else:
+            app.logger.warning("SQLite без поддержки FTS5, поиск по результатам отключён")
+    
+    # Очередь фоновых конвертаций
+    job_queue = JobQueue(
+        db_path=app.config['JOB_DB_PATH'],
+        spool_dir=os.path.join(app.config['UPLOAD_FOLDER'], 'jobs'),
+        converter_options=converter_options,
+        temp_dir=app.config['UPLOAD_FOLDER'],
+        bundle_path=app.config['XSLT_BUNDLE_PATH'],
+        bucket_seconds=app.config['EXPIRY_BUCKET_SECONDS'],
+        compression=compression,
+        compression_level=app.config['ARTIFACT_COMPRESSION_LEVEL'],
+        page_rows=app.config['RESULT_PAGE_ROWS'],
+        max_workers=app.config['JOB_WORKERS'],
+        max_pending=app.config['JOB_MAX_PENDING'],
+        search_db_path=search_index.db_path if search_index is not None else None
+    )
+    
+    # Контроль допуска к конвертациям: лимиты клиентов и нагрузки хоста
+    admission = None
+    if app.config['ADMISSION_ENABLED']:
+        admission = AdmissionControl(
+            app.config['ADMISSION_DB_PATH'],
+            rate=app.config['ADMISSION_RATE_PER_MINUTE'] / 60,
+            burst=app.config['ADMISSION_BURST'],
+            max_inflight_bytes=app.config['ADMISSION_MAX_INFLIGHT_BYTES'],
+            retry_after=app.config['ADMISSION_RETRY_AFTER'],
+            api_keys=[key.strip() for key in app.config['ADMISSION_API_KEYS'].split(',')
+                      if key.strip()]
+        )
+    
+    # Значения метрик всех процессов хоста (SQLite): /metrics любого воркера отдаёт их сумму
+    metrics_store = None
+    if app.config['METRICS_ENABLED']:
+        metrics_store = MetricsStore(app.config['METRICS_DB_PATH'])
+    
+    # Фоновая очистка временных файлов
+    janitor_tasks = [job_queue.purge]
+    if converter.shared_store is not None:
+        janitor_tasks.append(converter.shared_store.purge)
+    if search_index is not None:
+        janitor_tasks.append(search_index.expire)
+    if admission is not None:
+        janitor_tasks.append(admission.purge)
+    if metrics_store is not None:
+        janitor_tasks.append(metrics_store.purge)
+    janitor = CleanupJanitor(
+        temp_manager,
+        max_age_seconds=app.config['TEMP_FILE_LIFETIME'],
+        interval=app.config['JANITOR_INTERVAL'],
+        tasks=janitor_tasks
+    )
+    
+    # Метрики конвертаций и кэшей
+    metrics = None
+    if app.config['METRICS_ENABLED']:
+        metrics = ConversionMetrics(metrics_store, xslt_base_url=converter.xslt_base_url)
+        caches = cache_stats_sources(converter, result_cache)
+        metrics.register(CacheEventCounter('moex_cache_events_total', 'События кэша', caches))
+        metrics.register_collector(cache_collector('cache', caches, converter.shared_store))
+        if converter.shared_store is not None:
+            metrics.register_collector(worker_cache_collector(converter.shared_store))
+    
+    # Компоненты приложения доступны обёрткам (режим ASGI, asgi.py)
+    app.extensions['moex'] = {
+        'converter': converter,
+        'temp_manager': temp_manager,
+        'job_queue': job_queue,
+        'search_index': search_index,
+        'result_cache': result_cache,
+        'janitor': janitor,
+        'admission': admission,
+        'metrics': metrics
+    }
     
     # Регистрируем маршруты
-    register_routes(app, converter, temp_manager)
+    register_routes(app, converter, temp_manager, result_cache, janitor, job_queue, metrics,
+                    search_index, admission)
     
-    # Регистрируем обработчик для очистки временных файлов
+    # Поток очистки запускается лениво в каждом процессе (после fork в воркере gunicorn)
     @app.before_request
-    def cleanup_old_files():
-        if app.debug:
-            # В режиме разработки чистим при каждом запросе
-            temp_manager.cleanup(app.config['TEMP_FILE_LIFETIME'] / 3600)
-        else:
-            # В продакшене чистим раз в 100 запросов
-            import random
-            if random.random() < 0.01:  # 1% шанс на очистку
-                temp_manager.cleanup(app.config['TEMP_FILE_LIFETIME'] / 3600)
+    def start_janitor():
+        if app.config['JANITOR_ENABLED']:
+            janitor.ensure_started()
+    
+    # Счётчики кэшей воркера видны остальным через общее хранилище
+    if converter.shared_store is not None:
+        @app.before_request
+        def publish_cache_stats():
+            converter.shared_store.maybe_publish(cache_stats_sources(converter, result_cache))
+    
+    # Значения метрик воркера попадают в /metrics остальных
+    if metrics is not None:
+        @app.after_request
+        def publish_metrics(response):
+            metrics.maybe_publish()
+            return response
     
     return app
 
+def cache_stats_sources(converter, result_cache):
+    """Кэши процесса, счётчики которых публикуются и отдаются в метриках"""
+    return {
+        'xslt': converter.xslt_cache,
+        'xsd': converter.xsd_cache,
+        'results': result_cache
+    }
+
+def before_fork(app):
+    """
+    Подготовка мастера gunicorn (preload_app) к запуску воркеров.
+
+    Сессия HTTP и пул потоков загрузки, открытые при прогреве XSLT, и
+    соединения SQLite, открытые при создании приложения, закрываются:
+    воркеры создадут свои, а унаследованные сокеты и дескрипторы
+    оставались бы открытыми в каждом из них.
+    """
+    components = app.extensions['moex']
+    converter = components['converter']
+    converter.fetcher.close()
+    if converter.shared_store is not None:
+        converter.shared_store.close()
+    if components['search_index'] is not None:
+        components['search_index'].close()
+    if components['admission'] is not None:
+        components['admission'].close()
+    if components['metrics'] is not None:
+        components['metrics'].store.close()
+
+def after_fork(app):
+    """
+    Состояние воркера сразу после fork (хук post_fork gunicorn).
+
+    Поток очистки запускается до первого запроса, а счётчики кэшей
+    воркера сразу появляются в общем хранилище (и в /metrics остальных).
+    """
+    components = app.extensions['moex']
+    converter = components['converter']
+    if app.config['JANITOR_ENABLED']:
+        components['janitor'].ensure_started()
+    if converter.shared_store is not None:
+        converter.shared_store.publish(cache_stats_sources(converter, components['result_cache']))
+
+def preload_stylesheets(app, converter):
+    """Загрузка локального набора XSLT/XSD и прогрев кэша при старте"""
+    loaded = load_stylesheet_bundle(converter, app.config['XSLT_BUNDLE_PATH'])
+    if loaded['xslt'] or loaded['xsd']:
+        app.logger.info(f"Загружено из локального набора: XSLT - {loaded['xslt']}, "
+                        f"XSD - {loaded['xsd']}")
+    for error in loaded['errors']:
+        app.logger.warning(f"Ошибка загрузки стиля из набора: {error}")
+    
+    if app.config['XSLT_PRELOAD']:
+        for error in warm_up(converter):
+            app.logger.warning(f"Ошибка прогрева XSLT: {error}")
+
 if __name__ == '__main__':
     # Создаем приложение
     app = create_app()
@@ -0,0 +1,13 @@
+# asgi.py
+"""
+Точка входа режима ASGI (зависимости - requirements-asgi.txt):
+
+    uvicorn asgi:application --host 0.0.0.0 --port 5050 --workers 4
+
+Загрузка XSLT и отдача файлов идут в цикле событий, конвертации - в пуле
+из ASGI_CONVERT_WORKERS потоков (см. modules/asgi.py).
+"""
+from app import create_app
+from modules.asgi import ASGIApplication
+
+application = ASGIApplication(create_app())
@@ -0,0 +1,149 @@
+# benchmarks/bench_fix_encoding.py
+"""
+Микробенчмарк fix_encoding_issues на HTML, похожем на отчёты MOEX.
+
+Сравнивает текущую однопроходную реализацию с прежней (цепочка str.replace
+и компиляция регулярного выражения при каждом вызове) на чистом HTML и на
+HTML с кракозябрами, проверяя совпадение результатов.
+
+Запуск из корня проекта:
+    python -m benchmarks.bench_fix_encoding --size-mb 4 --repeat 5 --json result.json
+"""
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import statistics
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from modules.utils import fix_encoding_issues
+
+def legacy_fix_encoding_issues(text):
+    """Прежняя реализация - эталон для сравнения"""
+    if not text:
+        return text
+
+    def _try_recode_fragment(s, src, dst):
+        try:
+            return s.encode(src).decode(dst)
+        except (UnicodeEncodeError, UnicodeDecodeError):
+            return None
+
+    text = (
+        text.replace('â€”', '—')
+            .replace('â€“', '–')
+            .replace('â€˜', '‘')
+            .replace('â€™', '’')
+            .replace('â€œ', '“')
+            .replace('â€\u009d', '”')
+            .replace('â€\u009c', '“')
+            .replace('â€\u0099', '’')
+            .replace('â€\u0094', '—')
+            .replace('â€\u0093', '–')
+            .replace('вЂњ', '“')
+            .replace('вЂќ', '”')
+            .replace('вЂ™', '’')
+            .replace('вЂ”', '—')
+            .replace('вЂ–', '–')
+    )
+
+    mojibake_pattern = re.compile(r'(?:[РС][\u0400-\u04FF]){4,}')
+
+    def _fix_match(m):
+        frag = m.group(0)
+        fixed = _try_recode_fragment(frag, 'cp1251', 'utf-8')
+        if fixed:
+            return fixed
+        fixed = _try_recode_fragment(frag, 'latin1', 'utf-8')
+        if fixed:
+            return fixed
+        return frag
+
+    return mojibake_pattern.sub(_fix_match, text)
+
+INSTRUMENTS = ['USD000UTSTOM', 'EUR_RUB__TOM', 'CNYRUB_TOM', 'GLDRUB_TOM', 'USD000000TOD']
+NAMES = ['Доллар США - Российский рубль', 'Евро - Российский рубль',
+         'Китайский юань - Российский рубль', 'Золото - Российский рубль']
+HEADERS = ['Код инструмента', 'Наименование', 'Направление', 'Цена', 'Количество',
+           'Объём сделки', 'Комиссия', 'Расчётный код']
+
+def _mojibake(text):
+    """UTF-8 текст, ошибочно прочитанный как cp1251"""
+    return text.encode('utf-8').decode('cp1251', errors='replace')
+
+def generate_html(size_bytes, dirty_ratio=0.0, seed=1):
+    """HTML отчёта с таблицей сделок заданного размера"""
+    rnd = random.Random(seed)
+    head = ('<html><head><meta charset="utf-8"><title>Отчёт о сделках</title></head><body>'
+            '<h1>Отчёт участника клиринга</h1><table><tr>'
+            + ''.join(f'<th>{header}</th>' for header in HEADERS) + '</tr>')
+    rows = []
+    size = len(head)
+    while size < size_bytes:
+        name = rnd.choice(NAMES)
+        if rnd.random() < dirty_ratio:
+            name = _mojibake(name) + ' вЂ” ' + _mojibake('исправлено')
+        row = (f'<tr><td>{rnd.choice(INSTRUMENTS)}</td><td>{name}</td>'
+               f'<td>{rnd.choice(["Покупка", "Продажа"])}</td>'
+               f'<td>{rnd.uniform(60, 110):.4f}</td><td>{rnd.randint(1, 10000)}</td>'
+               f'<td>{rnd.uniform(1e3, 1e7):.2f}</td><td>{rnd.uniform(0, 100):.2f}</td>'
+               f'<td>Y0{rnd.randint(0, 9)}</td></tr>')
+        rows.append(row)
+        size += len(row)
+    return head + ''.join(rows) + '</table></body></html>'
+
+def measure(func, text, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(text)
+        timings.append(time.perf_counter() - started)
+    return {'median_s': statistics.median(timings), 'min_s': min(timings)}
+
+def run(size_mb=4.0, repeat=5, dirty_ratio=0.02):
+    size_bytes = int(size_mb * 1024 * 1024)
+    results = {'size_mb': size_mb, 'repeat': repeat, 'cases': {}}
+
+    for case, ratio in (('clean', 0.0), ('dirty', dirty_ratio)):
+        html = generate_html(size_bytes, ratio)
+        if legacy_fix_encoding_issues(html) != fix_encoding_issues(html):
+            raise AssertionError(f"Результаты реализаций расходятся ({case})")
+
+        legacy = measure(legacy_fix_encoding_issues, html, repeat)
+        current = measure(fix_encoding_issues, html, repeat)
+        results['cases'][case] = {
+            'chars': len(html),
+            'legacy': legacy,
+            'current': current,
+            'speedup': round(legacy['median_s'] / current['median_s'], 2)
+        }
+
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size-mb', type=float, default=4.0)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--dirty-ratio', type=float, default=0.02,
+                        help='доля строк таблицы с кракозябрами в "грязном" случае')
+    parser.add_argument('--json', help='файл для результатов в формате JSON')
+    args = parser.parse_args()
+
+    results = run(args.size_mb, args.repeat, args.dirty_ratio)
+
+    for case, data in results['cases'].items():
+        print(f"{case:6s} {data['chars'] / 1e6:6.1f}M символов: "
+              f"было {data['legacy']['median_s'] * 1000:8.1f} мс, "
+              f"стало {data['current']['median_s'] * 1000:8.1f} мс, "
+              f"ускорение x{data['speedup']}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+if __name__ == '__main__':
+    main()
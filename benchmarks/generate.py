@@ -0,0 +1,114 @@
+# benchmarks/generate.py
+"""
+Генератор синтетических XML отчётов MOEX для бенчмарков.
+
+Отчёт похож на настоящий CCX99: пролог с кодировкой, инструкция
+xml-stylesheet с локальным путём C:\\MICEX\\XSLT\\, шапка участника клиринга
+и таблица сделок нужного размера. Для преобразования подходит стиль
+benchmarks/stylesheets/CCX99_RU_23062025.xsl.
+
+Запуск из корня проекта:
+    python -m benchmarks.generate --size 10MB --encoding windows-1251 -o report.xml
+"""
+import re
+import sys
+import random
+import argparse
+
+STYLESHEET = 'CCX99_RU_23062025.xsl'
+ENCODINGS = ('windows-1251', 'utf-8')
+
+# Допустимые размеры отчёта
+MIN_SIZE = 1024
+MAX_SIZE = 100 * 1024 * 1024
+
+INSTRUMENTS = [
+    ('USD000UTSTOM', 'Доллар США - Российский рубль'),
+    ('EUR_RUB__TOM', 'Евро - Российский рубль'),
+    ('CNYRUB_TOM', 'Китайский юань - Российский рубль'),
+    ('GLDRUB_TOM', 'Золото - Российский рубль'),
+    ('USD000000TOD', 'Доллар США - Российский рубль (TOD)'),
+]
+
+SIZE_UNITS = {'': 1, 'B': 1, 'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3}
+
+def parse_size(value):
+    """Размер вида 512, 100KB, 1.5MB -> байты"""
+    match = re.fullmatch(r'\s*([\d.]+)\s*([KMG]?B?)\s*', value.upper())
+    if not match:
+        raise ValueError(f"Некорректный размер: {value}")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+def format_size(size):
+    for unit in ('GB', 'MB', 'KB'):
+        if size >= SIZE_UNITS[unit] and size % SIZE_UNITS[unit] == 0:
+            return f"{size // SIZE_UNITS[unit]}{unit}"
+    return f"{size}B"
+
+def _record(rnd, trade_no):
+    price = rnd.uniform(10, 110)
+    quantity = rnd.randint(1, 100000)
+    return (f'<REC TradeNo="{trade_no}" TradeTime="{rnd.randint(10, 23):02d}:'
+            f'{rnd.randint(0, 59):02d}:{rnd.randint(0, 59):02d}" '
+            f'BuySell="{rnd.choice("BS")}" Price="{price:.4f}" '
+            f'Quantity="{quantity}" Value="{price * quantity:.2f}" '
+            f'Commission="{price * quantity * 0.0001:.2f}" SettleCode="Y0{rnd.randint(0, 9)}"/>\n')
+
+def generate_report(size_bytes, encoding='windows-1251', seed=1, stylesheet=STYLESHEET):
+    """
+    XML отчёт примерно заданного размера (в байтах, не меньше size_bytes).
+
+    Сделки сгруппированы по инструментам (SECURITY), как в разделах
+    настоящих отчётов. Возвращает bytes в указанной кодировке.
+    """
+    if encoding not in ENCODINGS:
+        raise ValueError(f"Неподдерживаемая кодировка: {encoding}")
+    if not MIN_SIZE <= size_bytes <= MAX_SIZE:
+        raise ValueError(f"Размер отчёта должен быть от {format_size(MIN_SIZE)} "
+                         f"до {format_size(MAX_SIZE)}")
+
+    rnd = random.Random(seed)
+    head = (f'<?xml version="1.0" encoding="{encoding}"?>\n'
+            f'<?xml-stylesheet type="text/xsl" href="C:\\MICEX\\XSLT\\{stylesheet}"?>\n'
+            f'<CCX99 DocDate="2025-06-23" DocNo="{rnd.randint(10000, 99999)}" '
+            f'FirmId="MC0000000000" FirmName="ООО «Тестовый участник клиринга»">\n'
+            f'<TRADES>\n').encode(encoding)
+    sections = [(f'<SECURITY SecCode="{code}" SecName="{name}">\n'.encode(encoding), [])
+                for code, name in INSTRUMENTS]
+    section_tail = '</SECURITY>\n'.encode(encoding)
+    tail = '</TRADES>\n</CCX99>\n'.encode(encoding)
+
+    size = len(head) + len(tail) + sum(len(open_tag) + len(section_tail)
+                                       for open_tag, _ in sections)
+    trade_no = 1000000
+    while size < size_bytes:
+        record = _record(rnd, trade_no).encode(encoding)
+        rnd.choice(sections)[1].append(record)
+        size += len(record)
+        trade_no += 1
+
+    parts = [head]
+    for open_tag, records in sections:
+        parts.append(open_tag)
+        parts.extend(records)
+        parts.append(section_tail)
+    parts.append(tail)
+    return b''.join(parts)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size', default='1MB', help='размер отчёта (1KB .. 100MB)')
+    parser.add_argument('--encoding', default='windows-1251', choices=ENCODINGS)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('-o', '--output', help='файл для отчёта (по умолчанию stdout)')
+    args = parser.parse_args()
+
+    report = generate_report(parse_size(args.size), args.encoding, args.seed)
+    if args.output:
+        with open(args.output, 'wb') as f:
+            f.write(report)
+    else:
+        sys.stdout.buffer.write(report)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,533 @@
+# benchmarks/run.py
+"""
+Набор бенчмарков производительности конвертера.
+
+Измеряет на синтетических отчётах (benchmarks/generate.py) разбор и
+конвертацию MOEXConverter по этапам, fix_encoding_issues на полученном
+HTML, его разбиение на страницы и индексацию для поиска (с временем
+запросов к индексу), табличный экспорт (CSV/JSON Lines), сравнение
+отчёта с исправленной версией и с отчётом другого дня (/api/diff),
+операции TemporaryFileManager и задержку/пропускную способность
+/api/convert под параллельной нагрузкой. Стили отдаёт локальная замена
+сервера MOEX (benchmarks/stub_server.py), сеть не нужна.
+
+Результаты пишутся в JSON; с --baseline печатается сравнение с прошлым
+прогоном (отношение медиан, > 1 - стало медленнее).
+
+Запуск из корня проекта:
+    python -m benchmarks.run --sizes 1KB,1MB,10MB --concurrency 1,4,8 --json results.json
+    python -m benchmarks.run --json new.json --baseline results.json
+
+Встроенный сервер для /api/convert - многопоточный сервер werkzeug в этом
+же процессе (с --asgi - uvicorn с ASGIApplication, нужен requirements-asgi.txt);
+для измерения боевой конфигурации запустите gunicorn или uvicorn и передайте
+его адрес через --server (стили он должен брать с --stub-port). С --slow-clients
+/api/convert нагружается вместе с медленными клиентами, скачивающими большой
+результат: под sync-воркерами каждый такой клиент занимает воркер.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import platform
+import tempfile
+import argparse
+import statistics
+import subprocess
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import requests
+from lxml import etree
+
+from benchmarks.generate import generate_report, parse_size, format_size, ENCODINGS
+from benchmarks.stub_server import StubServer
+from benchmarks.bench_fix_encoding import measure
+
+STYLESHEETS_DIR = Path(__file__).resolve().parent / 'stylesheets'
+
+def summarize(timings):
+    """Медиана, минимум и перцентили списка длительностей (в секундах)"""
+    ordered = sorted(timings)
+
+    def percentile(p):
+        index = min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))
+        return ordered[index]
+
+    return {
+        'count': len(ordered),
+        'median_s': statistics.median(ordered),
+        'min_s': ordered[0],
+        'mean_s': statistics.fmean(ordered),
+        'p95_s': percentile(95),
+        'p99_s': percentile(99),
+    }
+
+def environment():
+    """Описание окружения прогона (для сравнения результатов между версиями)"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                                text=True, cwd=Path(__file__).resolve().parent).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': commit or None,
+        'python': platform.python_version(),
+        'lxml': '.'.join(map(str, etree.LXML_VERSION)),
+        'libxslt': '.'.join(map(str, etree.LIBXSLT_VERSION)),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+def bench_converter(converter, report, repeat):
+    """Разбор и конвертация одного отчёта: полные длительности и медианы этапов"""
+    from modules.metrics import StageTimings
+
+    parse_timings = []
+    convert_timings = []
+    stages = {}
+    html = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        xml_doc = converter.parse_xml(report)
+        parse_timings.append(time.perf_counter() - started)
+
+        timings = StageTimings()
+        started = time.perf_counter()
+        html, _ = converter.convert(xml_doc=xml_doc, timings=timings)
+        convert_timings.append(time.perf_counter() - started)
+        for stage, seconds in timings.stages.items():
+            stages.setdefault(stage, []).append(seconds)
+        del xml_doc
+
+    convert = summarize(convert_timings)
+    return {
+        'input_bytes': len(report),
+        'output_chars': len(html),
+        'parse': summarize(parse_timings),
+        'convert': convert,
+        'stages_median_s': {stage: statistics.median(values) for stage, values in stages.items()},
+        'throughput_mb_s': len(report) / 1024 / 1024 / convert['median_s'],
+    }, html
+
+def bench_export(report, repeat, work_dir, formats=('csv', 'jsonl')):
+    """Табличный экспорт (modules/export.py) того же отчёта, в обход XSLT"""
+    import shutil
+    from modules.export import export_report
+
+    source = os.path.join(work_dir, 'export_source.xml')
+    with open(source, 'wb') as f:
+        f.write(report)
+
+    results = {}
+    for fmt in formats:
+        timings = []
+        for _ in range(repeat):
+            target = tempfile.mkdtemp(dir=work_dir)
+            started = time.perf_counter()
+            _, _, _, summary = export_report(source, target, fmt)
+            timings.append(time.perf_counter() - started)
+            shutil.rmtree(target)
+        data = summarize(timings)
+        data['rows'] = sum(table['rows'] for table in summary.values())
+        data['throughput_mb_s'] = len(report) / 1024 / 1024 / data['median_s']
+        results[fmt] = data
+    os.remove(source)
+    return results
+
+def _reissue(report, encoding, every=100):
+    """Исправленная версия отчёта: у каждой every-й сделки изменено количество"""
+    lines = report.decode(encoding).split('\n')
+    count = 0
+    for i, line in enumerate(lines):
+        if line.startswith('<REC '):
+            count += 1
+            if count % every == 0:
+                lines[i] = line.replace(' Quantity="', ' Quantity="1', 1)
+    return '\n'.join(lines).encode(encoding)
+
+def bench_diff(converter, report, encoding, repeat, work_dir):
+    """Сравнение отчётов (modules/diff.py): с исправленной версией и с отчётом другого дня"""
+    import shutil
+    from modules.diff import diff_reports
+    from modules.metrics import StageTimings
+
+    old_path = os.path.join(work_dir, 'diff_old.xml')
+    new_path = os.path.join(work_dir, 'diff_new.xml')
+    with open(old_path, 'wb') as f:
+        f.write(report)
+
+    results = {}
+    cases = (('reissue', lambda: _reissue(report, encoding)),
+             ('next_day', lambda: generate_report(len(report), encoding, seed=2)))
+    for name, make in cases:
+        with open(new_path, 'wb') as f:
+            f.write(make())
+        timings = []
+        stages = {}
+        for _ in range(repeat):
+            target = tempfile.mkdtemp(dir=work_dir)
+            stage_timings = StageTimings()
+            started = time.perf_counter()
+            _, summary = diff_reports(converter, old_path, new_path, target, timings=stage_timings)
+            timings.append(time.perf_counter() - started)
+            for stage, seconds in stage_timings.stages.items():
+                stages.setdefault(stage, []).append(seconds)
+            shutil.rmtree(target)
+        data = summarize(timings)
+        data['records'] = summary['records']
+        data['stages_median_s'] = {stage: statistics.median(values)
+                                   for stage, values in stages.items()}
+        results[name] = data
+    os.remove(old_path)
+    os.remove(new_path)
+    return results
+
+def bench_search(html, repeat, work_dir, queries=('Y04', 'USD000UTSTOM', '2025-06-23')):
+    """Индексация результата для поиска (modules/search.py) и запросы к индексу"""
+    from modules.search import SearchIndex
+
+    index = SearchIndex(os.path.join(work_dir, f"search_{len(html)}.sqlite3"))
+    timings = []
+    for i in range(repeat):
+        started = time.perf_counter()
+        rows = index.add(f"bench-{i}", html, 'CCX99', '2025-06-23', 'bench.xml')
+        timings.append(time.perf_counter() - started)
+    results = {'index': summarize(timings), 'rows': rows, 'query': {}}
+    results['index']['throughput_mb_s'] = len(html) / 1024 / 1024 / results['index']['median_s']
+
+    for query in queries:
+        timings = []
+        for _ in range(max(repeat, 10)):
+            started = time.perf_counter()
+            index.search(query)
+            timings.append(time.perf_counter() - started)
+        results['query'][query] = summarize(timings)
+    return results
+
+def bench_temp_files(html, count, compression=None):
+    """Операции TemporaryFileManager на count артефактах размера html"""
+    from modules.utils import TemporaryFileManager
+
+    results = {'files': count, 'file_chars': len(html)}
+    with tempfile.TemporaryDirectory(prefix='moex_bench_tmp_') as temp_dir:
+        manager = TemporaryFileManager(temp_dir, compression=compression)
+        ids = []
+
+        def timed(name, func):
+            timings = []
+            for temp_id in ids:
+                started = time.perf_counter()
+                func(temp_id)
+                timings.append(time.perf_counter() - started)
+            results[name] = summarize(timings)
+
+        timings = []
+        for _ in range(count):
+            started = time.perf_counter()
+            temp_id, _, _ = manager.create_temp_file(html, metadata={'original_name': 'bench.xml'})
+            timings.append(time.perf_counter() - started)
+            ids.append(temp_id)
+        results['create_temp_file'] = summarize(timings)
+        if ids:
+            results['stored_bytes'] = os.path.getsize(manager.get_temp_file(ids[0]))
+
+        timed('get_temp_file', manager.get_temp_file)
+        timed('get_metadata', manager.get_metadata)
+        timed('touch', manager.touch)
+
+        started = time.perf_counter()
+        files, size = manager.expire(-manager.bucket_seconds)
+        results['expire'] = {'files': files, 'bytes': size,
+                             'duration_s': time.perf_counter() - started}
+    return results
+
+def bench_endpoint(base_url, report, concurrency, total, unique=True):
+    """
+    Нагрузка на /api/convert: total запросов в concurrency потоков.
+
+    При unique=True каждый запрос получает уникальный отчёт (комментарий
+    в конце документа), чтобы не попадать в кэш результатов.
+    """
+    local = threading.local()
+    url = base_url.rstrip('/') + '/api/convert'
+
+    def send(index):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        body = report + f'<!-- {index} -->'.encode('ascii') if unique else report
+        started = time.perf_counter()
+        response = session.post(url, files={'xml_file': ('bench.xml', body, 'text/xml')})
+        return time.perf_counter() - started, response.status_code
+
+    # Прогрев: загрузка и компиляция XSLT
+    send(-1)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(send, range(total)))
+    wall = time.perf_counter() - started
+
+    latencies = [latency for latency, status in results if status == 200]
+    summary = summarize(latencies) if latencies else {}
+    summary.update({
+        'concurrency': concurrency,
+        'requests': total,
+        'errors': sum(1 for _, status in results if status != 200),
+        'wall_s': wall,
+        'throughput_rps': len(latencies) / wall,
+        'throughput_mb_s': len(latencies) * len(report) / 1024 / 1024 / wall,
+    })
+    return summary
+
+class SlowDownloads:
+    """Медленные клиенты: count потоков скачивают url, читая по куску раз в interval секунд"""
+
+    def __init__(self, url, count, chunk_size=64 * 1024, interval=0.05):
+        self.url = url
+        self.chunk_size = chunk_size
+        self.interval = interval
+        self.completed = 0
+        self.errors = 0
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._threads = [threading.Thread(target=self._download, name=f'bench-slow-{i}', daemon=True)
+                         for i in range(count)]
+
+    def __enter__(self):
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+
+    def _download(self):
+        while not self._stop.is_set():
+            try:
+                with requests.get(self.url, stream=True, timeout=60,
+                                  headers={'Accept-Encoding': 'identity'}) as response:
+                    for _ in response.iter_content(self.chunk_size):
+                        if self._stop.wait(self.interval):
+                            return
+                with self._lock:
+                    self.completed += 1
+            except requests.RequestException:
+                with self._lock:
+                    self.errors += 1
+
+def bench_mixed(base_url, report, concurrency, total, slow_clients, unique=True):
+    """/api/convert под нагрузкой вместе с slow_clients медленными скачиваниями результата"""
+    response = requests.post(base_url.rstrip('/') + '/api/convert',
+                             files={'xml_file': ('bench.xml', report, 'text/xml')})
+    response.raise_for_status()
+    with SlowDownloads(response.json()['download_url'], slow_clients) as downloads:
+        summary = bench_endpoint(base_url, report, concurrency, total, unique)
+    summary['slow_clients'] = slow_clients
+    summary['slow_errors'] = downloads.errors
+    return summary
+
+class AsgiServer:
+    """uvicorn с ASGIApplication в фоновом потоке (интерфейс как у сервера werkzeug)"""
+
+    def __init__(self, app):
+        import uvicorn
+        from modules.asgi import ASGIApplication
+
+        config = uvicorn.Config(ASGIApplication(app), host='127.0.0.1', port=0,
+                                log_level='warning', lifespan='on')
+        self.server = uvicorn.Server(config)
+        self.thread = threading.Thread(target=self.server.run, name='bench-app', daemon=True)
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+        self.server_port = self.server.servers[0].sockets[0].getsockname()[1]
+
+    def shutdown(self):
+        self.server.should_exit = True
+        self.thread.join()
+
+def start_app_server(work_dir, stub_url, max_size, asgi=False):
+    """
+    Приложение во встроенном многопоточном сервере werkzeug (или в uvicorn
+    с asgi=True); возвращает (url, server)
+    """
+    os.environ.update({
+        'SECRET_KEY': os.environ.get('SECRET_KEY', 'benchmark'),
+        'MOEX_XSLT_BASE': stub_url,
+        'UPLOAD_FOLDER': os.path.join(work_dir, 'uploads'),
+        'XSLT_CACHE_DIR': os.path.join(work_dir, 'xslt_cache'),
+        'XSLT_BUNDLE_PATH': os.path.join(work_dir, 'no_bundle'),
+        'MAX_CONTENT_LENGTH': str(max_size),
+        'JANITOR_ENABLED': 'False',
+        # Нагрузка идёт с одного адреса - лимиты клиента измерение бы исказили
+        'ADMISSION_ENABLED': 'False',
+    })
+    from werkzeug.serving import make_server
+    from app import create_app
+
+    # Журнал каждого запроса сервера werkzeug только мешает выводу
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    app = create_app('production')
+    if asgi:
+        server = AsgiServer(app)
+    else:
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, name='bench-app', daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}", server
+
+def run(sizes, encodings, repeat, concurrency, requests_total, e2e_size,
+        temp_files, server_url=None, stub_port=0, unique=True, asgi=False, slow_clients=0):
+    from modules.converter import MOEXConverter
+    from modules.utils import fix_encoding_issues
+    from modules.paging import split_pages
+
+    results = {'environment': environment(), 'converter': {}, 'fix_encoding': {},
+               'export': {}, 'diff': {}, 'paging': {}, 'search': {}, 'temp_files': {},
+               'endpoint': {}}
+
+    with tempfile.TemporaryDirectory(prefix='moex_bench_') as work_dir, \
+            StubServer(STYLESHEETS_DIR, port=stub_port) as stub:
+        stub_url = stub.url('XSLT/')
+        converter = MOEXConverter(stub_url, cache_dir=os.path.join(work_dir, 'converter_cache'))
+
+        html = None
+        for size in sizes:
+            for encoding in encodings:
+                key = f"{format_size(size)}/{encoding}"
+                report = generate_report(size, encoding)
+                results['converter'][key], html = bench_converter(converter, report, repeat)
+                print(f"convert {key:20s} {results['converter'][key]['convert']['median_s'] * 1000:10.1f} мс "
+                      f"({results['converter'][key]['throughput_mb_s']:.1f} МБ/с)", file=sys.stderr)
+                results['export'][key] = bench_export(report, repeat, work_dir)
+                print(f"export  {key:20s} {results['export'][key]['csv']['median_s'] * 1000:10.1f} мс "
+                      f"({results['export'][key]['csv']['throughput_mb_s']:.1f} МБ/с, csv)", file=sys.stderr)
+                results['diff'][key] = bench_diff(converter, report, encoding, repeat, work_dir)
+                print(f"diff    {key:20s} {results['diff'][key]['reissue']['median_s'] * 1000:10.1f} мс "
+                      f"(исправление), {results['diff'][key]['next_day']['median_s'] * 1000:.1f} мс "
+                      f"(другой день)", file=sys.stderr)
+
+            results['fix_encoding'][format_size(size)] = measure(fix_encoding_issues, html, repeat)
+            # Разбиение результата на страницы при сохранении (RESULT_PAGE_ROWS по умолчанию)
+            data = html.encode('utf-8')
+            results['paging'][format_size(size)] = measure(lambda data: split_pages(data, 1000),
+                                                           data, repeat)
+            results['search'][format_size(size)] = bench_search(data, repeat, work_dir)
+
+        # Хранение артефактов без сжатия и в формате по умолчанию (gzip)
+        results['temp_files'] = {name: bench_temp_files(html, temp_files, compression=name)
+                                 for name in ('none', 'gzip')}
+
+        if requests_total:
+            server = None
+            if server_url is None:
+                server_url, server = start_app_server(work_dir, stub_url, e2e_size * 2, asgi)
+            report = generate_report(e2e_size, encodings[0])
+            try:
+                for level in concurrency:
+                    key = f"{format_size(e2e_size)}/c{level}"
+                    if slow_clients:
+                        key += f"/slow{slow_clients}"
+                        results['endpoint'][key] = bench_mixed(server_url, report, level,
+                                                               requests_total, slow_clients, unique)
+                    else:
+                        results['endpoint'][key] = bench_endpoint(server_url, report, level,
+                                                                  requests_total, unique)
+                    data = results['endpoint'][key]
+                    print(f"/api/convert {key:14s} p50 {data.get('median_s', 0) * 1000:8.1f} мс, "
+                          f"p95 {data.get('p95_s', 0) * 1000:8.1f} мс, "
+                          f"{data['throughput_rps']:.1f} зап/с, ошибок {data['errors']}",
+                          file=sys.stderr)
+            finally:
+                if server is not None:
+                    server.shutdown()
+
+    return results
+
+def _flatten(data, prefix=''):
+    """Числовые показатели вида converter.1MB/utf-8.convert.median_s"""
+    flat = {}
+    for key, value in data.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(_flatten(value, name + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+def compare(results, baseline):
+    """Сравнение медиан с прошлым прогоном: {показатель: (было, стало, отношение)}"""
+    old = _flatten({key: value for key, value in baseline.items() if key != 'environment'})
+    new = _flatten({key: value for key, value in results.items() if key != 'environment'})
+    return {name: (old[name], new[name], new[name] / old[name])
+            for name in sorted(old.keys() & new.keys())
+            if name.endswith(('median_s', 'p95_s')) and old[name]}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default='1KB,100KB,1MB,10MB',
+                        help='размеры отчётов через запятую (1KB .. 100MB)')
+    parser.add_argument('--encodings', default=','.join(ENCODINGS))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--concurrency', default='1,4,8',
+                        help='уровни параллельности для /api/convert')
+    parser.add_argument('--requests', type=int, default=40,
+                        help='запросов к /api/convert на уровень (0 - не измерять)')
+    parser.add_argument('--e2e-size', default='1MB', help='размер отчёта для /api/convert')
+    parser.add_argument('--temp-files', type=int, default=200,
+                        help='число артефактов для TemporaryFileManager')
+    parser.add_argument('--cached', action='store_true',
+                        help='отправлять одинаковый отчёт (измерять попадания в кэш результатов)')
+    parser.add_argument('--server', help='адрес уже запущенного приложения')
+    parser.add_argument('--stub-port', type=int, default=0,
+                        help='порт замены сервера MOEX (для приложения из --server)')
+    parser.add_argument('--asgi', action='store_true',
+                        help='встроенный сервер - uvicorn с ASGIApplication (requirements-asgi.txt)')
+    parser.add_argument('--slow-clients', type=int, default=0,
+                        help='медленных скачиваний результата параллельно с /api/convert')
+    parser.add_argument('--json', help='файл для результатов')
+    parser.add_argument('--baseline', help='JSON прошлого прогона для сравнения')
+    args = parser.parse_args()
+
+    encodings = [encoding.strip() for encoding in args.encodings.split(',')]
+    for encoding in encodings:
+        if encoding not in ENCODINGS:
+            parser.error(f"неподдерживаемая кодировка: {encoding}")
+
+    results = run(
+        sizes=[parse_size(size) for size in args.sizes.split(',')],
+        encodings=encodings,
+        repeat=args.repeat,
+        concurrency=[int(level) for level in args.concurrency.split(',')],
+        requests_total=args.requests,
+        e2e_size=parse_size(args.e2e_size),
+        temp_files=args.temp_files,
+        server_url=args.server,
+        stub_port=args.stub_port,
+        unique=not args.cached,
+        asgi=args.asgi,
+        slow_clients=args.slow_clients
+    )
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        for name, (old, new, ratio) in compare(results, baseline).items():
+            flag = ' <-- медленнее' if ratio > 1.1 else ''
+            print(f"{name:70s} {old * 1000:10.2f} -> {new * 1000:10.2f} мс  x{ratio:.2f}{flag}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+# benchmarks/startup.py
+"""
+Бенчмарк старта приложения.
+
+Измеряет в свежих процессах интерпретатора:
+
+- стоимость импорта app по модулям (python -X importtime): собственное
+  и накопленное время модулей проекта и сторонних пакетов, без модулей,
+  которые интерпретатор загружает и без приложения;
+- время до первой успешной конвертации: импорт app, create_app и первый
+  POST /api/convert (тестовым клиентом Flask) - для локального набора
+  стилей, прогрева XSLT при старте и загрузки стиля первым запросом;
+- с --gunicorn - время от запуска gunicorn (gunicorn.conf.py, preload_app)
+  до первого успешного ответа /api/convert по HTTP.
+
+Стили отдаёт локальная замена сервера MOEX (benchmarks/stub_server.py),
+сеть не нужна. Результаты пишутся в JSON.
+
+Запуск из корня проекта:
+    python -m benchmarks.startup --repeat 5 --json startup.json
+    python -m benchmarks.startup --gunicorn --workers 4
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import statistics
+import subprocess
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from benchmarks.generate import generate_report, parse_size, format_size
+from benchmarks.stub_server import StubServer
+from benchmarks.run import summarize, environment, STYLESHEETS_DIR
+
+# Сценарии первой конвертации: переменные окружения приложения
+SCENARIOS = {
+    # Стиль из локального набора, скомпилирован при старте
+    'bundle': {'XSLT_PRELOAD': 'False'},
+    # Стиль по умолчанию загружен и скомпилирован при старте (XSLT_PRELOAD)
+    'preload': {'XSLT_BUNDLE_PATH': '', 'XSLT_PRELOAD': 'True'},
+    # Стиль загружается первым запросом
+    'cold': {'XSLT_BUNDLE_PATH': '', 'XSLT_PRELOAD': 'False'},
+}
+
+# Код дочернего процесса: те же шаги, что при старте воркера и первом запросе
+CHILD_CODE = """
+import io, sys, json, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+application = app.create_app('production')
+created = time.perf_counter()
+with open(sys.argv[1], 'rb') as f:
+    report = f.read()
+response = application.test_client().post(
+    '/api/convert', data={'xml_file': (io.BytesIO(report), 'report.xml')},
+    content_type='multipart/form-data')
+finished = time.perf_counter()
+print(json.dumps({'status': response.status_code, 'import_s': imported - started,
+                  'create_app_s': created - imported, 'first_request_s': finished - created,
+                  'modules': len(sys.modules)}))
+"""
+
+def app_environment(work_dir, stub_url, **overrides):
+    """Окружение приложения в отдельном каталоге, стили - с замены сервера MOEX"""
+    env = dict(os.environ)
+    env.update({
+        'SECRET_KEY': env.get('SECRET_KEY', 'benchmark'),
+        'FLASK_CONFIG': 'production',
+        'MOEX_XSLT_BASE': stub_url,
+        'UPLOAD_FOLDER': os.path.join(work_dir, 'uploads'),
+        'XSLT_CACHE_DIR': os.path.join(work_dir, 'xslt_cache'),
+        'XSLT_BUNDLE_PATH': str(STYLESHEETS_DIR),
+        'JANITOR_ENABLED': 'False',
+        'PYTHONPATH': str(ROOT),
+    })
+    env.update(overrides)
+    # Пустое значение - "нет набора": путь, которого не существует
+    if not env['XSLT_BUNDLE_PATH']:
+        env['XSLT_BUNDLE_PATH'] = os.path.join(work_dir, 'no_bundle')
+    return env
+
+def parse_importtime(stderr):
+    """{модуль: (собственное, накопленное время в секундах)} из вывода -X importtime"""
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = (int(self_us) / 1e6, int(cumulative_us) / 1e6)
+    return modules
+
+def bench_imports(env, repeat, top=15):
+    """Стоимость импорта app по модулям (медианы по repeat запускам)"""
+    def run(code):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], env=env,
+                                cwd=ROOT, capture_output=True, text=True, check=True)
+        return parse_importtime(result.stderr)
+
+    # Модули, которые интерпретатор загружает и без приложения (site, .pth)
+    interpreter = set(run('pass'))
+
+    runs = [run('import app') for _ in range(repeat)]
+    names = [name for name in runs[0] if name not in interpreter]
+    modules = {}
+    for name in names:
+        samples = [modules_run[name] for modules_run in runs if name in modules_run]
+        modules[name] = {
+            'self_s': statistics.median(sample[0] for sample in samples),
+            'cumulative_s': statistics.median(sample[1] for sample in samples),
+        }
+
+    project = {name: value for name, value in modules.items()
+               if name in ('app', 'config') or name.startswith('modules.')}
+    # Сторонние пакеты - по корневому модулю (накопленное время включает подмодули)
+    packages = {name: value for name, value in modules.items()
+                if '.' not in name and name not in project}
+    return {
+        'total_s': modules.get('app', {}).get('cumulative_s'),
+        'modules_count': len(modules),
+        'project': project,
+        'packages': dict(sorted(packages.items(), key=lambda item: -item[1]['cumulative_s'])[:top]),
+        'top_self': dict(sorted(modules.items(), key=lambda item: -item[1]['self_s'])[:top]),
+    }
+
+def bench_first_conversion(env, report_path, repeat):
+    """Время до первой успешной конвертации в свежем процессе (с запуском интерпретатора)"""
+    totals = []
+    steps = {}
+    modules = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = subprocess.run([sys.executable, '-c', CHILD_CODE, report_path], env=env,
+                                cwd=ROOT, capture_output=True, text=True)
+        total = time.perf_counter() - started
+        if result.returncode != 0:
+            raise RuntimeError(f"Дочерний процесс завершился с ошибкой:\n{result.stderr}")
+        data = json.loads(result.stdout.strip().splitlines()[-1])
+        if data['status'] != 200:
+            raise RuntimeError(f"/api/convert ответил {data['status']}")
+        totals.append(total)
+        for step in ('import_s', 'create_app_s', 'first_request_s'):
+            steps.setdefault(step, []).append(data[step])
+        modules = data['modules']
+
+    return {
+        'total': summarize(totals),
+        'steps_median_s': {step: statistics.median(values) for step, values in steps.items()},
+        'modules_loaded': modules,
+    }
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def bench_gunicorn(env, report, workers, repeat, timeout=60):
+    """От запуска gunicorn до первого успешного /api/convert по HTTP"""
+    import requests
+
+    totals = []
+    for _ in range(repeat):
+        port = _free_port()
+        started = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '-c', str(ROOT / 'gunicorn.conf.py'),
+             '--workers', str(workers), '--bind', f"127.0.0.1:{port}", 'app:create_app()'],
+            env=env, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            while True:
+                if time.perf_counter() - started > timeout:
+                    raise RuntimeError("gunicorn не ответил вовремя")
+                if process.poll() is not None:
+                    raise RuntimeError(f"gunicorn завершился с кодом {process.returncode}")
+                try:
+                    response = requests.post(f"http://127.0.0.1:{port}/api/convert",
+                                             files={'xml_file': ('report.xml', report)}, timeout=timeout)
+                except requests.exceptions.ConnectionError:
+                    time.sleep(0.01)
+                    continue
+                if response.status_code != 200:
+                    raise RuntimeError(f"/api/convert ответил {response.status_code}")
+                totals.append(time.perf_counter() - started)
+                break
+        finally:
+            process.terminate()
+            process.wait()
+    return {'workers': workers, 'total': summarize(totals)}
+
+def run(repeat, report_size, scenarios, gunicorn_workers=None):
+    results = {'environment': environment(), 'imports': {}, 'first_conversion': {},
+               'gunicorn': {}}
+
+    with tempfile.TemporaryDirectory(prefix='moex_startup_') as work_dir, \
+            StubServer(STYLESHEETS_DIR) as stub:
+        stub_url = stub.url('XSLT/')
+        report = generate_report(report_size)
+        report_path = os.path.join(work_dir, 'report.xml')
+        with open(report_path, 'wb') as f:
+            f.write(report)
+
+        imports = bench_imports(app_environment(work_dir, stub_url), repeat)
+        results['imports'] = imports
+        print(f"import app: {imports['total_s'] * 1000:.1f} мс, модулей - {imports['modules_count']}")
+        for name, value in imports['packages'].items():
+            print(f"  {name:30s} {value['cumulative_s'] * 1000:8.1f} мс")
+
+        for scenario in scenarios:
+            # У каждого сценария свой каталог: кэши прошлых запусков не влияют
+            scenario_dir = tempfile.mkdtemp(prefix=f"{scenario}_", dir=work_dir)
+            env = app_environment(scenario_dir, stub_url, **SCENARIOS[scenario])
+            first = bench_first_conversion(env, report_path, repeat)
+            results['first_conversion'][scenario] = first
+            steps = ', '.join(f"{step[:-2]} {seconds * 1000:.0f} мс"
+                              for step, seconds in first['steps_median_s'].items())
+            print(f"первая конвертация ({scenario}, {format_size(len(report))}): "
+                  f"{first['total']['median_s'] * 1000:.0f} мс ({steps})")
+
+        if gunicorn_workers:
+            scenario_dir = tempfile.mkdtemp(prefix='gunicorn_', dir=work_dir)
+            env = app_environment(scenario_dir, stub_url, **SCENARIOS['bundle'])
+            served = bench_gunicorn(env, report, gunicorn_workers, repeat)
+            results['gunicorn'] = served
+            print(f"gunicorn ({gunicorn_workers} воркеров): первый ответ через "
+                  f"{served['total']['median_s'] * 1000:.0f} мс")
+
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--size', default='100KB', help='размер отчёта первой конвертации')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--gunicorn', action='store_true', help='измерить и запуск gunicorn')
+    parser.add_argument('--workers', type=int, default=2, help='воркеров gunicorn')
+    parser.add_argument('--json', help='файл для результатов')
+    args = parser.parse_args()
+
+    scenarios = [scenario.strip() for scenario in args.scenarios.split(',')]
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            parser.error(f"неизвестный сценарий: {scenario}")
+
+    results = run(args.repeat, parse_size(args.size), scenarios,
+                  gunicorn_workers=args.workers if args.gunicorn else None)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+if __name__ == '__main__':
+    main()
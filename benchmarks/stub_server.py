@@ -0,0 +1,161 @@
+# benchmarks/stub_server.py
+"""
+Локальная замена ftp.moex.com для проверок без сети.
+
+Отдаёт файлы из каталога (по умолчанию - локальный набор стилей) с ETag
+и ответом 304 на условные запросы. Можно задать задержку ответа и число
+первых неудачных ответов для каждого пути, чтобы проверить повторы и
+параллельную загрузку стилей-кандидатов. Считает запросы и TCP-соединения
+(для проверки keep-alive).
+
+Запуск из корня проекта:
+    python -m benchmarks.stub_server --root stylesheets --port 8765 --delay 0.2
+
+Использование в коде:
+    with StubServer('stylesheets', delays={'slow.xsl': 2}) as server:
+        base_url = server.url('XSLT/')
+"""
+import os
+import sys
+import time
+import hashlib
+import argparse
+import threading
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, unquote
+
+class StubServer:
+    """HTTP сервер со статическими файлами в отдельном потоке"""
+
+    def __init__(self, root, host='127.0.0.1', port=0, delay=0.0, delays=None,
+                 fail_first=0, fail_status=503, prefixes=('XSLT/', 'XSD/')):
+        self.root = os.path.abspath(root)
+        self.delay = delay
+        self.delays = dict(delays or {})
+        self.fail_first = fail_first
+        self.fail_status = fail_status
+        # Префиксы путей MOEX, отображаемые на корневой каталог
+        self.prefixes = prefixes
+        self.requests = Counter()
+        self.connections = 0
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def url(self, path=''):
+        return self.base_url + path.lstrip('/')
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever,
+                                        name='stub-server', daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        """Обслуживание в текущем потоке (для запуска из командной строки)"""
+        try:
+            self._httpd.serve_forever()
+        finally:
+            self._httpd.server_close()
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def resolve(self, path):
+        """Путь к файлу для пути запроса (или None)"""
+        path = unquote(urlsplit(path).path).lstrip('/')
+        for prefix in self.prefixes:
+            if path.startswith(prefix):
+                path = path[len(prefix):]
+                break
+        filepath = os.path.abspath(os.path.join(self.root, path))
+        if not filepath.startswith(self.root + os.sep) or not os.path.isfile(filepath):
+            return None
+        return filepath
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # HTTP/1.1 - соединения остаются открытыми между запросами
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                with server._lock:
+                    server.connections += 1
+
+            def do_GET(self):
+                name = os.path.basename(urlsplit(self.path).path)
+                with server._lock:
+                    server.requests[name] += 1
+                    attempt = server.requests[name]
+
+                delay = server.delays.get(name, server.delay)
+                if delay:
+                    time.sleep(delay)
+
+                if attempt <= server.fail_first:
+                    return self._reply(server.fail_status, b'')
+
+                filepath = server.resolve(self.path)
+                if filepath is None:
+                    return self._reply(404, b'')
+
+                with open(filepath, 'rb') as f:
+                    content = f.read()
+                etag = '"%s"' % hashlib.sha256(content).hexdigest()[:16]
+
+                if self.headers.get('If-None-Match') == etag:
+                    return self._reply(304, b'', {'ETag': etag})
+                return self._reply(200, content, {'ETag': etag,
+                                                  'Content-Type': 'application/xml'})
+
+            def _reply(self, status, body, headers=None):
+                self.send_response(status)
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if body:
+                    self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--root', default='stylesheets', help='каталог с XSLT/XSD')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--delay', type=float, default=0.0, help='задержка ответа, с')
+    parser.add_argument('--fail-first', type=int, default=0,
+                        help='сколько первых запросов к каждому файлу завершать ошибкой')
+    args = parser.parse_args()
+
+    server = StubServer(args.root, args.host, args.port, delay=args.delay,
+                        fail_first=args.fail_first)
+    print(f"Стили из {server.root} доступны по {server.url('XSLT/')}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+<?xml version="1.0" encoding="windows-1251"?>
+<!--
+       MOEX CCX99   (benchmarks/generate.py).
+        : ,    
+        .
+-->
+<xsl:stylesheet version="1.0" xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
+<xsl:output method="html" encoding="utf-8" indent="no"/>
+
+<xsl:template match="/CCX99">
+<html>
+<head>
+<meta charset="utf-8"/>
+<title>    <xsl:value-of select="@DocNo"/></title>
+</head>
+<body>
+<h1>    </h1>
+<table class="header">
+<tr><td> </td><td><xsl:value-of select="@FirmName"/> (<xsl:value-of select="@FirmId"/>)</td></tr>
+<tr><td></td><td><xsl:value-of select="@DocDate"/></td></tr>
+<tr><td> </td><td><xsl:value-of select="@DocNo"/></td></tr>
+</table>
+<xsl:for-each select="TRADES/SECURITY">
+<xsl:variable name="trades" select="REC"/>
+<h2><xsl:value-of select="@SecCode"/> - <xsl:value-of select="@SecName"/></h2>
+<table class="trades">
+<tr><th> </th><th></th><th></th><th></th><th></th><th></th><th></th><th> </th></tr>
+<xsl:for-each select="$trades">
+<tr>
+<td><xsl:value-of select="@TradeNo"/></td>
+<td><xsl:value-of select="@TradeTime"/></td>
+<td><xsl:choose><xsl:when test="@BuySell = 'B'"></xsl:when><xsl:otherwise></xsl:otherwise></xsl:choose></td>
+<td><xsl:value-of select="format-number(@Price, '# ##0.0000', 'ru')"/></td>
+<td><xsl:value-of select="format-number(@Quantity, '# ##0', 'ru')"/></td>
+<td><xsl:value-of select="format-number(@Value, '# ##0.00', 'ru')"/></td>
+<td><xsl:value-of select="format-number(@Commission, '# ##0.00', 'ru')"/></td>
+<td><xsl:value-of select="@SettleCode"/></td>
+</tr>
+</xsl:for-each>
+<tr class="total">
+<td colspan="4">  </td>
+<td><xsl:value-of select="format-number(sum($trades/@Quantity), '# ##0', 'ru')"/></td>
+<td><xsl:value-of select="format-number(sum($trades/@Value), '# ##0.00', 'ru')"/></td>
+<td><xsl:value-of select="format-number(sum($trades/@Commission), '# ##0.00', 'ru')"/></td>
+<td/>
+</tr>
+</table>
+</xsl:for-each>
+<p> : <xsl:value-of select="count(TRADES/SECURITY/REC)"/></p>
+</body>
+</html>
+</xsl:template>
+
+<xsl:decimal-format name="ru" decimal-separator="," grouping-separator=" "/>
+
+</xsl:stylesheet>
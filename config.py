@@ -7,28 +7,120 @@ basedir = Path(__file__).parent.absolute()
 class Config:
     # Основные настройки
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'dev-secret-key-change-in-production'
-    MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB
+    # Загрузки принимаются потоково (на диск), поэтому лимит можно поднимать
+    MAX_CONTENT_LENGTH = int(os.environ.get('MAX_CONTENT_LENGTH', 16 * 1024 * 1024))  # 16MB
+    
+    # Число доверенных обратных прокси перед приложением: адрес клиента, схема и хост
+    # берутся из их заголовков X-Forwarded-* (0 - приложение принимает запросы напрямую)
+    TRUSTED_PROXIES = int(os.environ.get('TRUSTED_PROXIES', 0))
     
     # Пути
-    UPLOAD_FOLDER = os.path.join(basedir, 'temp_uploads')
+    UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER') or os.path.join(basedir, 'temp_uploads')
+    # Каталог для принимаемых загрузок (файлы удаляются в конце запроса)
+    UPLOAD_SPOOL_FOLDER = os.path.join(UPLOAD_FOLDER, 'spool')
     STATIC_FOLDER = os.path.join(basedir, 'static')
     TEMPLATE_FOLDER = os.path.join(basedir, 'templates')
     
     # MOEX URLs
-    MOEX_XSLT_BASE = "https://ftp.moex.com/pub/Reports/Currency/XSLT"
-    MOEX_XSD_BASE = "https://ftp.moex.com/pub/Reports/Currency/XSD"
+    # Завершающий "/" обязателен: имена файлов присоединяются через urljoin
+    MOEX_XSLT_BASE = os.environ.get('MOEX_XSLT_BASE') or "https://ftp.moex.com/pub/Reports/Currency/XSLT/"
+    MOEX_XSD_BASE = os.environ.get('MOEX_XSD_BASE') or "https://ftp.moex.com/pub/Reports/Currency/XSD/"
     
     # Время жизни временных файлов (в секундах)
     TEMP_FILE_LIFETIME = 3600  # 1 час
     
+    # Фоновая очистка: период запуска и ширина корзины времени (в секундах)
+    JANITOR_ENABLED = os.environ.get('JANITOR_ENABLED', 'True').lower() == 'true'
+    JANITOR_INTERVAL = int(os.environ.get('JANITOR_INTERVAL', 60))
+    EXPIRY_BUCKET_SECONDS = int(os.environ.get('EXPIRY_BUCKET_SECONDS', 300))
+    
+    # Сжатие результатов на диске: gzip, zstd (нужен пакет zstandard) или none, и уровень сжатия
+    ARTIFACT_COMPRESSION = os.environ.get('ARTIFACT_COMPRESSION', 'gzip').lower()
+    ARTIFACT_COMPRESSION_LEVEL = int(os.environ.get('ARTIFACT_COMPRESSION_LEVEL', 4))
+    # Большие результаты просматриваются по страницам из стольких строк таблиц (0 - целиком)
+    RESULT_PAGE_ROWS = int(os.environ.get('RESULT_PAGE_ROWS', 1000))
+    
+    # Метрики: эндпоинт /metrics (значения всех воркеров хоста, SQLite)
+    # и заголовок Server-Timing в ответе /api/convert
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'True').lower() == 'true'
+    METRICS_DB_PATH = os.environ.get('METRICS_DB_PATH') or os.path.join(UPLOAD_FOLDER, '.metrics.sqlite3')
+    SERVER_TIMING = os.environ.get('SERVER_TIMING', 'False').lower() == 'true'
+    
     # Настройки запросов
     REQUEST_TIMEOUT = 30
+    # Пул соединений к серверу MOEX, повторы с экспоненциальной задержкой
+    # и число потоков для параллельной загрузки стилей-кандидатов
+    HTTP_CONNECT_TIMEOUT = int(os.environ.get('HTTP_CONNECT_TIMEOUT', 5))
+    HTTP_RETRIES = int(os.environ.get('HTTP_RETRIES', 3))
+    HTTP_BACKOFF = float(os.environ.get('HTTP_BACKOFF', 0.5))
+    HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 10))
+    XSLT_FETCH_WORKERS = int(os.environ.get('XSLT_FETCH_WORKERS', 4))
+    
+    # Кэш XSLT: размер (в стилях), время до перепроверки (в секундах) и каталог на диске
+    XSLT_CACHE_SIZE = int(os.environ.get('XSLT_CACHE_SIZE', 32))
+    XSLT_CACHE_TTL = int(os.environ.get('XSLT_CACHE_TTL', 6 * 3600))
+    XSLT_CACHE_DIR = os.environ.get('XSLT_CACHE_DIR') or os.path.join(basedir, 'xslt_cache')
+    
+    # Кэш результатов конвертации: суммарный размер артефактов (в байтах) и число записей
+    RESULT_CACHE_MAX_BYTES = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+    RESULT_CACHE_MAX_ENTRIES = int(os.environ.get('RESULT_CACHE_MAX_ENTRIES', 1000))
+    
+    # Общий для воркеров gunicorn кэш (SQLite): исходники XSLT/XSD, ссылки на результаты
+    # и счётчики кэшей каждого воркера. Вместо XSLT_CACHE_DIR, если включён
+    SHARED_CACHE_ENABLED = os.environ.get('SHARED_CACHE_ENABLED', 'True').lower() == 'true'
+    SHARED_CACHE_PATH = os.environ.get('SHARED_CACHE_PATH') or os.path.join(UPLOAD_FOLDER, '.cache.sqlite3')
+    
+    # Очередь фоновых конвертаций: процессы пула и максимум ожидающих заданий на воркер
+    JOB_WORKERS = int(os.environ.get('JOB_WORKERS', min(4, os.cpu_count() or 1)))
+    JOB_MAX_PENDING = int(os.environ.get('JOB_MAX_PENDING', 32))
+    JOB_DB_PATH = os.environ.get('JOB_DB_PATH') or os.path.join(UPLOAD_FOLDER, '.jobs.sqlite3')
+    
+    # Полнотекстовый поиск по результатам (SQLite FTS5), записи живут столько же, сколько файлы
+    SEARCH_ENABLED = os.environ.get('SEARCH_ENABLED', 'True').lower() == 'true'
+    SEARCH_DB_PATH = os.environ.get('SEARCH_DB_PATH') or os.path.join(UPLOAD_FOLDER, '.search.sqlite3')
+    
+    # Режим ASGI (asgi.py): потоки для конвертаций (CPU) и для остальных обработчиков
+    ASGI_CONVERT_WORKERS = int(os.environ.get('ASGI_CONVERT_WORKERS', os.cpu_count() or 1))
+    ASGI_THREADS = int(os.environ.get('ASGI_THREADS', 32))
+    
+    # Пакетная конвертация: максимум файлов и суммарный размер запроса/распакованных XML
+    BATCH_MAX_FILES = int(os.environ.get('BATCH_MAX_FILES', 200))
+    BATCH_MAX_CONTENT_LENGTH = int(os.environ.get('BATCH_MAX_CONTENT_LENGTH', 256 * 1024 * 1024))
+    
+    # Сравнение отчётов (/api/diff): лимит запроса с двумя файлами и ключевые атрибуты
+    # записей через запятую (по умолчанию - номера сделок/заявок, коды инструментов и счетов)
+    DIFF_MAX_CONTENT_LENGTH = int(os.environ.get('DIFF_MAX_CONTENT_LENGTH', 2 * MAX_CONTENT_LENGTH))
+    DIFF_KEY_ATTRIBUTES = os.environ.get('DIFF_KEY_ATTRIBUTES')
+    
+    # Контроль допуска к конвертациям (общий для воркеров хоста, SQLite): запросов в минуту
+    # и запас подряд на клиента (0 - без лимита частоты; клиент - ключ API из списка или IP),
+    # суммарный размер одновременно обрабатываемых документов (0 - без ограничения)
+    # и Retry-After ответа 503 (в секундах)
+    ADMISSION_ENABLED = os.environ.get('ADMISSION_ENABLED', 'True').lower() == 'true'
+    ADMISSION_RATE_PER_MINUTE = float(os.environ.get('ADMISSION_RATE_PER_MINUTE', 0))
+    ADMISSION_BURST = int(os.environ.get('ADMISSION_BURST', 30))
+    ADMISSION_MAX_INFLIGHT_BYTES = int(os.environ.get('ADMISSION_MAX_INFLIGHT_BYTES', 4 * MAX_CONTENT_LENGTH))
+    ADMISSION_RETRY_AFTER = int(os.environ.get('ADMISSION_RETRY_AFTER', 2))
+    ADMISSION_API_KEY_HEADER = os.environ.get('ADMISSION_API_KEY_HEADER') or 'X-API-Key'
+    # Ключи API (через запятую), которые получают свою корзину; прочие ключи не учитываются
+    ADMISSION_API_KEYS = os.environ.get('ADMISSION_API_KEYS', '')
+    ADMISSION_DB_PATH = os.environ.get('ADMISSION_DB_PATH') or os.path.join(UPLOAD_FOLDER, '.admission.sqlite3')
+    
+    # Локальный набор XSLT/XSD (каталог или zip-архив), загружаемый при старте
+    XSLT_BUNDLE_PATH = os.environ.get('XSLT_BUNDLE_PATH') or os.path.join(basedir, 'stylesheets')
+    # Автономный режим: не обращаться к ftp.moex.com вообще
+    XSLT_OFFLINE = os.environ.get('XSLT_OFFLINE', 'False').lower() == 'true'
+    # Прогрев XSLT по умолчанию при старте приложения
+    XSLT_PRELOAD = os.environ.get('XSLT_PRELOAD', 'False').lower() == 'true'
+    # Файлы больше этого размера /api/validate проверяет потоково, не строя дерево
+    VALIDATE_STREAM_THRESHOLD = int(os.environ.get('VALIDATE_STREAM_THRESHOLD', 8 * 1024 * 1024))
     ALLOWED_EXTENSIONS = {'.xml'}
     
     @staticmethod
     def init_app(app):
         # Создаем необходимые директории
         os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+        os.makedirs(app.config['UPLOAD_SPOOL_FOLDER'], exist_ok=True)
         os.makedirs(app.config['STATIC_FOLDER'], exist_ok=True)
         os.makedirs(app.config['TEMPLATE_FOLDER'], exist_ok=True)
 
@@ -38,13 +130,20 @@ class DevelopmentConfig(Config):
 
 class ProductionConfig(Config):
     DEBUG = False
+    XSLT_PRELOAD = os.environ.get('XSLT_PRELOAD', 'True').lower() == 'true'
     # В продакшене используем более безопасные настройки
     SECRET_KEY = os.environ.get('SECRET_KEY')
-    if not SECRET_KEY:
-        raise ValueError("SECRET_KEY не установлен в переменных окружения")
     
     # Можно использовать Redis или другую БД для сессий
     # SESSION_TYPE = 'redis'
+    
+    @staticmethod
+    def init_app(app):
+        # Проверяется при создании приложения, а не при импорте config:
+        # импорт модуля не должен зависеть от окружения продакшена
+        if not app.config.get('SECRET_KEY'):
+            raise ValueError("SECRET_KEY не установлен в переменных окружения")
+        Config.init_app(app)
 
 config = {
     'development': DevelopmentConfig,
@@ -0,0 +1,33 @@
+# gunicorn.conf.py
+import gc
+
+# Приложение создаётся один раз в мастере: локальный набор XSLT компилируется
+# до fork, и воркеры разделяют скомпилированные стили через copy-on-write
+preload_app = True
+
+def _flask_app(server):
+    """Приложение Flask, загруженное мастером (в режиме ASGI - внутри ASGIApplication)"""
+    if not server.cfg.preload_app:
+        # Без preload каждый воркер создаёт приложение сам, уже после fork
+        return None
+    app = server.app.wsgi()
+    return getattr(app, 'app', app)
+
+def when_ready(server):
+    from app import before_fork
+
+    # Соединения и потоки, открытые при создании приложения, воркерам не достаются
+    app = _flask_app(server)
+    if app is not None:
+        before_fork(app)
+    # Переносим объекты, созданные при загрузке, в постоянное поколение GC,
+    # чтобы сборщик мусора в воркерах не трогал их страницы памяти
+    gc.freeze()
+
+def post_fork(server, worker):
+    from app import after_fork
+
+    # Состояние воркера (поток очистки, счётчики кэшей) - до первого запроса
+    app = _flask_app(server)
+    if app is not None:
+        after_fork(app)
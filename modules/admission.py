@@ -0,0 +1,240 @@
+# modules/admission.py
+"""
+Контроль допуска к конвертациям.
+
+Один клиент, массово отправляющий большие файлы в /api/convert, может
+занять XSLT-преобразованиями все воркеры, и запросы /upload остальных
+пользователей будут ждать до таймаута. Перед обработкой запроса
+проверяются:
+
+- лимит частоты клиента (ключ API из разрешённого списка или IP) -
+  маркерная корзина: rate запросов в секунду с запасом burst; при
+  превышении - 429 с Retry-After, через сколько появится маркер;
+- суммарный размер документов, обрабатываемых на хосте одновременно
+  (вес запроса - его Content-Length); при превышении - 503 с Retry-After.
+
+Состояние хранится в SQLite рядом с временными файлами, поэтому лимиты
+действуют на весь хост, а не на каждый воркер gunicorn в отдельности.
+Проверка и учёт - одна короткая транзакция до чтения тела запроса:
+отказ не тратит ни приёма файла, ни разбора XML.
+"""
+import os
+import math
+import time
+import uuid
+import hashlib
+import sqlite3
+import threading
+from .utils import process_alive
+
+# Меньше этого вес запроса не считается: маленький документ тоже занимает воркер
+MIN_WEIGHT = 64 * 1024
+# Запись о запросе старше этого (в секундах) считается оставшейся от упавшего процесса
+INFLIGHT_LEASE = 600
+
+class AdmissionRejected(Exception):
+    """Запрос не допущен: status - 429 или 503, retry_after - секунды до повтора"""
+
+    def __init__(self, message, status, retry_after):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+class AdmissionTicket:
+    """Допущенный запрос: его вес учитывается до выхода из with (или release)"""
+
+    def __init__(self, control, ticket_id, weight):
+        self.control = control
+        self.ticket_id = ticket_id
+        self.weight = weight
+
+    def release(self):
+        if self.ticket_id is not None:
+            self.control._release(self.ticket_id)
+            self.ticket_id = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+class AdmissionControl:
+    """
+    Лимиты частоты клиентов и нагрузки хоста (общие для процессов, SQLite).
+
+    rate - запросов в секунду на клиента (0 - без лимита), burst - сколько
+    запросов клиент может сделать подряд; max_inflight_bytes - суммарный
+    вес одновременно обрабатываемых запросов (0 - без лимита). Запрос
+    тяжелее max_inflight_bytes допускается, только когда других нет.
+    Своя корзина - только у ключей из api_keys: иначе клиент обходил бы
+    лимит, меняя ключ в каждом запросе.
+    """
+
+    def __init__(self, db_path, rate=1.0, burst=10, max_inflight_bytes=0, retry_after=2,
+                 api_keys=()):
+        self.db_path = db_path
+        # Хранятся только хэши ключей
+        self._api_keys = {self._key_hash(key) for key in api_keys}
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.max_inflight_bytes = max_inflight_bytes
+        self.retry_after = retry_after
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._stats = {'admitted': 0, 'rate_limited': 0, 'overloaded': 0}
+
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS buckets (
+                client TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS inflight (
+                ticket TEXT PRIMARY KEY,
+                pid INTEGER NOT NULL,
+                weight INTEGER NOT NULL,
+                started REAL NOT NULL
+            );
+        """)
+
+    def _conn(self):
+        """Соединение текущего потока (после fork открывается заново)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def close(self):
+        """Закрытие соединения текущего потока (в мастере gunicorn перед fork)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            conn.close()
+        self._local.conn = None
+
+    @staticmethod
+    def _key_hash(api_key):
+        return hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+
+    def client_id(self, api_key=None, address=None):
+        """
+        Идентификатор клиента: хэш ключа API (сам ключ не хранится), если
+        ключ есть в разрешённом списке, иначе IP
+        """
+        if api_key:
+            key_hash = self._key_hash(api_key)
+            if key_hash in self._api_keys:
+                return 'key:' + key_hash[:32]
+        return f"ip:{address or 'unknown'}"
+
+    def admit(self, client, weight=0, inflight=True):
+        """
+        Допуск запроса клиента client весом weight байт.
+
+        Возвращает AdmissionTicket (with ticket: ... - на время обработки)
+        или возбуждает AdmissionRejected. С inflight=False проверяется
+        только лимит частоты (запрос не нагружает хост, например
+        постановка в очередь заданий).
+        """
+        weight = max(weight or 0, MIN_WEIGHT) if inflight else 0
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            tokens = self._tokens(conn, client, now)
+            if tokens < 1:
+                conn.execute("COMMIT")
+                self._count('rate_limited')
+                raise AdmissionRejected(
+                    "Слишком много запросов, повторите позже", 429,
+                    max(1, math.ceil((1 - tokens) / self.rate)))
+
+            ticket_id = None
+            if weight and self.max_inflight_bytes:
+                if not self._has_capacity(conn, weight, now):
+                    conn.execute("COMMIT")
+                    self._count('overloaded')
+                    raise AdmissionRejected(
+                        "Сервер перегружен конвертациями, повторите позже", 503,
+                        self.retry_after)
+                ticket_id = uuid.uuid4().hex
+                conn.execute("INSERT INTO inflight (ticket, pid, weight, started) "
+                             "VALUES (?, ?, ?, ?)", (ticket_id, os.getpid(), weight, now))
+
+            if self.rate:
+                conn.execute("INSERT OR REPLACE INTO buckets (client, tokens, updated) "
+                             "VALUES (?, ?, ?)", (client, tokens - 1, now))
+            conn.execute("COMMIT")
+        except AdmissionRejected:
+            raise
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+        self._count('admitted')
+        return AdmissionTicket(self, ticket_id, weight)
+
+    def _tokens(self, conn, client, now):
+        """Маркеры в корзине клиента на момент now"""
+        if not self.rate:
+            return float(self.burst)
+        row = conn.execute("SELECT tokens, updated FROM buckets WHERE client = ?",
+                           (client,)).fetchone()
+        if row is None:
+            return float(self.burst)
+        tokens, updated = row
+        return min(float(self.burst), tokens + max(0.0, now - updated) * self.rate)
+
+    def _has_capacity(self, conn, weight, now):
+        """Помещается ли запрос в лимит; при нехватке убираются записи упавших процессов"""
+        count, total = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(weight), 0) FROM inflight").fetchone()
+        if not count or total + weight <= self.max_inflight_bytes:
+            return True
+
+        stale = [ticket for ticket, pid, started in conn.execute(
+                     "SELECT ticket, pid, started FROM inflight")
+                 if started < now - INFLIGHT_LEASE or not process_alive(pid)]
+        if not stale:
+            return False
+        conn.executemany("DELETE FROM inflight WHERE ticket = ?", [(t,) for t in stale])
+        count, total = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(weight), 0) FROM inflight").fetchone()
+        return not count or total + weight <= self.max_inflight_bytes
+
+    def _release(self, ticket_id):
+        self._conn().execute("DELETE FROM inflight WHERE ticket = ?", (ticket_id,))
+
+    def purge(self, max_age_seconds):
+        """
+        Удаление полных корзин (клиент давно не обращался - состояние
+        совпадает с отсутствием записи); возвращает число записей
+        """
+        refill = self.burst / self.rate if self.rate else 0
+        cutoff = time.time() - max(max_age_seconds, refill)
+        return self._conn().execute("DELETE FROM buckets WHERE updated < ?",
+                                    (cutoff,)).rowcount
+
+    def stats(self):
+        """Лимиты, нагрузка хоста и счётчики решений текущего процесса"""
+        count, total = self._conn().execute(
+            "SELECT COUNT(*), COALESCE(SUM(weight), 0) FROM inflight").fetchone()
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update({
+            'rate_per_minute': self.rate * 60,
+            'burst': self.burst,
+            'max_inflight_bytes': self.max_inflight_bytes,
+            'inflight_requests': count,
+            'inflight_bytes': total,
+        })
+        return stats
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
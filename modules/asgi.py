@@ -0,0 +1,319 @@
+# modules/asgi.py
+"""
+Обслуживание приложения по ASGI (uvicorn): сетевой ввод-вывод - в цикле событий.
+
+Под sync-воркерами gunicorn каждое соединение занимает воркер целиком:
+и медленный клиент, скачивающий многомегабайтный /download, и запрос,
+ждущий XSLT с ftp.moex.com. ASGIApplication обслуживает то же
+Flask-приложение так:
+
+- тело запроса принимается в цикле событий (небольшое - в память,
+  большое - во временный файл), обработчик получает его целиком;
+- XSLT, на которые ссылается загружаемый документ, загружаются асинхронно
+  (ResourceFetcher.fetch_async) и кладутся в кэш конвертера до того, как
+  запрос попадёт в поток: поток сети не ждёт;
+- обработчики Flask выполняются в ограниченных пулах потоков: конвертации
+  (XSLT нагружает CPU, lxml отпускает GIL на время преобразования) - в пуле
+  из convert_workers потоков, остальные запросы - в общем пуле;
+- файлы ответов (send_file: /download, /result/.../raw, экспорт) отдаются
+  из цикла событий кусками, медленный клиент поток не занимает.
+"""
+import os
+import sys
+import asyncio
+import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.wsgi import FileWrapper
+
+logger = logging.getLogger(__name__)
+
+# Тело запроса больше этого размера принимается во временный файл
+BODY_SPOOL_SIZE = 1024 * 1024
+# Размер куска при отдаче файлов из цикла событий
+FILE_CHUNK_SIZE = 256 * 1024
+# Ответ обработчика до этого размера собирается в потоке целиком
+RESPONSE_BUFFER_SIZE = 256 * 1024
+# Сколько байт начала тела просматривается в поисках xml-stylesheet
+STYLESHEET_SCAN_SIZE = 64 * 1024
+
+# Запросы, нагружающие CPU (разбор и преобразование XML), - в пуле конвертаций
+CONVERSION_PATHS = frozenset(('/upload', '/api/convert', '/api/convert/batch',
+                              '/api/export', '/api/validate', '/api/diff'))
+# Запросы, для которых заранее загружаются XSLT из документа
+PREFETCH_PATHS = frozenset(('/upload', '/api/convert', '/api/diff'))
+
+class AsyncFileWrapper(FileWrapper):
+    """Файл ответа (wsgi.file_wrapper), который ASGIApplication отдаёт из цикла событий"""
+
+class ASGIApplication:
+    """
+    ASGI-приложение поверх Flask-приложения фабрики create_app.
+
+    Пулы потоков принадлежат процессу и создаются лениво (после fork -
+    заново), поэтому приложение можно создать и в мастере gunicorn.
+    """
+
+    def __init__(self, app, convert_workers=None, threads=None):
+        self.app = app
+        self.converter = app.extensions.get('moex', {}).get('converter')
+        self.convert_workers = convert_workers or app.config['ASGI_CONVERT_WORKERS']
+        self.threads = threads or app.config['ASGI_THREADS']
+        # Больше этого тело не принимается; точный предел маршрута проверит Flask
+        self.max_body_size = max(app.config['MAX_CONTENT_LENGTH'] or 0,
+                                 app.config.get('BATCH_MAX_CONTENT_LENGTH') or 0,
+                                 app.config.get('DIFF_MAX_CONTENT_LENGTH') or 0) or None
+        self.spool_dir = app.config.get('UPLOAD_SPOOL_FOLDER')
+        self._pid = None
+        self._conversions = None
+        self._handlers = None
+        self._prefetching = {}
+        self._lock = threading.Lock()
+
+    def _pools(self):
+        """(пул конвертаций, общий пул) текущего процесса"""
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    self._conversions = ThreadPoolExecutor(max_workers=self.convert_workers,
+                                                           thread_name_prefix='moex-convert')
+                    self._handlers = ThreadPoolExecutor(max_workers=self.threads,
+                                                        thread_name_prefix='moex-request')
+                    self._prefetching = {}
+                    self._pid = pid
+        return self._conversions, self._handlers
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http':
+            await self._handle(scope, receive, send)
+        elif scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'websocket':
+            await send({'type': 'websocket.close'})
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.converter is not None:
+                    await self.converter.fetcher.aclose()
+                if self._pid == os.getpid():
+                    self._conversions.shutdown(wait=False)
+                    self._handlers.shutdown(wait=False)
+                    self._pid = None
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _handle(self, scope, receive, send):
+        loop = asyncio.get_running_loop()
+        conversions, handlers = self._pools()
+
+        received = await self._receive_body(scope, receive)
+        if received is None:
+            # Клиент отключился, не дослав тело
+            return
+        body, length = received
+        if body is None:
+            await self._send_simple(send, 413, "Тело запроса слишком большое")
+            return
+
+        path = scope['path']
+        conversion = scope['method'] == 'POST' and path in CONVERSION_PATHS
+        try:
+            if conversion and path in PREFETCH_PATHS and self.converter is not None:
+                await self._prefetch_stylesheets(body)
+            environ = self._environ(scope, body, length)
+            status, headers, chunks, rest = await loop.run_in_executor(
+                conversions if conversion else handlers, self._run_app, environ)
+        except Exception as e:
+            logger.error(f"Ошибка обработки запроса {path}: {e}")
+            await self._send_simple(send, 500, "Внутренняя ошибка сервера")
+            return
+        finally:
+            body.close()
+
+        # Отключение клиента во время отдачи ответа прекращает чтение файла
+        disconnected = asyncio.Event()
+        watcher = asyncio.ensure_future(self._watch_disconnect(receive, disconnected))
+        try:
+            await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+            for chunk in chunks:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            if rest is not None:
+                await self._stream(rest, send, disconnected, handlers)
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            watcher.cancel()
+            if rest is not None and hasattr(rest, 'close'):
+                await loop.run_in_executor(handlers, rest.close)
+
+    async def _receive_body(self, scope, receive):
+        """
+        Тело запроса: (файл, длина); (None, длина) - больше допустимого,
+        None - клиент отключился.
+        """
+        declared = None
+        for name, value in scope['headers']:
+            if name == b'content-length':
+                try:
+                    declared = int(value)
+                except ValueError:
+                    pass
+
+        body = tempfile.SpooledTemporaryFile(max_size=BODY_SPOOL_SIZE, dir=self.spool_dir)
+        if declared is not None and self.max_body_size and declared > self.max_body_size:
+            # Тело не читаем: ответ 413 по Content-Length даст сам Flask
+            return body, declared
+
+        size = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                body.close()
+                return None
+            chunk = message.get('body', b'')
+            if chunk:
+                size += len(chunk)
+                if self.max_body_size and size > self.max_body_size:
+                    body.close()
+                    return None, size
+                body.write(chunk)
+            if not message.get('more_body', False):
+                break
+
+        body.seek(0)
+        return body, size
+
+    async def _prefetch_stylesheets(self, body):
+        """Асинхронная загрузка XSLT, указанных в начале загружаемого документа"""
+        head = body.read(STYLESHEET_SCAN_SIZE)
+        body.seek(0)
+        urls = self.converter.scan_xslt_urls(head) or [self.converter.default_xslt_url()]
+        await asyncio.gather(*(self._prefetch(url) for url in dict.fromkeys(urls)))
+
+    async def _prefetch(self, url):
+        # Одновременные запросы с одним стилем ждут одну загрузку
+        task = self._prefetching.get(url)
+        if task is None:
+            task = asyncio.ensure_future(self.converter.prefetch_xslt(url))
+            self._prefetching[url] = task
+            task.add_done_callback(lambda _: self._prefetching.pop(url, None))
+        await asyncio.shield(task)
+
+    def _environ(self, scope, body, length):
+        """Окружение WSGI для запроса ASGI"""
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client')
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1] or 80),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'REMOTE_ADDR': client[0] if client else '',
+            'CONTENT_LENGTH': str(length),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.input_terminated': True,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+            'wsgi.file_wrapper': AsyncFileWrapper,
+        }
+        for name, value in scope['headers']:
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name == 'CONTENT_LENGTH':
+                continue
+            key = name if name == 'CONTENT_TYPE' else f"HTTP_{name}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
+
+    def _run_app(self, environ):
+        """
+        Вызов Flask-приложения в потоке пула.
+
+        Возвращает (статус, заголовки, начало тела, остаток): файл ответа
+        и длинный ответ не читаются здесь, их дочитывает цикл событий.
+        """
+        response = {}
+        chunks = []
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                   for name, value in headers]
+            return chunks.append
+
+        result = self.app(environ, start_response)
+        if isinstance(result, AsyncFileWrapper):
+            return response['status'], response['headers'], chunks, result
+
+        size = 0
+        iterator = iter(result)
+        try:
+            for chunk in iterator:
+                chunks.append(chunk)
+                size += len(chunk)
+                if size >= RESPONSE_BUFFER_SIZE:
+                    return response['status'], response['headers'], chunks, _Remainder(result, iterator)
+        except BaseException:
+            if hasattr(result, 'close'):
+                result.close()
+            raise
+
+        if hasattr(result, 'close'):
+            result.close()
+        return response['status'], response['headers'], chunks, None
+
+    async def _stream(self, rest, send, disconnected, executor):
+        """Отдача остатка ответа: чтение - в пуле, ожидание клиента - в цикле событий"""
+        loop = asyncio.get_running_loop()
+        if isinstance(rest, AsyncFileWrapper):
+            read = rest.file.read
+            args = (FILE_CHUNK_SIZE,)
+        else:
+            # Итератор WSGI может отдавать и пустые куски - конец по None
+            read = next
+            args = (rest.iterator, None)
+        while not disconnected.is_set():
+            chunk = await loop.run_in_executor(executor, read, *args)
+            if chunk is None or (read is not next and not chunk):
+                break
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+
+    async def _watch_disconnect(self, receive, disconnected):
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                disconnected.set()
+                return
+
+    async def _send_simple(self, send, status, message):
+        body = message.encode('utf-8')
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', b'text/plain; charset=utf-8'),
+                                (b'content-length', str(len(body)).encode('ascii'))]})
+        await send({'type': 'http.response.body', 'body': body})
+
+class _Remainder:
+    """Недочитанный ответ обработчика: итератор и исходный объект (для close)"""
+
+    __slots__ = ('result', 'iterator')
+
+    def __init__(self, result, iterator):
+        self.result = result
+        self.iterator = iterator
+
+    def close(self):
+        if hasattr(self.result, 'close'):
+            self.result.close()
@@ -0,0 +1,148 @@
+# modules/batch.py
+import os
+import json
+import shutil
+import zipfile
+from collections import OrderedDict
+from .utils import allowed_file
+
+# Размер блока при копировании загруженных файлов
+CHUNK_SIZE = 1024 * 1024
+
+class BatchError(Exception):
+    """Некорректный пакет файлов"""
+
+def _copy_limited(src, dst_path, limit):
+    """Копирование потока в файл с ограничением размера; возвращает число байт"""
+    written = 0
+    with open(dst_path, 'wb') as dst:
+        while True:
+            chunk = src.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            written += len(chunk)
+            if written > limit:
+                raise BatchError("Превышен допустимый суммарный размер пакета")
+            dst.write(chunk)
+    return written
+
+def collect_batch_inputs(files, input_dir, max_files, max_bytes):
+    """
+    Сохранение XML из multipart-частей и zip-архивов во input_dir.
+
+    Возвращает список (исходное имя, путь к файлу). Число файлов и их
+    суммарный (распакованный) размер ограничены.
+    """
+    items = []
+    total = 0
+
+    def add(name, stream):
+        nonlocal total
+        if len(items) >= max_files:
+            raise BatchError(f"Слишком много файлов в пакете (максимум {max_files})")
+        path = os.path.join(input_dir, f"{len(items):05d}.xml")
+        total += _copy_limited(stream, path, max_bytes - total)
+        items.append((name, path))
+
+    for file in files:
+        if not file or not file.filename:
+            continue
+
+        if file.filename.lower().endswith('.zip'):
+            try:
+                with zipfile.ZipFile(file.stream) as archive:
+                    for info in archive.infolist():
+                        if info.is_dir() or not allowed_file(info.filename):
+                            continue
+                        with archive.open(info) as member:
+                            add(os.path.basename(info.filename), member)
+            except zipfile.BadZipFile:
+                raise BatchError(f"Повреждённый zip-архив: {file.filename}")
+        elif allowed_file(file.filename):
+            add(os.path.basename(file.filename), file.stream)
+        else:
+            raise BatchError(f"Недопустимый формат файла: {file.filename}")
+
+    if not items:
+        raise BatchError("В пакете нет XML файлов")
+
+    return items
+
+def group_by_stylesheet(converter, items):
+    """Группировка файлов по XSLT, в который они разрешаются"""
+    groups = OrderedDict()
+    for name, path in items:
+        urls = converter.peek_xslt_urls(path)
+        xslt_url = urls[0] if urls else converter.default_xslt_url()
+        groups.setdefault(xslt_url, []).append((name, path))
+    return groups
+
+def _output_names(items):
+    """Уникальные имена HTML файлов в архиве результата"""
+    used = set()
+    names = {}
+    for name, path in items:
+        base = os.path.splitext(name)[0] or 'report'
+        candidate = f"{base}.html"
+        index = 1
+        while candidate in used:
+            candidate = f"{base}_{index}.html"
+            index += 1
+        used.add(candidate)
+        names[path] = candidate
+    return names
+
+def plan_chunks(groups, workers, output_names):
+    """
+    Разбиение групп на части для пула процессов.
+
+    Каждая часть содержит файлы только одного XSLT; большая группа делится
+    на несколько частей, чтобы занять все ядра.
+    """
+    chunks = []
+    for items in groups.values():
+        parts = max(1, min(workers, len(items)))
+        size = -(-len(items) // parts)
+        for start in range(0, len(items), size):
+            chunks.append([(name, path, output_names[path])
+                           for name, path in items[start:start + size]])
+    return chunks
+
+def convert_batch(converter, job_queue, files, work_dir, max_files, max_bytes):
+    """
+    Пакетная конвертация.
+
+    Возвращает (путь к zip с HTML и manifest.json, манифест).
+    """
+    input_dir = os.path.join(work_dir, 'in')
+    output_dir = os.path.join(work_dir, 'out')
+    os.makedirs(input_dir, exist_ok=True)
+    os.makedirs(output_dir, exist_ok=True)
+
+    items = collect_batch_inputs(files, input_dir, max_files, max_bytes)
+    groups = group_by_stylesheet(converter, items)
+    output_names = _output_names(items)
+    chunks = plan_chunks(groups, job_queue.max_workers, output_names)
+
+    results = job_queue.run_batch(chunks, output_dir)
+
+    manifest = {
+        'total': len(results),
+        'converted': sum(1 for result in results if result['status'] == 'ok'),
+        'failed': sum(1 for result in results if result['status'] != 'ok'),
+        'stylesheets': {url: len(group) for url, group in groups.items()},
+        'files': results
+    }
+
+    zip_path = os.path.join(work_dir, 'result.zip')
+    with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for result in results:
+            if result['status'] == 'ok':
+                archive.write(os.path.join(output_dir, result['output']), result['output'])
+        archive.writestr('manifest.json', json.dumps(manifest, ensure_ascii=False, indent=2))
+
+    # Исходные и промежуточные файлы больше не нужны
+    shutil.rmtree(input_dir, ignore_errors=True)
+    shutil.rmtree(output_dir, ignore_errors=True)
+
+    return zip_path, manifest
@@ -0,0 +1,109 @@
+# modules/bundle.py
+import os
+import zipfile
+from functools import partial
+from urllib.parse import urljoin, quote, unquote
+from lxml import etree
+from .converter import compile_xslt, compile_schema
+
+XSLT_EXTENSIONS = {'.xsl', '.xslt'}
+XSD_EXTENSIONS = {'.xsd'}
+
+class ZipBundleResolver(etree.Resolver):
+    """
+    xsl:include/xs:include/xs:import между файлами zip-набора.
+
+    Файл архива получает base_url bundle:///<путь в архиве>; относительные
+    ссылки lxml разрешает от него, а содержимое отдаётся из архива.
+    """
+
+    PREFIX = 'bundle:///'
+
+    def __init__(self, members):
+        super().__init__()
+        self.members = members
+
+    @classmethod
+    def url(cls, path):
+        return cls.PREFIX + quote(path)
+
+    def resolve(self, url, pubid, context):
+        if not url or not url.startswith(self.PREFIX):
+            return None
+        content = self.members.get(unquote(url[len(self.PREFIX):]))
+        if content is None:
+            return None
+        return self.resolve_string(content, context, base_url=url)
+
+def iter_bundle_files(bundle_path):
+    """
+    Перебор файлов локального набора стилей MOEX.
+
+    Набор - каталог (копия C:\\MICEX\\XSLT\\ и C:\\MICEX\\XSD\\) или zip-архив.
+    Возвращает кортежи (имя файла, содержимое, base_url для xsl:include/xs:include,
+    resolver). Для каталога включаемые файлы читаются с диска (resolver - None),
+    для архива - из него через ZipBundleResolver.
+    """
+    if zipfile.is_zipfile(bundle_path):
+        with zipfile.ZipFile(bundle_path) as archive:
+            members = {info.filename: archive.read(info)
+                       for info in archive.infolist() if not info.is_dir()}
+        resolver = ZipBundleResolver(members)
+        for path, content in members.items():
+            yield os.path.basename(path), content, ZipBundleResolver.url(path), resolver
+        return
+
+    for root, _, files in os.walk(bundle_path):
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            with open(path, 'rb') as f:
+                yield name, f.read(), path, None
+
+def load_stylesheet_bundle(converter, bundle_path):
+    """
+    Загрузка и компиляция локального набора XSLT/XSD.
+
+    Каждый файл закрепляется в кэше конвертера под тем же URL, в который
+    extract_xslt_urls переписывает путь C:\\MICEX\\XSLT\\<имя>, поэтому
+    документы с такими ссылками обрабатываются без обращения к ftp.moex.com.
+
+    XSLT компилируются сразу (нужны первой же конвертации), XSD - при первой
+    проверке по схеме: их в наборе десятки, а проверка нужна не каждому
+    процессу, и старт на их компиляцию не тратится.
+    """
+    loaded = {'xslt': 0, 'xsd': 0, 'errors': []}
+
+    if not bundle_path or not os.path.exists(bundle_path):
+        return loaded
+
+    for name, content, base_url, resolver in iter_bundle_files(bundle_path):
+        ext = os.path.splitext(name)[1].lower()
+        try:
+            if ext in XSLT_EXTENSIONS:
+                url = urljoin(converter.xslt_base_url, name)
+                converter.xslt_cache.preload(url, content,
+                                             compile_xslt(content, base_url, resolver=resolver))
+                loaded['xslt'] += 1
+            elif ext in XSD_EXTENSIONS and converter.xsd_base_url:
+                url = urljoin(converter.xsd_base_url, name)
+                converter.xsd_cache.preload(url, content,
+                                            compiler=partial(compile_schema, base_url=base_url,
+                                                             resolver=resolver))
+                loaded['xsd'] += 1
+        except Exception as e:
+            loaded['errors'].append(f"{name}: {e}")
+
+    return loaded
+
+def warm_up(converter, xslt_urls=None):
+    """Прогрев кэша: компиляция XSLT по умолчанию и дополнительных стилей"""
+    urls = [converter.default_xslt_url()] + list(xslt_urls or [])
+    errors = []
+
+    for url in urls:
+        try:
+            converter.get_transform(url)
+        except Exception as e:
+            errors.append(f"{url}: {e}")
+
+    return errors
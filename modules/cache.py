@@ -0,0 +1,682 @@
+# modules/cache.py
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import nullcontext
+from .utils import file_lock
+
+
+class CacheEntry:
+    """Запись кэша: исходные байты ресурса и скомпилированный объект"""
+
+    __slots__ = ('url', 'content', 'etag', 'last_modified', 'checked_at',
+                 'compiled', 'compiler', 'pinned', 'digest')
+
+    def __init__(self, url, content, etag=None, last_modified=None, checked_at=None,
+                 pinned=False):
+        self.url = url
+        self.content = content
+        self.etag = etag
+        self.last_modified = last_modified
+        self.checked_at = checked_at if checked_at is not None else time.time()
+        self.compiled = None
+        # Своя функция компиляции записи (отложенная компиляция из локального набора)
+        self.compiler = None
+        # Закреплённые записи (из локального набора стилей) не вытесняются и не перепроверяются
+        self.pinned = pinned
+        self.digest = hashlib.sha256(content).hexdigest()
+
+    @property
+    def version(self):
+        """Версия ресурса: хэш содержимого (меняется вместе со стилем)"""
+        return self.digest[:16]
+
+
+class StylesheetCache:
+    """
+    LRU-кэш ресурсов MOEX (XSLT/XSD), ключ - итоговый URL ресурса.
+
+    В памяти держим скомпилированные объекты (etree.XSLT, etree.XMLSchema), исходные байты
+    дополнительно сохраняем на диск, чтобы перезапущенный воркер стартовал
+    "тёплым". После истечения TTL запись перепроверяется условным запросом
+    (If-None-Match / If-Modified-Since).
+
+    fetch(url, etag, last_modified) должен возвращать кортеж
+    (content, etag, last_modified), где content is None означает 304.
+
+    С общим хранилищем store (SharedCacheStore) исходные байты хранятся
+    в нём вместо cache_dir: их видят все процессы хоста, а загрузка и
+    перепроверка ресурса выполняются одним процессом, остальные ждут
+    и берут результат из хранилища.
+    """
+
+    def __init__(self, fetch, compile, max_entries=32, ttl=3600, cache_dir=None, store=None):
+        self.fetch = fetch
+        self.compile = compile
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.cache_dir = cache_dir
+        self.store = store
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {
+            'hits': 0,          # свежая запись из памяти
+            'disk_hits': 0,     # запись поднята с диска
+            'shared_hits': 0,   # запись из общего хранилища (загружена другим процессом)
+            'misses': 0,        # полная загрузка с сервера
+            'revalidated': 0,   # 304 Not Modified
+            'refreshed': 0,     # стиль изменился на сервере
+            'stale_served': 0,  # сервер недоступен, отдали старую версию
+            'evictions': 0,
+        }
+
+        if cache_dir and store is None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def get(self, url):
+        """Получение скомпилированного стиля по URL"""
+        entry = self._lookup(url)
+
+        if entry is None:
+            entry = self._load(url)
+            if entry is None:
+                with self._single_flight(url):
+                    # Пока ждали блокировку, ресурс мог загрузить другой процесс
+                    entry = self._load(url)
+                    if entry is None:
+                        content, etag, last_modified = self.fetch(url, None, None)
+                        entry = CacheEntry(url, content, etag, last_modified)
+                        self._save(entry)
+                        self._count('misses')
+        elif self._is_fresh(entry):
+            self._count('hits')
+
+        if not self._is_fresh(entry):
+            entry = self._revalidate(entry)
+
+        if entry.compiled is None:
+            entry.compiled = (entry.compiler or self.compile)(entry.content)
+
+        self._store(entry)
+        return entry.compiled
+
+    def preload(self, url, content, compiled=None, compiler=None):
+        """
+        Закрепление ресурса из локального набора без обращения к сети.
+
+        С compiler запись компилируется не сейчас, а при первом get этой
+        функцией (compiler(content)).
+        """
+        entry = CacheEntry(url, content, pinned=True)
+        if compiler is not None and compiled is None:
+            entry.compiler = compiler
+        else:
+            entry.compiled = compiled if compiled is not None else self.compile(content)
+        with self._lock:
+            self._entries[url] = entry
+            self._entries.move_to_end(url)
+        return entry
+
+    def validators(self, url):
+        """
+        Нужна ли загрузка ресурса: None, если свежая запись есть в памяти,
+        общем хранилище или на диске, иначе (etag, last_modified) для
+        условного запроса (оба None, если ресурса нет совсем).
+
+        Вместе с update() позволяет загрузить ресурс вне get() - например,
+        асинхронно в режиме ASGI; компиляцию затем выполнит get().
+        """
+        entry = self._lookup(url)
+        if entry is None:
+            entry = self._load_shared(url) if self.store is not None else self._load_from_disk(url)
+        if entry is None:
+            return None, None
+        if self._is_fresh(entry):
+            return None
+        return entry.etag, entry.last_modified
+
+    def update(self, url, content, etag=None, last_modified=None):
+        """Результат загрузки ресурса вне get(): content is None - ответ 304"""
+        if content is None:
+            entry = self._lookup(url)
+            if entry is None:
+                entry = self._load_shared(url) if self.store is not None else self._load_from_disk(url)
+                if entry is None:
+                    return
+            entry.checked_at = time.time()
+            self._save_meta(entry)
+            self._count('revalidated')
+        else:
+            current = self._lookup(url)
+            if current is not None and current.digest == hashlib.sha256(content).hexdigest():
+                # Стиль не изменился - скомпилированный объект остаётся
+                entry = current
+                entry.etag, entry.last_modified = etag, last_modified
+                entry.checked_at = time.time()
+                self._save_meta(entry)
+            else:
+                entry = CacheEntry(url, content, etag, last_modified)
+                self._save(entry)
+            self._count('misses' if current is None else 'refreshed')
+        self._store(entry)
+
+    def contains(self, url):
+        """Есть ли ресурс в памяти (без загрузки и перепроверки)"""
+        with self._lock:
+            return url in self._entries
+
+    def get_entry(self, url):
+        """Получение записи кэша (с загрузкой и компиляцией при необходимости)"""
+        self.get(url)
+        with self._lock:
+            return self._entries.get(url)
+
+    def stats(self):
+        """Счётчики попаданий/промахов кэша"""
+        with self._lock:
+            stats = dict(self._counters)
+            stats['size'] = len(self._entries)
+            stats['pinned'] = sum(1 for entry in self._entries.values() if entry.pinned)
+        stats['max_entries'] = self.max_entries
+        return stats
+
+    def clear(self):
+        """Очистка кэша в памяти"""
+        with self._lock:
+            self._entries.clear()
+
+    def _lookup(self, url):
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None:
+                self._entries.move_to_end(url)
+            return entry
+
+    def _store(self, entry):
+        with self._lock:
+            self._entries[entry.url] = entry
+            self._entries.move_to_end(entry.url)
+            unpinned = [key for key, value in self._entries.items() if not value.pinned]
+            while len(unpinned) > self.max_entries:
+                del self._entries[unpinned.pop(0)]
+                self._counters['evictions'] += 1
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def _is_fresh(self, entry):
+        if entry.pinned:
+            return True
+        return time.time() - entry.checked_at < self.ttl
+
+    def _revalidate(self, entry):
+        """Условная перепроверка устаревшей записи"""
+        with self._single_flight(entry.url):
+            # Другой процесс мог перепроверить ресурс, пока ждали блокировку
+            shared = self._load_shared(entry.url)
+            if shared is not None and self._is_fresh(shared):
+                if shared.digest == entry.digest:
+                    entry.checked_at = shared.checked_at
+                    entry.etag, entry.last_modified = shared.etag, shared.last_modified
+                    self._count('shared_hits')
+                    return entry
+                self._count('refreshed')
+                return shared
+
+            try:
+                content, etag, last_modified = self.fetch(
+                    entry.url, entry.etag, entry.last_modified
+                )
+            except Exception:
+                # Сервер MOEX недоступен - работаем со старой версией стиля
+                entry.checked_at = time.time()
+                self._count('stale_served')
+                return entry
+
+            if content is None:
+                entry.checked_at = time.time()
+                self._save_meta(entry)
+                self._count('revalidated')
+                return entry
+
+            new_entry = CacheEntry(entry.url, content, etag, last_modified)
+            self._save(new_entry)
+            self._count('refreshed')
+            return new_entry
+
+    def _single_flight(self, url):
+        """Межпроцессная блокировка загрузки ресурса (только с общим хранилищем)"""
+        if self.store is None:
+            return nullcontext()
+        return self.store.lock(url)
+
+    def _load(self, url):
+        """Исходные байты из общего хранилища или с диска"""
+        if self.store is not None:
+            entry = self._load_shared(url)
+            name = 'shared_hits'
+        else:
+            entry = self._load_from_disk(url)
+            name = 'disk_hits'
+        if entry is not None:
+            self._count(name)
+        return entry
+
+    def _save(self, entry):
+        if self.store is not None:
+            self.store.put_resource(entry.url, entry.content, entry.etag,
+                                    entry.last_modified, entry.checked_at)
+        else:
+            self._save_to_disk(entry)
+
+    # Общее хранилище
+
+    def _load_shared(self, url):
+        if self.store is None:
+            return None
+
+        row = self.store.get_resource(url)
+        if row is None:
+            return None
+
+        content, etag, last_modified, checked_at = row
+        return CacheEntry(url, content, etag=etag, last_modified=last_modified,
+                          checked_at=checked_at)
+
+    # Дисковое хранилище
+
+    def _disk_path(self, url):
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()[:32]
+        return os.path.join(self.cache_dir, key)
+
+    def _load_from_disk(self, url):
+        if not self.cache_dir:
+            return None
+
+        path = self._disk_path(url)
+        try:
+            with open(path + '.json', 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            with open(path + '.bin', 'rb') as f:
+                content = f.read()
+        except (OSError, ValueError):
+            return None
+
+        if meta.get('url') != url:
+            return None
+
+        return CacheEntry(url, content,
+                          etag=meta.get('etag'),
+                          last_modified=meta.get('last_modified'),
+                          checked_at=meta.get('checked_at', 0))
+
+    def _save_to_disk(self, entry):
+        if not self.cache_dir:
+            return
+
+        path = self._disk_path(entry.url)
+        try:
+            _atomic_write(path + '.bin', entry.content)
+            self._save_meta(entry)
+        except OSError:
+            pass
+
+    def _save_meta(self, entry):
+        if self.store is not None:
+            self.store.touch_resource(entry.url, entry.checked_at)
+            return
+        if not self.cache_dir:
+            return
+
+        meta = {
+            'url': entry.url,
+            'etag': entry.etag,
+            'last_modified': entry.last_modified,
+            'checked_at': entry.checked_at,
+        }
+        try:
+            _atomic_write(self._disk_path(entry.url) + '.json',
+                          json.dumps(meta).encode('utf-8'))
+        except OSError:
+            pass
+
+
+class ResultCache:
+    """
+    Кэш результатов конвертации с адресацией по содержимому.
+
+    Ключ - хэш входного XML, в записи хранится URL и версия XSLT, которым
+    получен результат; при поиске версия сверяется с текущей, так что смена
+    стиля на сервере MOEX делает запись недействительной. Значение - temp_id
+    уже сохранённого HTML артефакта в TemporaryFileManager.
+
+    Сами артефакты по-прежнему удаляются очисткой по времени жизни: при
+    попадании артефакт "освежается" (mtime), а если он уже удалён - запись
+    просто отбрасывается. Вытеснение ограничивает суммарный размер
+    артефактов, на которые ссылается кэш.
+
+    С общим хранилищем store (SharedCacheStore) записи видны всем воркерам
+    хоста, а single_flight() не даёт двум процессам одновременно
+    конвертировать один и тот же документ.
+    """
+
+    def __init__(self, temp_manager, max_bytes=256 * 1024 * 1024, max_entries=1000,
+                 store=None):
+        self.temp_manager = temp_manager
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.store = store
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'misses': 0, 'stale': 0, 'expired': 0, 'evictions': 0,
+                          'coalesced': 0}
+
+    def get(self, xml_hash, stylesheet_version, count=True):
+        """
+        Поиск готового результата; возвращает (temp_id, xslt_used) или None.
+
+        stylesheet_version(url) - текущая версия XSLT по URL. С count=False
+        промах не учитывается, а попадание считается объединённым запросом
+        (повторная проверка внутри single_flight).
+        """
+        entry = self._get_entry(xml_hash)
+
+        if entry is None:
+            if count:
+                self._count('misses')
+            return None
+
+        temp_id, xslt_used, xslt_version, _ = entry
+        try:
+            current_version = stylesheet_version(xslt_used)
+        except Exception:
+            current_version = None
+
+        if current_version != xslt_version:
+            self._discard(xml_hash, 'stale')
+            if count:
+                self._count('misses')
+            return None
+
+        if not self.temp_manager.touch(temp_id):
+            # Артефакт уже удалён очисткой - запись больше не нужна
+            self._discard(xml_hash, 'expired')
+            if count:
+                self._count('misses')
+            return None
+
+        self._count('hits' if count else 'coalesced')
+        return temp_id, xslt_used
+
+    def put(self, xml_hash, temp_id, xslt_used, xslt_version, size):
+        """Сохранение ссылки на результат"""
+        if self.store is not None:
+            evicted = self.store.put_result(xml_hash, temp_id, xslt_used, xslt_version, size,
+                                            self.max_entries, self.max_bytes)
+            with self._lock:
+                self._counters['evictions'] += evicted
+            return
+
+        with self._lock:
+            old = self._entries.pop(xml_hash, None)
+            if old is not None:
+                self._total_bytes -= old[3]
+            self._entries[xml_hash] = (temp_id, xslt_used, xslt_version, size)
+            self._total_bytes += size
+
+            while self._entries and (len(self._entries) > self.max_entries
+                                     or self._total_bytes > self.max_bytes):
+                _, evicted = self._entries.popitem(last=False)
+                self._total_bytes -= evicted[3]
+                self._counters['evictions'] += 1
+
+    def single_flight(self, xml_hash):
+        """
+        Блокировка конвертации документа между процессами.
+
+        Внутри блокировки стоит повторить get(..., count=False): результат
+        мог сохранить процесс, державший блокировку до нас.
+        """
+        if self.store is None:
+            return nullcontext()
+        return self.store.lock(f"result:{xml_hash}")
+
+    def stats(self):
+        """Счётчики попаданий/промахов кэша"""
+        with self._lock:
+            stats = dict(self._counters)
+            stats['size'] = len(self._entries)
+            stats['bytes'] = self._total_bytes
+        if self.store is not None:
+            stats['size'], stats['bytes'] = self.store.result_totals()
+        stats['max_entries'] = self.max_entries
+        stats['max_bytes'] = self.max_bytes
+        return stats
+
+    def _get_entry(self, xml_hash):
+        if self.store is not None:
+            return self.store.get_result(xml_hash)
+
+        with self._lock:
+            entry = self._entries.get(xml_hash)
+            if entry is not None:
+                self._entries.move_to_end(xml_hash)
+            return entry
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def _discard(self, xml_hash, reason):
+        if self.store is not None:
+            if self.store.discard_result(xml_hash):
+                self._count(reason)
+            return
+
+        with self._lock:
+            entry = self._entries.pop(xml_hash, None)
+            if entry is not None:
+                self._total_bytes -= entry[3]
+                self._counters[reason] += 1
+
+
+class SharedCacheStore:
+    """
+    Общее для всех процессов хоста хранилище кэшей в локальной SQLite (WAL).
+
+    Воркеры gunicorn и процессы пула заданий держат скомпилированные стили
+    каждый у себя, а исходные байты XSLT/XSD и ссылки на готовые результаты
+    конвертаций берут отсюда. Одновременную загрузку или конвертацию одного
+    ключа разными процессами исключает lock() - flock на одном из
+    LOCK_STRIPES файлов блокировок.
+
+    Счётчики кэшей каждого процесса публикуются в таблицу workers
+    (publish), поэтому статистику всех воркеров видно из любого из них.
+    """
+
+    LOCK_STRIPES = 256
+
+    def __init__(self, db_path, publish_interval=10):
+        self.db_path = db_path
+        self.lock_dir = db_path + '.locks'
+        self.publish_interval = publish_interval
+        self._local = threading.local()
+        self._published = 0.0
+
+        os.makedirs(self.lock_dir, exist_ok=True)
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS resources (
+                url TEXT PRIMARY KEY,
+                content BLOB NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                checked_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS results (
+                xml_hash TEXT PRIMARY KEY,
+                temp_id TEXT NOT NULL,
+                xslt_used TEXT,
+                xslt_version TEXT,
+                size INTEGER NOT NULL,
+                accessed REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed);
+            CREATE TABLE IF NOT EXISTS workers (
+                pid INTEGER NOT NULL,
+                cache TEXT NOT NULL,
+                stats TEXT NOT NULL,
+                updated REAL NOT NULL,
+                PRIMARY KEY (pid, cache)
+            );
+        """)
+
+    def _conn(self):
+        """Соединение текущего потока (после fork открывается заново)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def close(self):
+        """Закрытие соединения текущего потока (в мастере gunicorn перед fork)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            conn.close()
+        self._local.conn = None
+
+    def lock(self, key):
+        """Межпроцессная блокировка по ключу"""
+        stripe = int(hashlib.sha256(key.encode('utf-8')).hexdigest()[:8], 16) % self.LOCK_STRIPES
+        return file_lock(os.path.join(self.lock_dir, f"{stripe:03d}.lock"))
+
+    # Ресурсы MOEX (XSLT/XSD)
+
+    def get_resource(self, url):
+        """(content, etag, last_modified, checked_at) или None"""
+        return self._conn().execute(
+            "SELECT content, etag, last_modified, checked_at FROM resources WHERE url = ?",
+            (url,)
+        ).fetchone()
+
+    def put_resource(self, url, content, etag, last_modified, checked_at):
+        self._conn().execute(
+            "INSERT OR REPLACE INTO resources (url, content, etag, last_modified, checked_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (url, content, etag, last_modified, checked_at)
+        )
+
+    def touch_resource(self, url, checked_at):
+        """Отметка успешной перепроверки (304 Not Modified)"""
+        self._conn().execute("UPDATE resources SET checked_at = ? WHERE url = ?",
+                             (checked_at, url))
+
+    # Результаты конвертаций
+
+    def get_result(self, xml_hash):
+        """(temp_id, xslt_used, xslt_version, size) или None"""
+        conn = self._conn()
+        row = conn.execute(
+            "SELECT temp_id, xslt_used, xslt_version, size FROM results WHERE xml_hash = ?",
+            (xml_hash,)
+        ).fetchone()
+        if row is not None:
+            conn.execute("UPDATE results SET accessed = ? WHERE xml_hash = ?",
+                         (time.time(), xml_hash))
+        return row
+
+    def put_result(self, xml_hash, temp_id, xslt_used, xslt_version, size,
+                   max_entries, max_bytes):
+        """Сохранение ссылки на результат; возвращает число вытесненных записей"""
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "INSERT OR REPLACE INTO results "
+                "(xml_hash, temp_id, xslt_used, xslt_version, size, accessed) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (xml_hash, temp_id, xslt_used, xslt_version, size, time.time())
+            )
+            # Вытесняем давно не запрошенные записи сверх лимитов числа и объёма
+            return conn.execute("""
+                DELETE FROM results WHERE xml_hash IN (
+                    SELECT xml_hash FROM (
+                        SELECT xml_hash,
+                               ROW_NUMBER() OVER (ORDER BY accessed DESC) AS position,
+                               SUM(size) OVER (ORDER BY accessed DESC) AS total
+                        FROM results
+                    ) WHERE position > ? OR total > ?
+                )
+            """, (max_entries, max_bytes)).rowcount
+
+    def discard_result(self, xml_hash):
+        return self._conn().execute("DELETE FROM results WHERE xml_hash = ?",
+                                    (xml_hash,)).rowcount > 0
+
+    def result_totals(self):
+        """(число записей, суммарный размер артефактов)"""
+        count, total = self._conn().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results").fetchone()
+        return count, total
+
+    # Статистика воркеров
+
+    def publish(self, caches):
+        """Публикация счётчиков кэшей текущего процесса; caches - {имя: объект с stats()}"""
+        now = time.time()
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(
+                "INSERT OR REPLACE INTO workers (pid, cache, stats, updated) VALUES (?, ?, ?, ?)",
+                [(os.getpid(), name, json.dumps(cache.stats()), now)
+                 for name, cache in caches.items()]
+            )
+        self._published = now
+
+    def maybe_publish(self, caches):
+        """Публикация не чаще publish_interval секунд"""
+        if time.time() - self._published >= self.publish_interval:
+            self.publish(caches)
+
+    def worker_stats(self):
+        """{pid: {кэш: счётчики с hit_rate}} по всем процессам хоста"""
+        workers = {}
+        for pid, name, stats, updated in self._conn().execute(
+                "SELECT pid, cache, stats, updated FROM workers ORDER BY pid, cache"):
+            stats = json.loads(stats)
+            stats['hit_rate'] = hit_rate(stats)
+            stats['updated'] = updated
+            workers.setdefault(pid, {})[name] = stats
+        return workers
+
+    def purge(self, max_age_seconds):
+        """Удаление статистики завершившихся процессов; возвращает число записей"""
+        cutoff = time.time() - max(max_age_seconds, self.publish_interval * 10)
+        return self._conn().execute("DELETE FROM workers WHERE updated < ?",
+                                    (cutoff,)).rowcount
+
+
+def hit_rate(stats):
+    """Доля попаданий по счётчикам кэша (или None, если обращений не было)"""
+    hits = sum(stats.get(name, 0) for name in ('hits', 'disk_hits', 'shared_hits', 'coalesced'))
+    total = hits + stats.get('misses', 0)
+    return round(hits / total, 4) if total else None
+
+
+def _atomic_write(path, data):
+    """Атомарная запись файла через временный файл"""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
@@ -2,17 +2,108 @@
 import re
 import io
 from lxml import etree
-import requests
-from urllib.parse import urljoin
+from urllib.parse import urljoin, urlsplit
 from .utils import extract_encoding_from_xml, fix_encoding_issues
+from .cache import StylesheetCache, SharedCacheStore
+from .fetcher import ResourceFetcher, FetchError
+from .metrics import StageTimings
+
+# XSLT по умолчанию для документов без xml-stylesheet
+DEFAULT_XSLT = "CCX99_RU_23062025.xsl"
+
+# Пространство имён атрибутов xsi:schemaLocation / xsi:noNamespaceSchemaLocation
+XSI_NAMESPACE = "http://www.w3.org/2001/XMLSchema-instance"
+
+# Сколько байт с начала документа смотрим при определении кодировки
+XML_PROLOG_SIZE = 1024
+
+# Инструкция xml-stylesheet в сырых байтах (например, в теле multipart-запроса)
+XML_STYLESHEET_PATTERN = re.compile(rb'<\?xml-stylesheet\b(.*?)\?>', re.S)
+
+def detect_xslt_encoding(content):
+    """Определение кодировки XSLT по заголовку"""
+    encoding = 'utf-8'
+    header = content[:200].decode('ascii', errors='ignore')
+    match = re.search(r'encoding=[\'"]([^\'"]+)[\'"]', header)
+    if match:
+        encoding = match.group(1).lower()
+    return encoding
+
+def _resolving_parser(resolver=None, **options):
+    """Парсер, через который разбираются и xsl:include/xs:include документа"""
+    parser = etree.XMLParser(**options)
+    if resolver is not None:
+        parser.resolvers.add(resolver)
+    return parser
+
+def compile_xslt(content, base_url=None, resolver=None):
+    """Компиляция XSLT из исходных байтов (resolver - для xsl:include вне файловой системы)"""
+    encoding = detect_xslt_encoding(content)
+    try:
+        xslt_doc = etree.parse(
+            io.BytesIO(content),
+            parser=_resolving_parser(resolver, encoding=encoding),
+            base_url=base_url
+        )
+    except Exception:
+        xslt_doc = etree.parse(io.BytesIO(content), parser=_resolving_parser(resolver),
+                               base_url=base_url)
+    
+    return etree.XSLT(xslt_doc)
+
+def create_xml_parser(encoding=None):
+    """Парсер XML отчётов (годится и для инкрементального разбора через feed)"""
+    return etree.XMLParser(encoding=encoding, huge_tree=True)
+
+def compile_schema(content, base_url=None, resolver=None):
+    """Компиляция XSD схемы из исходных байтов (resolver - для xs:include/xs:import)"""
+    xsd_doc = etree.parse(io.BytesIO(content), parser=_resolving_parser(resolver),
+                          base_url=base_url)
+    return etree.XMLSchema(xsd_doc)
 
 class MOEXConverter:
     """Конвертер XML MOEX в HTML"""
     
-    def __init__(self, xslt_base_url, xsd_base_url=None, timeout=30):
+    def __init__(self, xslt_base_url, xsd_base_url=None, timeout=30,
+                 cache_size=32, cache_ttl=3600, cache_dir=None, offline=False,
+                 connect_timeout=5, retries=3, backoff=0.5, pool_size=10, fetch_workers=4,
+                 shared_cache_path=None):
         self.xslt_base_url = xslt_base_url
         self.xsd_base_url = xsd_base_url
         self.timeout = timeout
+        # Все загрузки XSLT/XSD идут через общий пул соединений с повторами
+        self.fetcher = ResourceFetcher(
+            timeout=timeout,
+            connect_timeout=connect_timeout,
+            retries=retries,
+            backoff=backoff,
+            pool_size=pool_size,
+            workers=fetch_workers
+        )
+        # В автономном режиме ресурсы берутся только из локального набора и кэша
+        self.offline = offline
+        # Исходники стилей - в общем для всех процессов хоста хранилище (если задано)
+        self.shared_store = SharedCacheStore(shared_cache_path) if shared_cache_path else None
+        self.xslt_cache = StylesheetCache(
+            fetch=self.fetch_resource,
+            compile=compile_xslt,
+            max_entries=cache_size,
+            ttl=cache_ttl,
+            cache_dir=cache_dir,
+            store=self.shared_store
+        )
+        self.xsd_cache = StylesheetCache(
+            fetch=self.fetch_resource,
+            compile=compile_schema,
+            max_entries=cache_size,
+            ttl=cache_ttl,
+            cache_dir=cache_dir,
+            store=self.shared_store
+        )
+    
+    def default_xslt_url(self):
+        """URL XSLT по умолчанию"""
+        return urljoin(self.xslt_base_url, DEFAULT_XSLT)
         
     def extract_xslt_urls(self, xml_doc):
         """Извлечение URL XSLT из XML документа"""
@@ -20,104 +111,260 @@ class MOEXConverter:
         
         for node in xml_doc.xpath('//processing-instruction()'):
             if node.target == 'xml-stylesheet':
-                pi_text = str(node)
-                match = re.search(r'href=[\'"]([^\'"]+)[\'"]', pi_text)
-                if match:
-                    href = match.group(1)
-                    
-                    # Преобразование локальных путей в URL
-                    if href.startswith('C:\\MICEX\\XSLT\\'):
-                        filename = href.split('\\')[-1]
-                        href = urljoin(self.xslt_base_url, filename)
-                    elif href.startswith('C:\\MICEX\\XSD\\') and self.xsd_base_url:
-                        filename = href.split('\\')[-1]
-                        href = urljoin(self.xsd_base_url, filename)
-                    
+                href = self._stylesheet_href(node)
+                if href:
                     xslt_urls.append(href)
         
         return xslt_urls
     
-    def load_xslt(self, xslt_url):
-        """Загрузка XSLT файла"""
+    def peek_xslt_urls(self, source):
+        """
+        URL XSLT из пролога документа без разбора всего файла.
+        
+        Читает только инструкции обработки до корневого элемента,
+        source - путь к файлу или файловый объект.
+        """
+        xslt_urls = []
+        
         try:
-            response = requests.get(xslt_url, timeout=self.timeout)
-            response.raise_for_status()
-            content = response.content
-            
-            # Определение кодировки XSLT
-            encoding = 'utf-8'
-            header = content[:200].decode('ascii', errors='ignore')
-            match = re.search(r'encoding=[\'"]([^\'"]+)[\'"]', header)
-            if match:
-                encoding = match.group(1).lower()
-            
-            return content, encoding
-            
-        except requests.exceptions.RequestException as e:
-            raise Exception(f"Ошибка загрузки XSLT: {e}")
+            for event, node in etree.iterparse(source, events=('start', 'pi')):
+                if event == 'start':
+                    break
+                if node.target == 'xml-stylesheet':
+                    href = self._stylesheet_href(node)
+                    if href:
+                        xslt_urls.append(href)
+        except etree.XMLSyntaxError:
+            pass
+        
+        return xslt_urls
     
-    def decode_xml(self, xml_bytes):
-        """Декодирование XML с правильной кодировкой"""
-        encoding = extract_encoding_from_xml(xml_bytes)
+    def scan_xslt_urls(self, data):
+        """
+        URL XSLT из инструкций xml-stylesheet в сырых байтах без разбора XML.
         
-        # Пробуем декодировать с найденной кодировкой
-        for enc in [encoding, 'windows-1251', 'cp1251', 'utf-8']:
-            try:
-                return xml_bytes.decode(enc), enc
-            except UnicodeDecodeError:
-                continue
+        Годится для начала тела запроса с загружаемым файлом (multipart):
+        по нему режим ASGI заранее загружает нужные стили.
+        """
+        xslt_urls = []
+        for match in XML_STYLESHEET_PATTERN.finditer(data):
+            href = self._stylesheet_href(match.group(1).decode('latin-1'))
+            if href:
+                xslt_urls.append(href)
+        return xslt_urls
+    
+    def _stylesheet_href(self, node):
+        """URL из инструкции xml-stylesheet (с заменой локальных путей MOEX)"""
+        pi_text = str(node)
+        match = re.search(r'href=[\'"]([^\'"]+)[\'"]', pi_text)
+        if not match:
+            return None
         
-        # Если ничего не сработало, используем игнорирование ошибок
-        return xml_bytes.decode('utf-8', errors='ignore'), 'utf-8'
+        return self._map_local_path(match.group(1))
     
-    def convert(self, xml_bytes, xslt_url=None):
-        """Основной метод конвертации"""
-        # Шаг 1: Декодируем XML
-        xml_text, xml_encoding = self.decode_xml(xml_bytes)
+    def _map_local_path(self, href):
+        """Преобразование локальных путей MOEX (C:\\MICEX\\...) в URL"""
+        if href.startswith('C:\\MICEX\\XSLT\\'):
+            filename = href.split('\\')[-1]
+            href = urljoin(self.xslt_base_url, filename)
+        elif href.startswith('C:\\MICEX\\XSD\\') and self.xsd_base_url:
+            filename = href.split('\\')[-1]
+            href = urljoin(self.xsd_base_url, filename)
         
-        # Шаг 2: Парсим XML
-        parser = etree.XMLParser(encoding=xml_encoding)
-        xml_file_like = io.BytesIO(xml_bytes)
+        return href
+    
+    def _schema_location(self, root):
+        """URL XSD из атрибутов xsi:* корневого элемента (или None)"""
+        href = root.get(f'{{{XSI_NAMESPACE}}}noNamespaceSchemaLocation')
+        if not href:
+            # schemaLocation - пары "пространство имён URL"; берём первую схему
+            locations = (root.get(f'{{{XSI_NAMESPACE}}}schemaLocation') or '').split()
+            href = locations[1] if len(locations) > 1 else None
+        if not href:
+            return None
         
+        if href.startswith('C:\\MICEX\\'):
+            href = self._map_local_path(href)
+            # Без MOEX_XSD_BASE локальный путь не во что преобразовать
+            return href if not href.startswith('C:\\') else None
+        
+        # Относительный путь - от каталога схем MOEX
+        if self.xsd_base_url and not urlsplit(href).scheme:
+            href = urljoin(self.xsd_base_url, href.replace('\\', '/'))
+        return href
+    
+    def extract_xsd_url(self, xml_doc):
+        """URL XSD, указанной в документе (xsi:noNamespaceSchemaLocation / xsi:schemaLocation)"""
+        return self._schema_location(xml_doc.getroot())
+    
+    def peek_xsd_url(self, source):
+        """URL XSD по корневому элементу, без разбора всего файла"""
         try:
-            xml_doc = etree.parse(xml_file_like, parser=parser)
-        except Exception as e:
-            # Альтернативный способ парсинга
-            xml_doc = etree.fromstring(xml_text.encode('utf-8'))
+            for _, node in etree.iterparse(source, events=('start',), huge_tree=True):
+                return self._schema_location(node)
+        except etree.XMLSyntaxError:
+            pass
+        return None
+    
+    def fetch_resource(self, url, etag=None, last_modified=None):
+        """
+        Загрузка ресурса (XSLT/XSD) с сервера MOEX.
         
-        # Шаг 3: Получаем URL XSLT
+        Возвращает (content, etag, last_modified); content is None,
+        если сервер ответил 304 Not Modified на условный запрос.
+        """
+        if self.offline:
+            raise Exception(f"Ресурс отсутствует в локальном наборе стилей: {url}")
+        
+        try:
+            return self.fetcher.fetch(url, etag, last_modified)
+        except FetchError as e:
+            raise Exception(f"Ошибка загрузки XSLT: {e}")
+    
+    def load_xslt(self, xslt_url):
+        """Загрузка XSLT файла"""
+        content, _, _ = self.fetch_resource(xslt_url)
+        return content, detect_xslt_encoding(content)
+    
+    async def prefetch_xslt(self, xslt_url):
+        """
+        Асинхронная загрузка XSLT в кэш без компиляции (режим ASGI).
+        
+        Скомпилирует стиль get_transform в потоке обработчика, уже без
+        обращения к сети. Ошибки загрузки не возбуждаются - их сообщит
+        обычная загрузка при конвертации. Возвращает True, если стиль в кэше.
+        """
+        validators = self.xslt_cache.validators(xslt_url)
+        if validators is None:
+            return True
+        if self.offline:
+            return False
+        
+        try:
+            content, etag, last_modified = await self.fetcher.fetch_async(xslt_url, *validators)
+        except Exception:
+            return False
+        self.xslt_cache.update(xslt_url, content, etag, last_modified)
+        return True
+    
+    def get_transform(self, xslt_url):
+        """Получение скомпилированного XSLT из кэша"""
+        return self.xslt_cache.get(xslt_url)
+    
+    def prefetch_transforms(self, xslt_urls):
+        """
+        Параллельная загрузка стилей-кандидатов.
+        
+        Кандидаты, которых ещё нет в кэше, загружаются и компилируются
+        одновременно, так что недоступный стиль не задерживает остальные
+        на полный таймаут. Возвращает {url: Future}; для одного кандидата
+        или когда всё уже в кэше параллелить нечего.
+        """
+        missing = [url for url in dict.fromkeys(xslt_urls) if not self.xslt_cache.contains(url)]
+        if len(missing) < 2:
+            return {}
+        return {url: self.fetcher.submit(self.get_transform, url) for url in missing}
+    
+    def stylesheet_version(self, xslt_url):
+        """Версия XSLT (по содержимому) из кэша стилей"""
+        return self.xslt_cache.get_entry(xslt_url).version
+    
+    def parse_xml(self, source):
+        """
+        Разбор XML за один проход.
+        
+        source - байты документа или путь к файлу (файл читает сам lxml,
+        целиком в память он не загружается). Кодировка определяется только
+        по заголовку документа (BOM/prolog), весь документ в строку не
+        декодируется. Повторный разбор выполняется лишь если документ
+        не разобрался с кодировкой из заголовка.
+        """
+        if isinstance(source, bytes):
+            head = source[:XML_PROLOG_SIZE]
+        else:
+            with open(source, 'rb') as f:
+                head = f.read(XML_PROLOG_SIZE)
+        encoding = extract_encoding_from_xml(head)
+        
+        first_error = None
+        for enc in dict.fromkeys([encoding, 'windows-1251', 'utf-8']):
+            try:
+                stream = io.BytesIO(source) if isinstance(source, bytes) else source
+                return etree.parse(stream, parser=create_xml_parser(enc))
+            except (etree.XMLSyntaxError, OSError) as e:
+                # При чтении из файла ошибки кодировки lxml выдаёт как OSError.
+                # Сообщаем ошибку разбора с кодировкой из заголовка - она понятнее
+                if first_error is None:
+                    first_error = e
+        
+        raise first_error
+    
+    def resolve_xslt_urls(self, xml_doc, xslt_url=None):
+        """Список URL XSLT-кандидатов в порядке приоритета"""
         xslt_urls = self.extract_xslt_urls(xml_doc)
         
         if not xslt_urls and not xslt_url:
             # Используем стандартный XSLT
-            default_xslt = "CCX99_RU_23062025.xsl"
-            xslt_url = urljoin(self.xslt_base_url, default_xslt)
-            xslt_urls = [xslt_url]
+            xslt_urls = [self.default_xslt_url()]
         elif xslt_url:
             xslt_urls.insert(0, xslt_url)
         
-        # Шаг 4: Загружаем и применяем XSLT
+        return xslt_urls
+    
+    def extract_metadata(self, xml_doc):
+        """Метаданные отчёта из уже разобранного документа"""
+        root = xml_doc.getroot()
+        return {
+            'root': etree.QName(root).localname,
+            'encoding': xml_doc.docinfo.encoding,
+            'attributes': dict(root.attrib),
+            'xslt_urls': self.extract_xslt_urls(xml_doc)
+        }
+    
+    def convert(self, xml_bytes=None, xslt_url=None, xml_doc=None, timings=None):
+        """
+        Основной метод конвертации.
+        
+        Можно передать уже разобранный документ (xml_doc), чтобы одно и то же
+        дерево использовалось для преобразования, валидации и метаданных.
+        В timings (StageTimings) записываются длительности этапов.
+        """
+        if timings is None:
+            timings = StageTimings()
+        
+        # Шаг 1: Парсим XML (один раз)
+        if xml_doc is None:
+            with timings.stage('parse'):
+                xml_doc = self.parse_xml(xml_bytes)
+        
+        # Шаг 2: Получаем URL XSLT
+        xslt_urls = self.resolve_xslt_urls(xml_doc, xslt_url)
+        
+        # Шаг 3: Загружаем и применяем XSLT.
+        # Кандидаты загружаются параллельно, но применяются в порядке приоритета:
+        # побеждает первый по списку стиль, который загрузился и сработал
+        pending = self.prefetch_transforms(xslt_urls)
         last_error = None
         for url in xslt_urls:
             try:
-                xslt_content, xslt_encoding = self.load_xslt(url)
-                
-                # Парсим XSLT
-                try:
-                    xslt_doc = etree.parse(
-                        io.BytesIO(xslt_content),
-                        parser=etree.XMLParser(encoding=xslt_encoding)
-                    )
-                except Exception:
-                    xslt_doc = etree.parse(io.BytesIO(xslt_content))
+                # Берём скомпилированный XSLT из кэша (или ждём параллельную загрузку)
+                with timings.stage('fetch_xslt'):
+                    future = pending.pop(url, None)
+                    transform = future.result() if future else self.get_transform(url)
                 
                 # Применяем преобразование
-                transform = etree.XSLT(xslt_doc)
-                result = transform(xml_doc)
-                html_output = str(result)
+                with timings.stage('transform'):
+                    result = transform(xml_doc)
+                with timings.stage('serialize'):
+                    html_output = str(result)
                 
                 # Исправляем проблемы с кодировкой
-                html_output = fix_encoding_issues(html_output)
+                with timings.stage('fix_encoding'):
+                    html_output = fix_encoding_issues(html_output)
+                
+                # Ещё не начатые загрузки менее приоритетных стилей не нужны
+                for future in pending.values():
+                    future.cancel()
                 
                 return html_output, url
                 
@@ -131,29 +378,70 @@ class MOEXConverter:
         else:
             raise Exception("Не найден подходящий XSLT для преобразования")
     
-    def validate_xml(self, xml_bytes, xsd_url=None):
-        """Валидация XML по XSD схеме (опционально)"""
+    def validate_xml(self, xml_bytes=None, xsd_url=None, xml_doc=None):
+        """
+        Валидация XML по XSD схеме.
+        
+        Схема берётся из xsd_url или из самого документа
+        (xsi:noNamespaceSchemaLocation / xsi:schemaLocation с заменой
+        C:\\MICEX\\XSD\\); без схемы проверяется только синтаксис.
+        Скомпилированные схемы кэшируются (xsd_cache).
+        """
         try:
-            xml_text, _ = self.decode_xml(xml_bytes)
-            xml_doc = etree.fromstring(xml_text.encode('utf-8'))
+            if xml_doc is None:
+                xml_doc = self.parse_xml(xml_bytes)
             
+            xsd_url = xsd_url or self.extract_xsd_url(xml_doc)
             if xsd_url:
-                # Загружаем XSD схему
-                response = requests.get(xsd_url, timeout=self.timeout)
-                xsd_content = response.content
-                
-                # Создаем XML схему
-                xsd_doc = etree.XML(xsd_content)
-                schema = etree.XMLSchema(xsd_doc)
+                # Берём скомпилированную XSD схему из кэша
+                schema = self.xsd_cache.get(xsd_url)
                 
                 # Валидируем
                 schema.assertValid(xml_doc)
+                return True, "XML валиден"
             
-            return True, "XML валиден"
+            return True, "XML синтаксически корректен (схема в документе не указана)"
             
         except etree.XMLSyntaxError as e:
             return False, f"Ошибка синтаксиса XML: {e}"
         except etree.DocumentInvalid as e:
             return False, f"XML не соответствует схеме: {e}"
         except Exception as e:
-            return False, f"Ошибка валидации: {e}"
\ No newline at end of file
+            return False, f"Ошибка валидации: {e}"
+    
+    def validate_stream(self, source, xsd_url=None):
+        """
+        Потоковая валидация большого файла.
+        
+        Документ не строится целиком: iterparse проверяет его по схеме
+        по мере чтения, обработанные элементы сразу освобождаются, так что
+        память не зависит от размера файла. source - путь к файлу.
+        """
+        schema = None
+        try:
+            xsd_url = xsd_url or self.peek_xsd_url(source)
+            if xsd_url:
+                schema = self.xsd_cache.get(xsd_url)
+            
+            for _, element in etree.iterparse(source, events=('end',), schema=schema,
+                                              huge_tree=True):
+                element.clear(keep_tail=True)
+                # Уже проверенные соседние элементы больше не нужны
+                parent = element.getparent()
+                if parent is not None:
+                    while element.getprevious() is not None:
+                        del parent[0]
+            
+            if schema is None:
+                return True, "XML синтаксически корректен (схема в документе не указана)"
+            return True, "XML валиден"
+            
+        except etree.XMLSyntaxError as e:
+            # При потоковой проверке ошибки схемы тоже приходят как XMLSyntaxError;
+            # отличаем их по коду ошибки из журнала валидатора
+            if any(error.domain == etree.ErrorDomains.SCHEMASV and error.type == e.code
+                   for error in e.error_log):
+                return False, f"XML не соответствует схеме: {e}"
+            return False, f"Ошибка синтаксиса XML: {e}"
+        except Exception as e:
+            return False, f"Ошибка валидации: {e}"
@@ -0,0 +1,476 @@
+# modules/diff.py
+"""
+Сравнение двух отчётов MOEX (/api/diff).
+
+Записи отчётов (элементы с атрибутами без дочерних элементов - строки
+сделок, позиций и т.п., как в экспорте) сопоставляются по ключевым
+атрибутам: номеру сделки, коду инструмента раздела и т.п. Для каждой
+записи считаются два хэша - ключа и содержимого, - так что сравнение
+линейно по числу записей, а в памяти держится только словарь хэшей
+старого отчёта, но не деревья документов.
+
+Отчёты читаются парсером lxml без построения дерева, в три прохода:
+старый (хэши), новый (добавленные и изменённые записи), снова старый
+(удалённые и прежние значения изменённых). Найденные записи пишутся в
+сокращённые документы с той же структурой и xml-stylesheet, что у
+исходных, и преобразуются тем же XSLT, что и сами отчёты.
+"""
+import os
+import re
+import html
+from lxml import etree
+from .utils import extract_encoding_from_xml
+from .converter import XML_PROLOG_SIZE, XSI_NAMESPACE
+from .metrics import StageTimings
+
+# Ключевые атрибуты по умолчанию: по ним (у записи и у объемлющих разделов)
+# записи двух отчётов считаются одной и той же записью
+DEFAULT_KEY_ATTRIBUTES = ('TradeNo', 'OrderNo', 'DealNo', 'TradeId', 'OrderId',
+                          'SecCode', 'Account', 'ClientCode')
+
+# Сколько изменённых записей описывается в сводке по атрибутам
+MAX_CHANGE_DETAILS = 100
+
+# Разделы страницы сравнения: (вид, заголовок)
+SECTIONS = (
+    ('added', 'Добавленные записи'),
+    ('removed', 'Удалённые записи'),
+    ('changed_old', 'Изменённые записи: прежние значения'),
+    ('changed_new', 'Изменённые записи: новые значения'),
+)
+
+class DiffError(Exception):
+    """Отчёты нельзя сравнить"""
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+class _Section:
+    """Открытый элемент-раздел документа (не запись)"""
+
+    __slots__ = ('parent', 'tag', 'attrib', 'path', 'key', 'identity')
+
+    def __init__(self, parent, tag, attrib, key_attributes):
+        self.parent = parent
+        self.tag = tag
+        self.attrib = attrib
+        if parent is None:
+            # Атрибуты корня (дата, номер документа) в ключ не входят
+            self.path = ''
+            self.key = hash(tag)
+            self.identity = {}
+        else:
+            self.path = f"{parent.path}/{_local_name(tag)}" if parent.path else _local_name(tag)
+            own = {name: attrib[name] for name in key_attributes if name in attrib}
+            self.key = hash((parent.key, tag, tuple(own.values())))
+            self.identity = {**parent.identity, **own} if own else parent.identity
+
+class _Scanner:
+    """
+    Цель парсера lxml: документ разбирается событиями, дерево не строится.
+
+    Элемент, внутри которого встретился другой элемент, - раздел; элемент
+    без дочерних элементов - запись (если есть атрибуты) или поле шапки.
+    Для записи вызывается on_record(section, tag, attrib, text, key, digest),
+    где key - хэш раздела и ключевых атрибутов, digest - хэш содержимого.
+    Повторы ключа нумерует первый проход (duplicates: ключ -> число
+    записей), остальные получают ключи повторов по тем же номерам.
+    Поля шапки передаются в on_field(section, tag, attrib, text).
+    """
+
+    def __init__(self, key_attributes, on_record, on_field=None, duplicates=None):
+        self.key_attributes = key_attributes
+        # Число записей для ключей, встречающихся в старом отчёте больше одного раза
+        self.duplicates = duplicates
+        self._seen = {}
+        self.on_record = on_record
+        self.on_field = on_field
+        self.root = None
+        self.records = 0
+        self._stack = []
+        self._pending = None
+        self._text = []
+
+    def start(self, tag, attrib):
+        if self._pending is not None:
+            parent = self._stack[-1] if self._stack else None
+            section = _Section(parent, *self._pending, self.key_attributes)
+            self._stack.append(section)
+            if parent is None:
+                self.root = section
+        self._pending = (tag, attrib)
+        self._text = []
+
+    def data(self, data):
+        if self._pending is not None:
+            self._text.append(data)
+
+    def end(self, tag):
+        if self._pending is None:
+            self._stack.pop()
+            return
+        tag, attrib = self._pending
+        self._pending = None
+        if not self._stack:
+            # Документ из одного корня - сравнивать нечего
+            return
+        section = self._stack[-1]
+        text = ''.join(self._text).strip()
+        if not attrib:
+            if self.on_field is not None:
+                self.on_field(section, tag, attrib, text)
+            return
+
+        own = tuple(attrib[name] for name in self.key_attributes if name in attrib)
+        digest = hash((tuple(attrib.items()), text))
+        # Запись без ключевых атрибутов узнаётся только по содержимому
+        key = hash((section.key, tag, own if own else digest))
+        if self.duplicates and key in self.duplicates:
+            # n-й повтор ключа (как его пронумеровал проход по старому отчёту)
+            number = self._seen.get(key, 0)
+            self._seen[key] = number + 1
+            if number:
+                key = hash((key, number))
+        self.records += 1
+        self.on_record(section, tag, attrib, text, key, digest)
+
+    def close(self):
+        return self
+
+def _scan(path, scanner, label):
+    """Проход по документу; кодировка - из заголовка, как при конвертации"""
+    with open(path, 'rb') as f:
+        encoding = extract_encoding_from_xml(f.read(XML_PROLOG_SIZE))
+    parser = etree.XMLParser(target=scanner, encoding=encoding, huge_tree=True)
+    try:
+        etree.parse(path, parser)
+    except (etree.XMLSyntaxError, OSError) as e:
+        raise DiffError(f"Ошибка разбора {label} отчёта: {e}")
+    if scanner.root is None:
+        raise DiffError(f"В {label} отчёте нет записей для сравнения")
+    return scanner
+
+# Символы, которые нужно экранировать в значениях атрибутов и в тексте
+ATTRIBUTE_SPECIAL_CHARS = re.compile(r'[&<>"\n\r\t]')
+TEXT_SPECIAL_CHARS = re.compile(r'[&<>\r]')
+
+def _escape_attribute(value):
+    return (value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+            .replace('"', '&quot;').replace('\n', '&#10;').replace('\r', '&#13;')
+            .replace('\t', '&#9;'))
+
+def _escape_text(value):
+    if not TEXT_SPECIAL_CHARS.search(value):
+        return value
+    return (value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+            .replace('\r', '&#13;'))
+
+class _Extract:
+    """
+    Сокращённый документ: часть записей отчёта в его же структуре.
+
+    Корень, разделы (с атрибутами) и инструкции xml-stylesheet те же, что
+    в исходном отчёте, поэтому документ преобразуется тем же XSLT.
+    Пишется потоково, разделы открываются по мере надобности. Элементы
+    сериализуются строками: создавать для каждой записи элемент lxml
+    втрое дольше, теги записей собираются по шаблону для набора
+    атрибутов. Имена из пространств имён ({uri}name) получают префикс,
+    объявленный на том же элементе.
+    """
+
+    def __init__(self, path, pis):
+        self.path = path
+        self.records = 0
+        self._pis = pis
+        # Файл создаётся при первой записи: пустой документ не нужен
+        self._file = None
+        # [(раздел, закрывающий тег)] открытых разделов от корня
+        self._open = []
+        self._names = {}
+        self._templates = {}
+        self._prefixes = {XSI_NAMESPACE: 'xsi'}
+
+    def _start(self):
+        self._file = open(self.path, 'w', encoding='utf-8')
+        self._file.write('<?xml version="1.0" encoding="utf-8"?>\n')
+        for target, data in self._pis:
+            self._file.write(f"<?{target} {data}?>\n" if data else f"<?{target}?>\n")
+
+    def _name(self, name):
+        """(имя в документе, объявление пространства имён) для имени lxml"""
+        result = self._names.get(name)
+        if result is None:
+            if name[0] == '{':
+                uri, local = name[1:].split('}', 1)
+                prefix = self._prefixes.setdefault(uri, f"ns{len(self._prefixes)}")
+                result = (f"{prefix}:{local}", f' xmlns:{prefix}="{_escape_attribute(uri)}"')
+            else:
+                result = (name, '')
+            self._names[name] = result
+        return result
+
+    def _start_tag(self, tag, attrib):
+        """Открывающий тег без закрывающей скобки и имя для закрывающего тега"""
+        names = tuple(attrib.keys())
+        template = self._templates.get((tag, names))
+        if template is None:
+            # Шаблон тега по именам атрибутов: '<REC TradeNo="%s" Price="%s"'
+            name, declarations = self._name(tag)
+            parts = []
+            for key in names:
+                key, declaration = self._name(key)
+                if declaration and declaration not in declarations:
+                    declarations += declaration
+                parts.append(f' {key}="%s"')
+            template = self._templates[(tag, names)] = (
+                f"<{name}{declarations}".replace('%', '%%') + ''.join(parts), name)
+        values = tuple(attrib.values())
+        if ATTRIBUTE_SPECIAL_CHARS.search(''.join(values)):
+            values = tuple(_escape_attribute(value) for value in values)
+        return template[0] % values, template[1]
+
+    def _enter(self, section):
+        if self._open and self._open[-1][0] is section:
+            return
+        chain = []
+        while section is not None:
+            chain.append(section)
+            section = section.parent
+        chain.reverse()
+
+        common = 0
+        while (common < len(self._open) and common < len(chain)
+               and self._open[common][0] is chain[common]):
+            common += 1
+        while len(self._open) > common:
+            self._file.write(self._open.pop()[1])
+        for section in chain[common:]:
+            start, name = self._start_tag(section.tag, section.attrib)
+            self._file.write(start + '>\n')
+            self._open.append((section, f"</{name}>\n"))
+
+    def write(self, section, tag, attrib, text, record=True):
+        if self._file is None:
+            self._start()
+        self._enter(section)
+        start, name = self._start_tag(tag, attrib)
+        if text:
+            self._file.write(f"{start}>{_escape_text(text)}</{name}>\n")
+        else:
+            self._file.write(start + '/>\n')
+        if record:
+            self.records += 1
+
+    def close(self):
+        if self._file is None:
+            return
+        while self._open:
+            self._file.write(self._open.pop()[1])
+        self._file.close()
+
+def _split_body(content):
+    """(начало документа до содержимого body, содержимое body)"""
+    start = content.find('<body')
+    start = content.find('>', start) + 1 if start >= 0 else 0
+    end = content.rfind('</body>')
+    if end < start:
+        end = len(content)
+    return content[:start], content[start:end]
+
+def _header_table(header):
+    rows = ''.join(f"<tr><td>{html.escape(name)}</td><td>{html.escape(old or '')}</td>"
+                   f"<td>{html.escape(new or '')}</td></tr>"
+                   for name, (old, new) in header.items())
+    return (f'<table class="moex-diff-header"><tr><th>Атрибут</th><th>Было</th>'
+            f'<th>Стало</th></tr>{rows}</table>\n')
+
+def _render(converter, extracts, summary, timings):
+    """Страница сравнения: разделы, преобразованные XSLT отчётов, в одном HTML"""
+    head = None
+    parts = []
+    counts = summary['records']
+    parts.append(
+        f'<p class="moex-diff-summary">Добавлено: {counts["added"]}, '
+        f'удалено: {counts["removed"]}, изменено: {counts["changed"]}, '
+        f'без изменений: {counts["unchanged"]}</p>\n')
+    if summary['header']:
+        parts.append(_header_table(summary['header']))
+
+    for kind, title in SECTIONS:
+        extract = extracts[kind]
+        if not extract.records:
+            continue
+        with timings.stage('parse'):
+            xml_doc = converter.parse_xml(extract.path)
+        content, xslt_used = converter.convert(xml_doc=xml_doc, timings=timings)
+        del xml_doc
+        summary['xslt_used'].setdefault(kind, xslt_used)
+        prefix, body = _split_body(content)
+        del content
+        if head is None:
+            head = prefix
+        parts.append(f'<h2 class="moex-diff-section moex-diff-{kind}">'
+                     f'{title}: {extract.records}</h2>\n')
+        parts.append(body)
+
+    if head is None:
+        head = ('<!DOCTYPE html>\n<html><head><meta charset="utf-8">'
+                '<title>Сравнение отчётов</title></head><body>\n')
+        parts.append('<p class="moex-diff-empty">Записи отчётов совпадают</p>\n')
+    return head + ''.join(parts) + '</body></html>\n'
+
+def diff_reports(converter, old_path, new_path, work_dir, key_attributes=None, timings=None):
+    """
+    Сравнение двух отчётов (путей к XML).
+
+    Возвращает (HTML страницы сравнения, сводка). В сводке - число
+    добавленных, удалённых, изменённых и неизменных записей, то же по
+    таблицам (пути записей в документе), различия атрибутов корня и
+    изменения атрибутов первых MAX_CHANGE_DETAILS изменённых записей.
+    Промежуточные документы пишутся в work_dir.
+    """
+    if timings is None:
+        timings = StageTimings()
+    key_attributes = tuple(key_attributes or DEFAULT_KEY_ATTRIBUTES)
+    tables = {}
+
+    def count(section, tag, kind):
+        path = f"{section.path}/{_local_name(tag)}" if section.path else _local_name(tag)
+        table = tables.get(path)
+        if table is None:
+            table = tables[path] = {'added': 0, 'removed': 0, 'changed': 0}
+        table[kind] += 1
+        return path
+
+    # Проход 1: хэши записей старого отчёта
+    index = {}
+    duplicates = {}
+
+    def remember(section, tag, attrib, text, key, digest):
+        if key in index:
+            number = duplicates.get(key, 1)
+            duplicates[key] = number + 1
+            key = hash((key, number))
+        index[key] = digest
+
+    with timings.stage('diff_index'):
+        old_scan = _scan(old_path, _Scanner(key_attributes, remember), 'старого')
+
+    # Проход 2: новый отчёт - добавленные и изменённые записи
+    extracts = {}
+    changed = set()
+    details = {}
+    unchanged = 0
+
+    def classify(section, tag, attrib, text, key, digest):
+        nonlocal unchanged
+        previous = index.pop(key, None)
+        if previous is None:
+            extracts['added'].write(section, tag, attrib, text)
+            count(section, tag, 'added')
+        elif previous != digest:
+            extracts['changed_new'].write(section, tag, attrib, text)
+            path = count(section, tag, 'changed')
+            changed.add(key)
+            if len(details) < MAX_CHANGE_DETAILS:
+                details[key] = (path, section.identity, dict(attrib), text)
+        else:
+            unchanged += 1
+
+    def copy_new_field(section, tag, attrib, text):
+        extracts['added'].write(section, tag, attrib, text, record=False)
+        extracts['changed_new'].write(section, tag, attrib, text, record=False)
+
+    new_pis = _peek_pis(new_path)
+    extracts['added'] = _Extract(os.path.join(work_dir, 'added.xml'), new_pis)
+    extracts['changed_new'] = _Extract(os.path.join(work_dir, 'changed_new.xml'), new_pis)
+    try:
+        with timings.stage('diff_compare'):
+            scanner = _Scanner(key_attributes, classify, copy_new_field, duplicates)
+            new_scan = _scan(new_path, scanner, 'нового')
+    finally:
+        extracts['added'].close()
+        extracts['changed_new'].close()
+
+    if new_scan.root.tag != old_scan.root.tag:
+        raise DiffError(f"Отчёты разных видов: {_local_name(old_scan.root.tag)} "
+                        f"и {_local_name(new_scan.root.tag)}")
+
+    # Проход 3: старый отчёт - удалённые записи и прежние значения изменённых
+    changes = []
+
+    def collect(section, tag, attrib, text, key, digest):
+        if key in index:
+            extracts['removed'].write(section, tag, attrib, text)
+            count(section, tag, 'removed')
+        elif key in changed:
+            extracts['changed_old'].write(section, tag, attrib, text)
+            detail = details.get(key)
+            if detail is not None:
+                changes.append((key, _describe_change(detail, attrib, text, key_attributes)))
+
+    def copy_old_field(section, tag, attrib, text):
+        extracts['removed'].write(section, tag, attrib, text, record=False)
+        extracts['changed_old'].write(section, tag, attrib, text, record=False)
+
+    old_pis = _peek_pis(old_path)
+    extracts['removed'] = _Extract(os.path.join(work_dir, 'removed.xml'), old_pis)
+    extracts['changed_old'] = _Extract(os.path.join(work_dir, 'changed_old.xml'), old_pis)
+    try:
+        # Без удалённых и изменённых записей третий проход не нужен
+        if index or changed:
+            with timings.stage('diff_collect'):
+                scanner = _Scanner(key_attributes, collect, copy_old_field, duplicates)
+                _scan(old_path, scanner, 'старого')
+    finally:
+        extracts['removed'].close()
+        extracts['changed_old'].close()
+
+    old_header = old_scan.root.attrib
+    new_header = new_scan.root.attrib
+    # Порядок изменений - как в новом отчёте
+    order = {key: position for position, key in enumerate(details)}
+    changes.sort(key=lambda item: order[item[0]])
+
+    summary = {
+        'records': {
+            'old': old_scan.records,
+            'new': new_scan.records,
+            'added': extracts['added'].records,
+            'removed': extracts['removed'].records,
+            'changed': extracts['changed_new'].records,
+            'unchanged': unchanged,
+        },
+        'tables': tables,
+        'header': {name: [old_header.get(name), new_header.get(name)]
+                   for name in dict.fromkeys([*old_header, *new_header])
+                   if old_header.get(name) != new_header.get(name)},
+        'changes': [change for _, change in changes],
+        'key_attributes': list(key_attributes),
+        'xslt_used': {},
+    }
+    return _render(converter, extracts, summary, timings), summary
+
+def _describe_change(detail, old_attrib, old_text, key_attributes):
+    """Изменение записи: путь, ключ и различающиеся атрибуты {имя: [было, стало]}"""
+    path, identity, new_attrib, new_text = detail
+    key = dict(identity)
+    key.update((name, new_attrib[name]) for name in key_attributes if name in new_attrib)
+    fields = {name: [old_attrib.get(name), new_attrib.get(name)]
+              for name in dict.fromkeys([*old_attrib, *new_attrib])
+              if old_attrib.get(name) != new_attrib.get(name)}
+    if old_text != new_text:
+        fields['#text'] = [old_text, new_text]
+    return {'table': path, 'key': key, 'fields': fields}
+
+def _peek_pis(path):
+    """Инструкции обработки перед корнем документа (xml-stylesheet)"""
+    pis = []
+    try:
+        for event, node in etree.iterparse(path, events=('start', 'pi')):
+            if event == 'start':
+                break
+            pis.append((node.target, node.text))
+    except etree.XMLSyntaxError:
+        pass
+    return pis
@@ -0,0 +1,349 @@
+# modules/export.py
+import os
+import io
+import re
+import csv
+import json
+import shutil
+import zipfile
+from functools import lru_cache
+from lxml import etree
+
+EXPORT_FORMATS = ('csv', 'jsonl', 'parquet')
+
+# Размер блока (в байтах) при чтении промежуточного CSV для Parquet и при копировании
+PARQUET_BLOCK_SIZE = 8 * 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+
+class ExportError(Exception):
+    """Некорректный запрос экспорта"""
+
+@lru_cache(maxsize=None)
+def _pyarrow():
+    """
+    Модуль pyarrow (с pyarrow.csv и pyarrow.parquet) или None.
+
+    Импорт pyarrow заметно удлиняет старт процесса, поэтому выполняется
+    при первом экспорте в Parquet, а не при загрузке модуля.
+    """
+    try:
+        import pyarrow
+        import pyarrow.csv
+        import pyarrow.parquet
+    except ImportError:  # экспорт в Parquet необязателен
+        return None
+    return pyarrow
+
+def parquet_available():
+    return _pyarrow() is not None
+
+# Значения с такими символами нужно заключать в кавычки (как csv.QUOTE_MINIMAL)
+CSV_SPECIAL_CHARS = re.compile(r'[",\r\n]')
+
+# Значения с такими символами требуют экранирования в JSON
+JSON_SPECIAL_CHARS = re.compile(r'["\\\x00-\x1f]')
+
+def _csv_line(values):
+    """Строка CSV (с \\r\\n в конце); обычно значения не требуют кавычек"""
+    line = ','.join(values)
+    if len(values) > 1 and not CSV_SPECIAL_CHARS.search(line):
+        return line + '\r\n'
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(values)
+    return buffer.getvalue()
+
+class _Table:
+    """
+    Таблица записей одного вида (одного пути в документе).
+
+    Строки сразу пишутся в файл на диске, так что память не зависит от
+    числа записей. Для CSV и Parquet это промежуточный CSV без заголовка:
+    новые столбцы добавляются в конец, поэтому ранее записанные строки -
+    префикс полной строки и при выводе дополняются. JSON Lines пишется
+    сразу в окончательном виде.
+    """
+
+    def __init__(self, name, spool_path, fmt='csv'):
+        self.name = name
+        self.spool_path = spool_path
+        self.columns = []
+        self.rows = 0
+        self._index = {}
+        # Раскладка столбцов по набору имён (обычно он у всех записей одинаков);
+        # None - значения идут подряд с первого столбца
+        self._layouts = {}
+        # Наименьшая ширина записанной строки: меньше числа столбцов - нужно дополнение
+        self._min_width = None
+        self._file = open(spool_path, 'w', encoding='utf-8', newline='')
+        self._context = None
+        self._prefix = ''
+        if fmt == 'jsonl':
+            self._encode = json.JSONEncoder(ensure_ascii=False).encode
+            self.add = self._add_json
+
+    def _layout(self, names):
+        """Номера столбцов для имён (новые имена добавляются в конец)"""
+        layout = []
+        for name in names:
+            index = self._index.get(name)
+            if index is None:
+                index = self._index[name] = len(self.columns)
+                self.columns.append(name)
+            layout.append(index)
+        if layout == list(range(len(layout))):
+            return None
+        return layout
+
+    def add(self, context, attrib):
+        """Запись строки; context - (имена, значения) столбцов объемлющих элементов"""
+        context_names, context_values = context
+        key = (context_names, tuple(attrib.keys()))
+        layout = self._layouts.get(key, False)
+        if layout is False:
+            layout = self._layouts[key] = self._layout(context_names + key[1])
+
+        if layout is None:
+            # Обычный случай: контекст и атрибуты записи идут подряд. Контекст
+            # одинаков у всех записей раздела - кодируем его в CSV один раз
+            if context is not self._context:
+                self._context = context
+                self._prefix = _csv_line(context_values)[:-2] + ',' if context_values else ''
+            values = attrib.values()
+            self._file.write(self._prefix + _csv_line(values))
+            width = len(context_values) + len(values)
+        else:
+            row = [''] * (max(layout) + 1)
+            for index, value in zip(layout, context_values + attrib.values()):
+                row[index] = value
+            self._file.write(_csv_line(row))
+            width = len(row)
+
+        if self._min_width is None or width < self._min_width:
+            self._min_width = width
+        self.rows += 1
+
+    def _add_json(self, context, attrib):
+        context_names, context_values = context
+        names = tuple(attrib.keys())
+        key = (context_names, names)
+        template = self._layouts.get(key)
+        if template is None:
+            self._layout(context_names + names)
+            # Шаблон строки по именам атрибутов: '"TradeNo": "%s", ...}'
+            template = self._layouts[key] = ', '.join(
+                self._encode(name).replace('%', '%%') + ': "%s"' for name in names) + '}\n'
+        if context is not self._context:
+            self._context = context
+            self._prefix = self._encode(dict(zip(context_names, context_values)))[:-1] + ', ' \
+                if context_values else '{'
+
+        values = attrib.values()
+        if JSON_SPECIAL_CHARS.search(''.join(values)):
+            line = self._prefix + self._encode(dict(zip(names, values)))[1:] + '\n'
+        else:
+            line = self._prefix + template % tuple(values)
+        # Отсутствующих у записи атрибутов в строке нет
+        self._file.write(line)
+        self.rows += 1
+
+    def close(self):
+        self._file.close()
+
+    @property
+    def padded(self):
+        """Все строки промежуточного файла уже полной ширины"""
+        return self._min_width is None or self._min_width == len(self.columns)
+
+    def read_rows(self):
+        """Строки таблицы, дополненные до полного набора столбцов"""
+        width = len(self.columns)
+        with open(self.spool_path, 'r', encoding='utf-8', newline='') as f:
+            for row in csv.reader(f):
+                if len(row) < width:
+                    row.extend([''] * (width - len(row)))
+                yield row
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1] if isinstance(tag, str) else None
+
+def _context(parent):
+    """Путь записей под parent (без корня) и столбцы контекста из атрибутов предков"""
+    ancestors = []
+    while parent is not None:
+        ancestors.append(parent)
+        parent = parent.getparent()
+    ancestors.reverse()
+
+    tags = [_local_name(node.tag) for node in ancestors]
+    names = []
+    values = []
+    for tag, node in zip(tags, ancestors):
+        for name, value in node.attrib.items():
+            names.append(f"{tag}.{name}")
+            values.append(value)
+    return '/'.join(tags[1:]), (tuple(names), values)
+
+def collect_tables(source, work_dir, table=None, fmt='csv'):
+    """
+    Разбор отчёта в таблицы записей без XSLT.
+
+    Записью считается элемент с атрибутами и без дочерних элементов
+    (строки сделок, позиций и т.п.). Таблица - все записи одного пути
+    (например, TRADES/SECURITY/REC). Атрибуты объемлющих элементов
+    (раздела, инструмента, шапки отчёта) добавляются к каждой строке
+    столбцами "<элемент>.<атрибут>".
+
+    Документ читается потоково (iterparse), обработанные элементы сразу
+    освобождаются. table - имя или путь таблицы, чтобы выгрузить только её.
+    Возвращает список _Table в порядке появления.
+    """
+    tables = {}
+    parent = None
+    records = None
+    context = None
+
+    try:
+        for _, element in etree.iterparse(source, events=('end',), huge_tree=True,
+                                          remove_comments=True, remove_pis=True):
+            if len(element):
+                # Раздел закончился - от его записей остался только последний элемент
+                element.clear(keep_tail=True)
+            else:
+                current = element.getparent()
+                if current is None:
+                    break
+                # Контекст и таблица меняются только при переходе к другому родителю
+                if current is not parent:
+                    parent = current
+                    path, context = _context(parent)
+                    path = f"{path}/{_local_name(element.tag)}" if path else _local_name(element.tag)
+                    records = None
+                    if table is None or table == path or path.endswith('/' + table):
+                        records = tables.get(path)
+                        if records is None:
+                            spool_path = os.path.join(work_dir, f"table_{len(tables):03d}.tmp")
+                            records = tables[path] = _Table(path, spool_path, fmt)
+                if records is not None and len(element.attrib):
+                    records.add(context, element.attrib)
+                element.clear(keep_tail=True)
+
+            # Обработанные соседние элементы больше не нужны
+            previous = element.getprevious()
+            if previous is not None:
+                owner = element.getparent()
+                while element.getprevious() is not None:
+                    del owner[0]
+    except etree.XMLSyntaxError as e:
+        raise ExportError(f"Ошибка синтаксиса XML: {e}")
+    finally:
+        for records in tables.values():
+            records.close()
+
+    return list(tables.values())
+
+def _write_csv(records, path):
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        csv.writer(f).writerow(records.columns)
+        if records.padded:
+            # Строки уже полной ширины - копируем промежуточный файл как есть
+            with open(records.spool_path, 'r', encoding='utf-8', newline='') as spool:
+                shutil.copyfileobj(spool, f, CHUNK_SIZE)
+        else:
+            csv.writer(f).writerows(records.read_rows())
+    os.remove(records.spool_path)
+
+def _write_jsonl(records, path):
+    # Строки записаны сразу в окончательном виде; отсутствующих атрибутов в них нет
+    os.replace(records.spool_path, path)
+
+def _write_parquet(records, path):
+    # Значения - строки как в XML; таблица читается из spool-файла блоками
+    pyarrow = _pyarrow()
+    convert_options = pyarrow.csv.ConvertOptions(
+        column_types={name: pyarrow.string() for name in records.columns},
+        strings_can_be_null=False
+    )
+    read_options = pyarrow.csv.ReadOptions(column_names=records.columns,
+                                           block_size=PARQUET_BLOCK_SIZE)
+    schema = pyarrow.schema([(name, pyarrow.string()) for name in records.columns])
+
+    padded = records.spool_path
+    if not records.padded:
+        padded = path + '.csv'
+        with open(padded, 'w', encoding='utf-8', newline='') as f:
+            csv.writer(f).writerows(records.read_rows())
+        os.remove(records.spool_path)
+    try:
+        reader = pyarrow.csv.open_csv(padded, read_options=read_options,
+                                      convert_options=convert_options)
+        writer = pyarrow.parquet.ParquetWriter(path, schema)
+        try:
+            for batch in reader:
+                writer.write_batch(batch)
+        finally:
+            writer.close()
+    finally:
+        os.remove(padded)
+
+WRITERS = {'csv': _write_csv, 'jsonl': _write_jsonl, 'parquet': _write_parquet}
+
+MIMETYPES = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+def _file_names(tables, fmt):
+    """Имена файлов таблиц в архиве (по пути в документе)"""
+    used = set()
+    names = []
+    for records in tables:
+        base = records.name.replace('/', '_') or 'records'
+        candidate = f"{base}.{fmt}"
+        index = 1
+        while candidate in used:
+            candidate = f"{base}_{index}.{fmt}"
+            index += 1
+        used.add(candidate)
+        names.append(candidate)
+    return names
+
+def export_report(source, work_dir, fmt='csv', table=None):
+    """
+    Экспорт таблиц записей отчёта в CSV, JSON Lines или Parquet.
+
+    source - путь к XML. Одна таблица выгружается одним файлом, несколько -
+    zip-архивом с файлом на таблицу. Возвращает (путь, mimetype, имя файла,
+    сводка {таблица: {'rows', 'columns'}}).
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ExportError(f"Неподдерживаемый формат экспорта: {fmt}. "
+                          f"Допустимые: {', '.join(EXPORT_FORMATS)}")
+    if fmt == 'parquet' and not parquet_available():
+        raise ExportError("Экспорт в Parquet недоступен: не установлен пакет pyarrow")
+
+    tables = collect_tables(source, work_dir, table, fmt)
+    if not tables:
+        if table:
+            raise ExportError(f"Таблица {table} в отчёте не найдена")
+        raise ExportError("В отчёте нет записей для экспорта")
+
+    summary = {records.name: {'rows': records.rows, 'columns': records.columns}
+               for records in tables}
+    names = _file_names(tables, fmt)
+    write = WRITERS[fmt]
+
+    if len(tables) == 1:
+        path = os.path.join(work_dir, names[0])
+        write(tables[0], path)
+        return path, MIMETYPES[fmt], names[0], summary
+
+    zip_path = os.path.join(work_dir, 'export.zip')
+    with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for records, name in zip(tables, names):
+            path = os.path.join(work_dir, name)
+            write(records, path)
+            archive.write(path, name)
+            os.remove(path)
+        archive.writestr('tables.json', json.dumps(summary, ensure_ascii=False, indent=2))
+    return zip_path, 'application/zip', 'export.zip', summary
@@ -0,0 +1,247 @@
+# modules/fetcher.py
+import os
+import threading
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+
+# Статусы, при которых запрос повторяется
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+class FetchError(Exception):
+    """Ошибка загрузки ресурса (сеть, статус ответа)"""
+
+@lru_cache(maxsize=None)
+def _httpx():
+    """Модуль httpx или None; импортируется при первой асинхронной загрузке"""
+    try:
+        import httpx
+    except ImportError:
+        return None
+    return httpx
+
+class ResourceFetcher:
+    """
+    Общий слой загрузки ресурсов MOEX (XSLT/XSD).
+
+    Все запросы идут через один requests.Session: соединения с сервером
+    переиспользуются (keep-alive), неудачные запросы повторяются ограниченное
+    число раз с экспоненциальной задержкой. Здесь же живёт небольшой пул
+    потоков для параллельной загрузки стилей-кандидатов.
+
+    Сессия и пул потоков принадлежат процессу и после fork создаются заново:
+    сокеты и потоки родителя в воркере использовать нельзя. Создаются они
+    при первом обращении, поэтому requests/urllib3 импортируются только
+    тогда, когда ресурс действительно приходится загружать (при старте
+    с локальным набором стилей - никогда).
+
+    fetch_async - та же загрузка для цикла событий (режим ASGI): через
+    httpx.AsyncClient, если пакет установлен, иначе синхронный fetch
+    в пуле потоков загрузки.
+    """
+
+    def __init__(self, timeout=30, connect_timeout=5, retries=3, backoff=0.5,
+                 pool_size=10, workers=4):
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self.workers = workers
+        self._session = None
+        self._executor = None
+        self._pid = None
+        self._async_client = None
+        self._async_loop = None
+        self._lock = threading.Lock()
+        self._counters = {
+            'requests': 0,
+            'not_modified': 0,
+            'errors': 0,
+        }
+
+    def _ensure_process(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            self._session = None
+            self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                thread_name_prefix='moex-fetch')
+            self._pid = pid
+
+    def _create_session(self):
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        # Повторяются только ошибки соединения и статусы RETRY_STATUSES: повтор
+        # после таймаута чтения ждал бы ответа ещё timeout секунд, и зависший
+        # сервер держал бы запрос (retries + 1) * timeout
+        retry = Retry(
+            total=self.retries,
+            connect=self.retries,
+            read=0,
+            status=self.retries,
+            other=0,
+            backoff_factor=self.backoff,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=frozenset(['GET']),
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=self.pool_size,
+                              pool_maxsize=self.pool_size,
+                              max_retries=retry)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    @property
+    def session(self):
+        """requests.Session текущего процесса"""
+        self._ensure_process()
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    self._session = self._create_session()
+        return self._session
+
+    @property
+    def executor(self):
+        """Пул потоков текущего процесса для параллельных загрузок"""
+        self._ensure_process()
+        return self._executor
+
+    def fetch(self, url, etag=None, last_modified=None):
+        """
+        Условная загрузка ресурса.
+
+        Возвращает (content, etag, last_modified); content is None,
+        если сервер ответил 304 Not Modified. Ошибки - FetchError.
+        """
+        import requests
+
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+
+        self._count('requests')
+        try:
+            response = self.session.get(url, headers=headers,
+                                        timeout=(self.connect_timeout, self.timeout))
+            if response.status_code == 304:
+                self._count('not_modified')
+                return None, etag, last_modified
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            self._count('errors')
+            raise FetchError(str(e)) from e
+
+        return (response.content,
+                response.headers.get('ETag'),
+                response.headers.get('Last-Modified'))
+
+    async def fetch_async(self, url, etag=None, last_modified=None):
+        """
+        Условная загрузка ресурса без блокировки цикла событий.
+
+        Возвращает то же, что fetch; повторы - при ошибках соединения
+        и статусах RETRY_STATUSES, с экспоненциальной задержкой.
+        """
+        import asyncio
+
+        httpx = _httpx()
+        if httpx is None:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, self.fetch, url, etag, last_modified)
+
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+
+        client = self._get_async_client()
+        self._count('requests')
+        try:
+            for attempt in range(self.retries + 1):
+                if attempt:
+                    await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+                try:
+                    response = await client.get(url, headers=headers)
+                except (httpx.ConnectError, httpx.ConnectTimeout):
+                    # Как в синхронной сессии: таймаут чтения не повторяется
+                    if attempt == self.retries:
+                        raise
+                    continue
+                if response.status_code not in RETRY_STATUSES:
+                    break
+
+            if response.status_code == 304:
+                self._count('not_modified')
+                return None, etag, last_modified
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            self._count('errors')
+            raise FetchError(str(e)) from e
+
+        return (response.content,
+                response.headers.get('ETag'),
+                response.headers.get('Last-Modified'))
+
+    def _get_async_client(self):
+        """httpx.AsyncClient текущего цикла событий (клиент привязан к циклу)"""
+        import asyncio
+
+        httpx = _httpx()
+        loop = asyncio.get_running_loop()
+        if self._async_client is None or self._async_loop is not loop:
+            self._async_client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.timeout, connect=self.connect_timeout),
+                limits=httpx.Limits(max_connections=self.pool_size,
+                                    max_keepalive_connections=self.pool_size)
+            )
+            self._async_loop = loop
+        return self._async_client
+
+    async def aclose(self):
+        """Закрытие асинхронного клиента (при остановке цикла событий)"""
+        client, self._async_client = self._async_client, None
+        if client is not None:
+            await client.aclose()
+
+    def close(self):
+        """
+        Закрытие сессии и пула потоков текущего процесса.
+
+        Вызывается в мастере gunicorn перед запуском воркеров: соединения,
+        открытые при прогреве, не наследуются ими; воркер создаст свои.
+        """
+        with self._lock:
+            session, executor = self._session, self._executor
+            self._session = self._executor = None
+            self._pid = None
+        if session is not None:
+            session.close()
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def submit(self, fn, *args, **kwargs):
+        """Выполнение fn в пуле потоков загрузки; возвращает Future"""
+        return self.executor.submit(fn, *args, **kwargs)
+
+    def stats(self):
+        """Счётчики запросов текущего процесса"""
+        with self._lock:
+            stats = dict(self._counters)
+        stats['pool_size'] = self.pool_size
+        stats['retries'] = self.retries
+        return stats
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
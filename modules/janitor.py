@@ -0,0 +1,123 @@
+# modules/janitor.py
+import os
+import time
+import logging
+import threading
+from .utils import file_lock
+
+logger = logging.getLogger(__name__)
+
+class CleanupJanitor:
+    """
+    Фоновая очистка временных файлов.
+
+    Один поток на процесс; между воркерами gunicorn очистку выполняет тот,
+    кто успел взять файловую блокировку, остальные пропускают итерацию.
+    Очистка инкрементальная (по корзинам времени TemporaryFileManager),
+    изредка выполняется полный обход для "потерянных" файлов.
+
+    tasks - дополнительные функции task(max_age_seconds), выполняемые
+    в той же итерации (например, удаление старых записей о заданиях).
+    """
+
+    def __init__(self, temp_manager, max_age_seconds, interval=60,
+                 full_sweep_every=60, max_buckets=None, lock_path=None, tasks=None):
+        self.temp_manager = temp_manager
+        self.tasks = list(tasks or [])
+        self.max_age_seconds = max_age_seconds
+        self.interval = interval
+        self.full_sweep_every = full_sweep_every
+        self.max_buckets = max_buckets
+        self.lock_path = lock_path or os.path.join(temp_manager.temp_dir, '.janitor.lock')
+        self._pid = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._runs = 0
+        self._stats = {
+            'runs': 0,
+            'skipped': 0,
+            'files_reclaimed': 0,
+            'bytes_reclaimed': 0,
+            'last_run': None,
+            'last_duration': None,
+        }
+
+    def ensure_started(self):
+        """Запуск потока в текущем процессе (повторный вызов ничего не делает)"""
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+
+        with self._lock:
+            if self._pid == pid:
+                return
+            # После fork поток родителя в дочернем процессе не существует
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._loop,
+                                            name='moex-janitor', daemon=True)
+            self._thread.start()
+            self._pid = pid
+
+    def stop(self):
+        """Остановка потока"""
+        self._stop.set()
+
+    def run_once(self, full_sweep=False):
+        """
+        Одна итерация очистки.
+
+        Возвращает (файлов, байт) или None, если очистку сейчас выполняет
+        другой процесс.
+        """
+        with file_lock(self.lock_path, blocking=False) as acquired:
+            if not acquired:
+                with self._lock:
+                    self._stats['skipped'] += 1
+                return None
+
+            started = time.monotonic()
+            files, size = self.temp_manager.expire(self.max_age_seconds, self.max_buckets)
+
+            if full_sweep:
+                swept_files, swept_size = self.temp_manager.cleanup(self.max_age_seconds / 3600)
+                files += swept_files
+                size += swept_size
+
+            for task in self.tasks:
+                try:
+                    task(self.max_age_seconds)
+                except Exception as e:
+                    logger.error(f"Ошибка задачи очистки {task!r}: {e}")
+
+            duration = time.monotonic() - started
+
+        with self._lock:
+            self._stats['runs'] += 1
+            self._stats['files_reclaimed'] += files
+            self._stats['bytes_reclaimed'] += size
+            self._stats['last_run'] = time.time()
+            self._stats['last_duration'] = round(duration, 4)
+
+        if files:
+            logger.info(f"Очистка временных файлов: удалено {files} файлов, "
+                        f"{size} байт за {duration:.3f} с")
+
+        return files, size
+
+    def stats(self):
+        """Статистика очистки в текущем процессе"""
+        with self._lock:
+            stats = dict(self._stats)
+        stats['pid'] = os.getpid()
+        stats['interval'] = self.interval
+        return stats
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            self._runs += 1
+            full_sweep = self.full_sweep_every and self._runs % self.full_sweep_every == 0
+            try:
+                self.run_once(full_sweep=bool(full_sweep))
+            except Exception as e:
+                logger.error(f"Ошибка фоновой очистки: {e}")
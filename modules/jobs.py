@@ -0,0 +1,345 @@
+# modules/jobs.py
+import os
+import time
+import uuid
+import shutil
+import sqlite3
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from .utils import process_alive
+
+logger = logging.getLogger(__name__)
+
+# Идентификатор задания - uuid4 в hex
+JOB_ID_LENGTH = 32
+
+# Ошибка заданий, потерянных вместе с процессом пула или очередью
+LOST_JOB_ERROR = "Процесс конвертации аварийно завершился, задание не выполнено"
+
+# Состояние процесса-исполнителя (создаётся в инициализаторе пула)
+_worker = {}
+
+class QueueFullError(Exception):
+    """Очередь заданий переполнена"""
+
+def _connect(db_path):
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def _update_job(db_path, job_id, **fields):
+    fields['updated'] = time.time()
+    columns = ', '.join(f"{name} = ?" for name in fields)
+    with _connect(db_path) as conn:
+        conn.execute(f"UPDATE jobs SET {columns} WHERE id = ?",
+                     (*fields.values(), job_id))
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def _init_worker(converter_options, bundle_path, temp_dir, bucket_seconds,
+                 compression=None, compression_level=4, page_rows=0, search_db_path=None):
+    """Инициализация процесса пула: свой конвертер и свой кэш XSLT"""
+    from .converter import MOEXConverter
+    from .bundle import load_stylesheet_bundle
+    from .utils import TemporaryFileManager
+
+    converter = MOEXConverter(**converter_options)
+    load_stylesheet_bundle(converter, bundle_path)
+
+    _worker['converter'] = converter
+    _worker['temp_manager'] = TemporaryFileManager(temp_dir, bucket_seconds=bucket_seconds,
+                                                   compression=compression,
+                                                   compression_level=compression_level,
+                                                   page_rows=page_rows)
+    _worker['search_index'] = None
+    if search_db_path:
+        from .search import SearchIndex
+        _worker['search_index'] = SearchIndex(search_db_path)
+
+def _run_conversion(db_path, job_id, xml_path, original_name):
+    """Конвертация в процессе пула; результат записывается в базу заданий"""
+    converter = _worker['converter']
+    temp_manager = _worker['temp_manager']
+
+    _update_job(db_path, job_id, status='running', pid=os.getpid())
+    try:
+        xml_doc = converter.parse_xml(xml_path)
+
+        html_content, xslt_used = converter.convert(xml_doc=xml_doc)
+        temp_id, _, _ = temp_manager.create_temp_file(
+            html_content,
+            extension='.html',
+            prefix='moex_',
+            metadata={
+                'original_name': original_name,
+                'xslt_used': xslt_used
+            }
+        )
+        _index_result(temp_id, html_content, xml_doc, xslt_used, original_name)
+        _update_job(db_path, job_id, status='done', temp_id=temp_id, xslt_used=xslt_used)
+        return temp_id, xslt_used
+
+    except Exception as e:
+        _update_job(db_path, job_id, status='failed', error=str(e))
+        raise
+
+    finally:
+        _remove(xml_path)
+
+def _index_result(temp_id, html_content, xml_doc, xslt_used, original_name):
+    """Индексация результата для поиска (в процессе пула - сразу, HTML уже в памяти)"""
+    search_index = _worker['search_index']
+    if search_index is None:
+        return
+    from .search import report_type, report_date
+
+    try:
+        search_index.add(temp_id, html_content, report_type(xslt_used, xml_doc),
+                         report_date(xml_doc, xslt_used), original_name)
+    except Exception as e:
+        logger.warning(f"Не удалось проиндексировать результат {temp_id}: {e}")
+
+def _run_batch_chunk(items, out_dir):
+    """
+    Конвертация части пакета в процессе пула.
+
+    Все файлы части используют один XSLT, поэтому стиль компилируется
+    один раз на процесс. items - список (имя, путь к XML, имя HTML).
+    """
+    converter = _worker['converter']
+    results = []
+
+    for name, xml_path, output_name in items:
+        try:
+            xml_doc = converter.parse_xml(xml_path)
+            html_content, xslt_used = converter.convert(xml_doc=xml_doc)
+            del xml_doc
+
+            with open(os.path.join(out_dir, output_name), 'w', encoding='utf-8') as f:
+                f.write(html_content)
+
+            results.append({'name': name, 'status': 'ok', 'output': output_name,
+                            'xslt_used': xslt_used, 'size': len(html_content)})
+        except Exception as e:
+            results.append({'name': name, 'status': 'error', 'error': str(e)})
+
+    return results
+
+class JobQueue:
+    """
+    Очередь фоновых конвертаций.
+
+    Конвертации выполняются в ограниченном пуле процессов (XSLT нагружает CPU),
+    состояние заданий хранится в локальной SQLite, поэтому статус доступен
+    из любого воркера gunicorn. Без внешних брокеров.
+    """
+
+    def __init__(self, db_path, spool_dir, converter_options, temp_dir,
+                 bundle_path=None, bucket_seconds=300, compression=None, compression_level=4,
+                 page_rows=0, max_workers=2, max_pending=32, search_db_path=None):
+        self.db_path = db_path
+        self.spool_dir = spool_dir
+        self.converter_options = converter_options
+        self.temp_dir = temp_dir
+        self.bundle_path = bundle_path
+        self.bucket_seconds = bucket_seconds
+        self.compression = compression
+        self.compression_level = compression_level
+        self.page_rows = page_rows
+        self.search_db_path = search_db_path
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._executor = None
+        self._pid = None
+        self._pending = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(spool_dir, exist_ok=True)
+        with _connect(db_path) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    original_name TEXT,
+                    created REAL NOT NULL,
+                    updated REAL NOT NULL,
+                    temp_id TEXT,
+                    xslt_used TEXT,
+                    error TEXT,
+                    pid INTEGER
+                )
+            """)
+
+    @property
+    def executor(self):
+        """Пул процессов текущего процесса (после fork создаётся заново)"""
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_init_worker,
+                    initargs=(self.converter_options, self.bundle_path,
+                              self.temp_dir, self.bucket_seconds,
+                              self.compression, self.compression_level, self.page_rows,
+                              self.search_db_path)
+                )
+                self._pid = os.getpid()
+                self._pending = 0
+            return self._executor
+
+    def submit(self, source_path, original_name=None):
+        """
+        Постановка конвертации в очередь; возвращает идентификатор задания.
+
+        Файл source_path переходит во владение очереди: он переносится
+        в каталог заданий без копирования (или удаляется при отказе).
+        """
+        executor = self.executor
+        with self._lock:
+            if self._pending >= self.max_pending:
+                _remove(source_path)
+                raise QueueFullError("Очередь конвертаций переполнена, повторите позже")
+            self._pending += 1
+
+        job_id = uuid.uuid4().hex
+        xml_path = self._spool_path(job_id)
+        try:
+            shutil.move(source_path, xml_path)
+
+            now = time.time()
+            with _connect(self.db_path) as conn:
+                conn.execute(
+                    "INSERT INTO jobs (id, status, original_name, created, updated) "
+                    "VALUES (?, 'queued', ?, ?, ?)",
+                    (job_id, original_name, now, now)
+                )
+
+            try:
+                future = executor.submit(_run_conversion, self.db_path, job_id,
+                                         xml_path, original_name)
+            except BrokenProcessPool:
+                # Процесс пула аварийно завершился - пересоздаём пул
+                self._reset_executor(executor)
+                future = self.executor.submit(_run_conversion, self.db_path, job_id,
+                                              xml_path, original_name)
+        except Exception:
+            self._release()
+            _remove(source_path)
+            _remove(xml_path)
+            raise
+
+        future.add_done_callback(lambda f: self._on_done(job_id, f))
+        return job_id
+
+    def run_batch(self, chunks, out_dir):
+        """
+        Параллельная конвертация частей пакета в пуле процессов.
+
+        Блокирует до завершения всех частей; возвращает общий список результатов.
+        """
+        futures = [self.executor.submit(_run_batch_chunk, chunk, out_dir) for chunk in chunks]
+        results = []
+        for future in futures:
+            results.extend(future.result())
+        return results
+
+    def record_done(self, temp_id, xslt_used, original_name=None):
+        """Запись уже выполненного задания (например, при попадании в кэш результатов)"""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with _connect(self.db_path) as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, status, original_name, created, updated, temp_id, xslt_used) "
+                "VALUES (?, 'done', ?, ?, ?, ?, ?)",
+                (job_id, original_name, now, now, temp_id, xslt_used)
+            )
+        return job_id
+
+    def get(self, job_id):
+        """Состояние задания или None"""
+        if not job_id or len(job_id) != JOB_ID_LENGTH or not job_id.isalnum():
+            return None
+
+        with _connect(self.db_path) as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def stats(self):
+        """Число заданий по состояниям"""
+        with _connect(self.db_path) as conn:
+            rows = conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        stats = {status: count for status, count in rows}
+        with self._lock:
+            stats['pending_in_worker'] = self._pending
+        stats['max_pending'] = self.max_pending
+        stats['max_workers'] = self.max_workers
+        return stats
+
+    def purge(self, max_age_seconds):
+        """
+        Удаление записей о старых заданиях; возвращает число удалённых записей.
+
+        Задания, оставшиеся от упавших процессов, завершаются ошибкой:
+        running - если процесса пула pid уже нет, queued - если задание
+        ждёт дольше max_age_seconds (процесс, поставивший его, умер вместе
+        с очередью). Их входные файлы удаляются.
+        """
+        now = time.time()
+        cutoff = now - max_age_seconds
+        with _connect(self.db_path) as conn:
+            rows = conn.execute(
+                "SELECT id, status, pid FROM jobs WHERE status = 'running' "
+                "OR (status = 'queued' AND created < ?)",
+                (cutoff,)
+            ).fetchall()
+            lost = [row['id'] for row in rows
+                    if row['status'] == 'queued' or not row['pid'] or not process_alive(row['pid'])]
+            conn.executemany(
+                "UPDATE jobs SET status = 'failed', error = ?, updated = ? "
+                "WHERE id = ? AND status IN ('queued', 'running')",
+                [(LOST_JOB_ERROR, now, job_id) for job_id in lost]
+            )
+            deleted = conn.execute(
+                "DELETE FROM jobs WHERE updated < ? AND status IN ('done', 'failed')",
+                (cutoff,)
+            ).rowcount
+        for job_id in lost:
+            _remove(self._spool_path(job_id))
+        return deleted
+
+    def _reset_executor(self, broken):
+        with self._lock:
+            if self._executor is broken:
+                self._executor = None
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def _release(self):
+        with self._lock:
+            self._pending = max(0, self._pending - 1)
+
+    def _spool_path(self, job_id):
+        return os.path.join(self.spool_dir, f"{job_id}.xml")
+
+    def _on_done(self, job_id, future):
+        self._release()
+        if future.cancelled():
+            # Задание снято при пересоздании сломанного пула и не начиналось
+            error = LOST_JOB_ERROR
+        else:
+            error = future.exception()
+            if error is None:
+                return
+        # Процесс пула упал до записи результата (например, BrokenProcessPool)
+        job = self.get(job_id)
+        if job and job['status'] not in ('done', 'failed'):
+            _update_job(self.db_path, job_id, status='failed', error=str(error))
+        _remove(self._spool_path(job_id))
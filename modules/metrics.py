@@ -0,0 +1,524 @@
+# modules/metrics.py
+import os
+import json
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+from .utils import process_alive
+
+logger = logging.getLogger(__name__)
+
+# Границы гистограмм: длительности (с) и размеры (байт)
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = tuple(1024 * 4 ** power for power in range(10))  # 1 KB .. 256 MB
+# Столько разных имён XSLT получают свою метку stylesheet, остальные - 'other'
+MAX_STYLESHEET_LABELS = 50
+
+class StageTimings:
+    """
+    Длительности этапов одной конвертации.
+
+    Этапы записываются в порядке выполнения; повторный этап с тем же
+    именем (например, перебор XSLT-кандидатов) суммируется.
+    """
+
+    def __init__(self):
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def record(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    @property
+    def total(self):
+        return sum(self.stages.values())
+
+    def server_timing(self):
+        """Значение заголовка Server-Timing (длительности в миллисекундах)"""
+        return ', '.join(f"{name};dur={seconds * 1000:.1f}"
+                         for name, seconds in self.stages.items())
+
+    def as_dict(self):
+        return {name: round(seconds, 6) for name, seconds in self.stages.items()}
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join('{}="{}"'.format(
+        name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels)
+    return '{' + pairs + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+class Counter:
+    """Счётчик с метками"""
+
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def state(self):
+        """Снимок значений {метки: значение}"""
+        with self._lock:
+            return dict(self._values)
+
+    @staticmethod
+    def combine(states):
+        """Сумма снимков нескольких процессов"""
+        values = {}
+        for state in states:
+            for key, value in state.items():
+                values[key] = values.get(key, 0) + value
+        return values
+
+    def samples(self, values=None):
+        if values is None:
+            values = self.state()
+        for key, value in sorted(values.items()):
+            yield self.name, tuple(zip(self.labelnames, key)), value
+
+class Histogram:
+    """Гистограмма с метками (кумулятивные корзины, как в Prometheus)"""
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, buckets, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def state(self):
+        """Снимок значений {метки: [счётчики корзин, сумма, число]}"""
+        with self._lock:
+            return {key: [list(counts), total, count]
+                    for key, (counts, total, count) in self._values.items()}
+
+    @staticmethod
+    def combine(states):
+        """Сумма снимков нескольких процессов (снимки с другими корзинами пропускаются)"""
+        values = {}
+        for state in states:
+            for key, (counts, total, count) in state.items():
+                current = values.get(key)
+                if current is None:
+                    values[key] = [list(counts), total, count]
+                elif len(current[0]) == len(counts):
+                    current[0] = [a + b for a, b in zip(current[0], counts)]
+                    current[1] += total
+                    current[2] += count
+        return values
+
+    def samples(self, values=None):
+        if values is None:
+            values = self.state()
+        for key, (counts, total, count) in sorted(values.items()):
+            labels = tuple(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket", labels + (('le', _format_value(float(bound))),), cumulative
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, count
+
+class MetricsStore:
+    """
+    Значения метрик всех процессов хоста в локальной SQLite (WAL).
+
+    Каждый процесс публикует снимок своих счётчиков и гистограмм (publish,
+    как счётчики кэшей в SharedCacheStore), а /metrics любого воркера
+    отдаёт их сумму. Снимки завершившихся процессов при очистке (purge)
+    складываются в одну запись, поэтому сумма не уменьшается при
+    перезапуске воркеров и счётчики остаются монотонными. Значения других
+    воркеров отстают не больше чем на publish_interval секунд.
+    """
+
+    # Запись, в которую складываются снимки завершившихся процессов
+    RETIRED = 'retired'
+
+    def __init__(self, db_path, publish_interval=10):
+        self.db_path = db_path
+        self.publish_interval = publish_interval
+        self._local = threading.local()
+        self._process = None
+        self._process_pid = None
+        self._published = 0.0
+        self._timer = None
+        self._timer_lock = threading.Lock()
+
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS metrics (
+                process TEXT NOT NULL,
+                pid INTEGER NOT NULL,
+                metric TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                state TEXT NOT NULL,
+                updated REAL NOT NULL,
+                PRIMARY KEY (process, metric)
+            )
+        """)
+
+    def _conn(self):
+        """Соединение текущего потока (после fork открывается заново)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def close(self):
+        """Закрытие соединения текущего потока (в мастере gunicorn перед fork)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            conn.close()
+        self._local.conn = None
+
+    def _process_id(self):
+        """
+        Идентификатор процесса в таблице: pid может достаться новому
+        процессу, пока снимок прежнего ещё не сложен в RETIRED
+        """
+        if self._process_pid != os.getpid():
+            self._process = uuid.uuid4().hex
+            self._process_pid = os.getpid()
+            self._published = 0.0
+            # Таймер родителя после fork не существует
+            self._timer = None
+        return self._process
+
+    def publish(self, metrics):
+        """Публикация снимков метрик текущего процесса (объекты Counter/Histogram)"""
+        now = time.time()
+        process = self._process_id()
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(
+                "INSERT OR REPLACE INTO metrics (process, pid, metric, kind, state, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(process, os.getpid(), metric.name, metric.type, _dump_state(metric.state()), now)
+                 for metric in metrics]
+            )
+        self._published = now
+
+    def maybe_publish(self, metrics):
+        """
+        Публикация не чаще publish_interval секунд; если сейчас рано, она
+        откладывается (не позже чем через publish_interval), чтобы значения
+        затихшего воркера всё равно попали в общую сумму
+        """
+        self._process_id()
+        delay = self._published + self.publish_interval - time.time()
+        if delay <= 0:
+            self.publish(metrics)
+            return
+        with self._timer_lock:
+            if self._timer is None:
+                self._timer = threading.Timer(delay, self._deferred_publish, args=(metrics,))
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _deferred_publish(self, metrics):
+        with self._timer_lock:
+            self._timer = None
+        try:
+            self.publish(metrics)
+        except sqlite3.Error as e:
+            logger.warning(f"Не удалось опубликовать метрики: {e}")
+
+    def states(self):
+        """{метрика: [снимок, ...]} по всем процессам хоста (и завершившимся)"""
+        states = {}
+        for metric, state in self._conn().execute("SELECT metric, state FROM metrics"):
+            states.setdefault(metric, []).append(_load_state(state))
+        return states
+
+    def purge(self, max_age_seconds):
+        """
+        Снимки завершившихся процессов складываются в RETIRED;
+        возвращает число сложенных записей
+        """
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute("SELECT process, pid, metric, kind, state FROM metrics "
+                                "WHERE process != ?", (self.RETIRED,)).fetchall()
+            dead = [row for row in rows if not process_alive(row[1])]
+            if not dead:
+                return 0
+
+            retired = {}
+            for process, pid, metric, kind, state in dead:
+                retired.setdefault((metric, kind), []).append(_load_state(state))
+            for (metric, kind), states in retired.items():
+                row = conn.execute("SELECT state FROM metrics WHERE process = ? AND metric = ?",
+                                   (self.RETIRED, metric)).fetchone()
+                if row is not None:
+                    states.append(_load_state(row[0]))
+                combine = Histogram.combine if kind == Histogram.type else Counter.combine
+                conn.execute(
+                    "INSERT OR REPLACE INTO metrics (process, pid, metric, kind, state, updated) "
+                    "VALUES (?, 0, ?, ?, ?, ?)",
+                    (self.RETIRED, metric, kind, _dump_state(combine(states)), time.time()))
+            conn.executemany("DELETE FROM metrics WHERE process = ? AND metric = ?",
+                             [(process, metric) for process, _, metric, _, _ in dead])
+        return len(dead)
+
+def _dump_state(state):
+    return json.dumps([[list(key), value] for key, value in state.items()])
+
+def _load_state(data):
+    return {tuple(key): value for key, value in json.loads(data)}
+
+class MetricsRegistry:
+    """
+    Метрики в текстовом формате Prometheus.
+
+    Без store значения - только текущего процесса: при нескольких воркерах
+    gunicorn каждый отдавал бы свои, и очередные опросы попадали бы в
+    разные воркеры (значения скакали бы). Со store (MetricsStore) render
+    отдаёт по метрикам реестра (counter, histogram, register) сумму по
+    всем процессам хоста.
+
+    collectors - функции без аргументов, возвращающие список
+    (имя, тип, описание, [(метки, значение), ...]); их значения не
+    суммируются, поэтому коллекторы отдают gauge, уже общие для хоста
+    или помеченные процессом (например, размеры кэшей с меткой worker).
+    """
+
+    def __init__(self, store=None):
+        self.store = store
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, buckets, labelnames=()):
+        metric = Histogram(name, documentation, buckets, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def register(self, metric):
+        """Метрика с собственным источником значений (например, CacheEventCounter)"""
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector):
+        self._collectors.append(collector)
+
+    def maybe_publish(self):
+        """Публикация значений процесса в store (не чаще его publish_interval)"""
+        if self.store is not None:
+            self.store.maybe_publish(self._metrics)
+
+    def render(self):
+        states = None
+        if self.store is not None:
+            # Свои значения - свежие, остальных процессов - из последней публикации
+            self.store.publish(self._metrics)
+            states = self.store.states()
+
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            values = metric.combine(states.get(metric.name, ())) if states is not None else None
+            for name, labels, value in metric.samples(values):
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+
+        for collector in self._collectors:
+            for name, kind, documentation, samples in collector():
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(tuple(labels.items()))} "
+                                 f"{_format_value(value)}")
+
+        return '\n'.join(lines) + '\n'
+
+class ConversionMetrics(MetricsRegistry):
+    """Метрики конвертаций и HTTP запросов приложения"""
+
+    def __init__(self, store=None, xslt_base_url=None):
+        super().__init__(store)
+        self.xslt_base_url = xslt_base_url
+        self._stylesheets = set()
+        self._stylesheets_lock = threading.Lock()
+        self.stage_seconds = self.histogram(
+            'moex_conversion_stage_seconds',
+            'Длительность этапов конвертации',
+            DURATION_BUCKETS, labelnames=('stage',))
+        self.conversion_seconds = self.histogram(
+            'moex_conversion_seconds',
+            'Полная длительность конвертации',
+            DURATION_BUCKETS, labelnames=('stylesheet',))
+        self.input_bytes = self.histogram(
+            'moex_conversion_input_bytes',
+            'Размер исходного XML',
+            SIZE_BUCKETS)
+        self.output_bytes = self.histogram(
+            'moex_conversion_output_bytes',
+            'Размер результата HTML',
+            SIZE_BUCKETS)
+        self.conversions = self.counter(
+            'moex_conversions_total',
+            'Число конвертаций',
+            labelnames=('stylesheet', 'status', 'cached'))
+        self.admission_rejected = self.counter(
+            'moex_admission_rejected_total',
+            'Запросы, не допущенные контролем допуска',
+            labelnames=('endpoint', 'status'))
+        self.request_seconds = self.histogram(
+            'moex_http_request_seconds',
+            'Длительность обработки HTTP запросов',
+            DURATION_BUCKETS, labelnames=('endpoint', 'method', 'status'))
+
+    def observe_conversion(self, timings, input_size, output_size=None,
+                           stylesheet=None, cached=False, status='ok'):
+        """Учёт одной конвертации (для попадания в кэш этапов почти нет)"""
+        name = self.stylesheet_label(stylesheet)
+        for stage, seconds in timings.stages.items():
+            self.stage_seconds.observe(seconds, stage=stage)
+        self.conversion_seconds.observe(timings.total, stylesheet=name)
+        if input_size is not None:
+            self.input_bytes.observe(input_size)
+        if output_size is not None:
+            self.output_bytes.observe(output_size)
+        self.conversions.inc(stylesheet=name, status=status,
+                             cached='true' if cached else 'false')
+
+    def stylesheet_label(self, stylesheet):
+        """
+        Метка stylesheet: имя файла XSLT с сервера MOEX (xslt_base_url).
+
+        URL стиля берётся из загруженного документа, поэтому число рядов
+        ограничено: стили с других адресов и имена сверх
+        MAX_STYLESHEET_LABELS попадают в 'other'.
+        """
+        if not stylesheet:
+            return ''
+        if self.xslt_base_url and not stylesheet.startswith(self.xslt_base_url):
+            return 'other'
+        name = os.path.basename(urlsplit(stylesheet).path)
+        with self._stylesheets_lock:
+            if name not in self._stylesheets:
+                if len(self._stylesheets) >= MAX_STYLESHEET_LABELS:
+                    return 'other'
+                self._stylesheets.add(name)
+        return name
+
+# Поля stats() кэшей, которые описывают размер, а не события
+CACHE_SIZE_FIELDS = ('size', 'pinned', 'max_entries', 'bytes', 'max_bytes')
+
+class CacheEventCounter(Counter):
+    """
+    События кэшей процесса (попадания, промахи, вытеснения) как счётчик.
+
+    caches - {метка cache: объект с методом stats()}; значения - числовые
+    счётчики stats(), поэтому они публикуются в MetricsStore и суммируются
+    по процессам хоста, как и остальные счётчики реестра.
+    """
+
+    def __init__(self, name, documentation, caches):
+        super().__init__(name, documentation, labelnames=('cache', 'event'))
+        self.caches = caches
+
+    def state(self):
+        values = {}
+        for cache_name, cache in self.caches.items():
+            for event, value in cache.stats().items():
+                if event in CACHE_SIZE_FIELDS:
+                    continue
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    values[(cache_name, event)] = value
+        return values
+
+def cache_collector(name, caches, store=None):
+    """
+    Коллектор размеров кэшей для MetricsRegistry: moex_<name>_entries.
+
+    Размер кэша в памяти у каждого процесса свой, поэтому это gauge с
+    меткой worker (pid). С store (SharedCacheStore) значения берутся из
+    опубликованной воркерами статистики - любой воркер отдаёт все ряды;
+    без него - только ряды текущего процесса (caches - {метка cache:
+    объект с методом stats()}).
+    """
+    def collect():
+        entries = []
+        if store is not None:
+            for pid, worker_caches in store.worker_stats().items():
+                for cache_name, stats in worker_caches.items():
+                    if 'size' in stats:
+                        entries.append(({'worker': pid, 'cache': cache_name}, stats['size']))
+        else:
+            for cache_name, cache in caches.items():
+                stats = cache.stats()
+                if 'size' in stats:
+                    entries.append(({'worker': os.getpid(), 'cache': cache_name}, stats['size']))
+        return [(f'moex_{name}_entries', 'gauge', 'Записей в кэше по воркерам', entries)]
+    return collect
+
+def worker_cache_collector(store):
+    """
+    Коллектор доли попаданий в кэши по всем процессам хоста.
+
+    store - SharedCacheStore; значения берутся из опубликованной воркерами
+    статистики, поэтому любой воркер отдаёт картину по всем (метка worker - pid).
+    """
+    def collect():
+        samples = []
+        for pid, caches in store.worker_stats().items():
+            for cache_name, stats in caches.items():
+                if stats['hit_rate'] is not None:
+                    samples.append(({'worker': pid, 'cache': cache_name}, stats['hit_rate']))
+        return [('moex_worker_cache_hit_ratio', 'gauge',
+                 'Доля попаданий в кэш по воркерам', samples)]
+    return collect
@@ -0,0 +1,210 @@
+# modules/paging.py
+"""
+Разбиение HTML результата на страницы для просмотра по частям.
+
+Большие отчёты - это в основном длинные таблицы сделок. Тело документа
+режется по границам строк таблиц (каждые page_rows строк), части при
+этом не изменяются: их конкатенация - исходный HTML. Чтобы каждая
+страница была самостоятельным фрагментом, для неё запоминаются
+открывающие теги незакрытых на месте разреза элементов (с атрибутом
+data-page-continued и повтором шапки таблицы с data-page-repeated) и
+закрывающие теги для конца страницы. Просмотрщик по этим атрибутам
+склеивает продолжение с уже показанной таблицей.
+
+Разбор текстовый и рассчитан на результат XSLT (method="html"), где все
+элементы, кроме пустых, закрыты. Внутри таблиц просматриваются только
+границы таблиц, секций и строк, ячейки не разбираются (и комментарии там
+не учитываются). Если структура
+оказывается несогласованной, документ не разбивается.
+"""
+import re
+from itertools import islice
+
+# Шаблоны применяются к копии документа в нижнем регистре (байты UTF-8)
+BODY_PATTERN = re.compile(rb'<body\b[^>]*>')
+BODY_END = b'</body'
+
+# Вне таблиц: комментарии, script/style целиком и любые теги
+TAG_PATTERN = re.compile(rb'<!--.*?-->|<(script|style)\b.*?</\1\s*>|<(/?)([a-z][^\s/>]*)[^>]*>', re.S)
+
+# Внутри таблиц: имена тегов таблиц и секций (шаблон с буквы, а не с "<", в разы
+# быстрее на длинных таблицах; что это тег, проверяется по предшествующим символам).
+# Строки считаются отдельно
+TABLE_TAG_PATTERN = re.compile(rb't(?:able|head|body|foot)\b')
+ROW_END = b'</tr>'
+ROW_END_PATTERN = re.compile(re.escape(ROW_END))
+
+# Строка - последняя в таблице: резать после неё бессмысленно
+TABLE_END_PATTERN = re.compile(rb'\s*(?:</(?:tbody|tfoot)\s*>\s*)?</table\s*>')
+
+VOID_ELEMENTS = frozenset((
+    b'area', b'base', b'br', b'col', b'embed', b'hr', b'img', b'input', b'link', b'meta',
+    b'param', b'source', b'track', b'wbr'
+))
+
+def _mark(tag, attribute):
+    """Открывающий тег с добавленным атрибутом-меткой"""
+    return tag[:-1] + b' ' + attribute + b'>'
+
+class _Element:
+    __slots__ = ('name', 'tag', 'header')
+
+    def __init__(self, name, tag):
+        self.name = name
+        self.tag = tag
+        # Для таблиц - шапка (thead или первая строка с <th>), повторяемая на страницах
+        self.header = None
+
+def _reopen(stack):
+    """Начало страницы: незакрытые элементы открываются заново, у таблиц - шапка"""
+    parts = []
+    for element in stack:
+        parts.append(_mark(element.tag, b'data-page-continued'))
+        if element.name == b'table' and element.header:
+            header = element.header
+            if header[:6].lower() == b'<thead':
+                end = header.index(b'>') + 1
+                parts.append(_mark(header[:end], b'data-page-repeated'))
+                parts.append(header[end:])
+            else:
+                parts.append(b'<thead data-page-repeated>' + header + b'</thead>')
+    return b''.join(parts)
+
+def _close(stack):
+    return b''.join(b'</' + element.name + b'>' for element in reversed(stack))
+
+def _find_table_tag(lower, pos, end):
+    """Следующий тег таблицы или секции: (начало, конец, имя, закрывающий) или None"""
+    while True:
+        match = TABLE_TAG_PATTERN.search(lower, pos, end)
+        if match is None:
+            return None
+        start = match.start()
+        if lower[start - 1:start] == b'<':
+            closing = False
+            start -= 1
+        elif lower[start - 2:start] == b'</':
+            closing = True
+            start -= 2
+        else:
+            pos = match.end()
+            continue
+        end = lower.find(b'>', match.end())
+        if end == -1:
+            return None
+        return start, end + 1, match.group(0), closing
+
+def split_pages(html, page_rows):
+    """
+    Разбиение HTML (байты UTF-8) на страницы по page_rows строк таблиц.
+
+    Возвращает (offsets, pages) или None, если разбивать нечего:
+    offsets - границы частей [0, начало тела, разрезы..., конец тела, len(html)]
+    (части - шапка документа до <body> включительно, страницы и хвост),
+    pages - для каждой страницы пара (открывающие теги, закрывающие теги).
+    """
+    if not page_rows or page_rows <= 0:
+        return None
+
+    # Байтовые операции на порядок быстрее строковых, длина при смене регистра не меняется
+    lower = html.lower()
+
+    match = BODY_PATTERN.search(lower)
+    if match is None:
+        return None
+    body_start = match.end()
+    body_end = lower.rfind(BODY_END, body_start)
+    if body_end == -1:
+        body_end = len(html)
+
+    stack = []
+    cuts = []
+    rows = 0
+    tables = 0
+    thead_start = 0
+    pos = body_start
+
+    while True:
+        if not tables:
+            match = TAG_PATTERN.search(lower, pos, body_end)
+            if match is None:
+                break
+            pos = match.end()
+            name = match.group(3)
+            if name is None:
+                continue
+            if match.group(2):
+                if not stack or stack[-1].name != name:
+                    return None
+                stack.pop()
+            elif name not in VOID_ELEMENTS and not match.group(0).endswith(b'/>'):
+                stack.append(_Element(name, html[match.start():pos]))
+                if name == b'table':
+                    tables = 1
+            continue
+
+        tag = _find_table_tag(lower, pos, body_end)
+        if tag is None:
+            return None
+        limit, tag_end, name, closing = tag
+
+        if tables == 1 and stack[-1].name != b'thead' and limit > pos:
+            # Строки таблицы верхнего уровня до следующей границы таблицы или секции
+            table = stack[-1] if stack[-1].name == b'table' else stack[-2]
+            if table.header is None:
+                end = lower.find(ROW_END, pos, limit)
+                if end != -1:
+                    end += len(ROW_END)
+                    table.header = b''
+                    if b'<th' in lower[pos:end]:
+                        # Строка шапки не считается строкой данных
+                        table.header = html[pos:end]
+                        pos = end
+            count = lower.count(ROW_END, pos, limit)
+            ends = ROW_END_PATTERN.finditer(lower, pos, limit)
+            while rows + count >= page_rows:
+                # Строка, на которой набирается страница
+                row = next(islice(ends, page_rows - rows - 1, None))
+                count -= page_rows - rows
+                if TABLE_END_PATTERN.match(lower, row.end()):
+                    rows = page_rows
+                    break
+                cuts.append((row.end(), _reopen(stack), _close(stack)))
+                rows = 0
+            else:
+                rows += count
+
+        pos = tag_end
+        if name == b'table':
+            tables += -1 if closing else 1
+            if tables:
+                continue
+            # Таблица закончилась
+            while stack and stack[-1].name != b'table':
+                stack.pop()
+            if not stack:
+                return None
+            stack.pop()
+            if rows >= page_rows:
+                cuts.append((pos, _reopen(stack), _close(stack)))
+                rows = 0
+        elif tables == 1:
+            # Секция таблицы верхнего уровня
+            if closing:
+                if stack[-1].name != name:
+                    return None
+                stack.pop()
+                if name == b'thead':
+                    stack[-1].header = html[thead_start:pos]
+            else:
+                stack.append(_Element(name, html[limit:pos]))
+                if name == b'thead':
+                    thead_start = limit
+
+    if stack or not cuts:
+        return None
+
+    offsets = [0, body_start] + [cut[0] for cut in cuts] + [body_end, len(html)]
+    opens = [b''] + [cut[1] for cut in cuts]
+    closes = [cut[2] for cut in cuts] + [b'']
+    return offsets, list(zip(opens, closes))
@@ -1,26 +1,271 @@
 # modules/routes.py
-from flask import render_template, request, send_file, jsonify, redirect, url_for
+from flask import render_template, request, send_file, jsonify, redirect, url_for, g, Response
+from lxml import etree
 import os
+import time
+import shutil
+import functools
+import tempfile
 from datetime import datetime
 from .converter import MOEXConverter
-from .utils import allowed_file, TemporaryFileManager, generate_filename
+from .utils import (allowed_file, TemporaryFileManager, generate_filename,
+                    artifact_encoding, open_artifact)
+from .jobs import QueueFullError
+from .batch import BatchError, convert_batch
+from .export import ExportError, export_report
+from .diff import DiffError, diff_reports
+from .search import SearchError, report_type, report_date
+from .upload import parse_uploads, spool_upload
+from .metrics import StageTimings
+from .admission import AdmissionRejected
 
-def register_routes(app, converter, temp_manager):
+def register_routes(app, converter, temp_manager, result_cache=None, janitor=None,
+                    job_queue=None, metrics=None, search_index=None, admission=None):
     """Регистрация маршрутов приложения"""
     
+    def admitted(view=None, inflight=True):
+        """
+        Маршрут под контролем допуска: лимит частоты клиента и, с inflight,
+        суммарного размера обрабатываемых хостом документов.
+        
+        Проверка выполняется до чтения тела запроса, вес - Content-Length
+        (без него - лимит размера запроса). Отказ - 429/503 с Retry-After.
+        """
+        def decorator(view):
+            if admission is None:
+                return view
+            
+            @functools.wraps(view)
+            def wrapper(*args, **kwargs):
+                client = admission.client_id(
+                    request.headers.get(app.config['ADMISSION_API_KEY_HEADER']),
+                    request.remote_addr)
+                weight = request.content_length or request.max_content_length
+                try:
+                    ticket = admission.admit(client, weight, inflight=inflight)
+                except AdmissionRejected as e:
+                    return admission_rejected(e)
+                with ticket:
+                    return view(*args, **kwargs)
+            return wrapper
+        return decorator(view) if view is not None else decorator
+    
+    def admission_rejected(error):
+        """Быстрый отказ 429/503: тело запроса не читается"""
+        if metrics is not None:
+            metrics.admission_rejected.inc(endpoint=request.endpoint or 'unknown',
+                                           status=error.status)
+        if request.path.startswith('/api/'):
+            response = jsonify({'error': str(error), 'retry_after': error.retry_after})
+        else:
+            response = app.make_response(render_template('error.html', error=str(error)))
+        response.status_code = error.status
+        response.headers['Retry-After'] = str(error.retry_after)
+        # Непрочитанное тело не даёт использовать соединение повторно
+        response.headers['Connection'] = 'close'
+        return response
+    
+    def receive_xml(file, parse=False):
+        """Загруженный XML в spool-файле (с размером, sha256 и, при parse, деревом)"""
+        return spool_upload(file, app.config['UPLOAD_SPOOL_FOLDER'],
+                            max_size=request.max_content_length, parse=parse)
+    
+    def validation_requested(req):
+        """validate=1 в /api/convert: проверка по схеме перед конвертацией"""
+        return req.args.get('validate', '').lower() in ('1', 'true', 'yes')
+    
+    def parse_on_receipt(req):
+        """
+        Разбирать ли XML ещё при приёме.
+        
+        С кэшем результатов sha256 известен только после приёма всего файла,
+        и при попадании в кэш дерево не нужно: тогда при приёме файл лишь
+        пишется на диск и хэшируется, а разбирается из spool-файла после
+        промаха (convert_and_store). Дерево нужно наверняка без кэша и при
+        проверке по схеме.
+        """
+        return result_cache is None or (req.endpoint == 'api_convert'
+                                        and validation_requested(req))
+    
+    def convert_and_store(upload, original_name=None, timings=None):
+        """
+        Конвертация с учётом кэша результатов.
+        
+        upload - XMLSpool загруженного файла. Возвращает (temp_id, filename,
+        xslt_used, cached). XML разбирается только при промахе кэша (если
+        дерево не построено при приёме, см. parse_on_receipt) - при
+        попадании отдаём уже сохранённый артефакт. Длительности этапов
+        пишутся в timings и учитываются в метриках.
+        """
+        if timings is None:
+            timings = StageTimings()
+        xml_hash = upload.sha256
+        
+        if result_cache is None:
+            return convert_upload(upload, original_name, timings)
+        
+        with timings.stage('cache_lookup'):
+            cached = result_cache.get(xml_hash, converter.stylesheet_version)
+        if cached:
+            return cached_result(cached, upload, timings)
+        
+        # Один документ конвертирует один процесс хоста, остальные ждут его результат
+        with result_cache.single_flight(xml_hash):
+            with timings.stage('cache_lookup'):
+                cached = result_cache.get(xml_hash, converter.stylesheet_version, count=False)
+            if cached:
+                return cached_result(cached, upload, timings)
+            return convert_upload(upload, original_name, timings)
+    
+    def cached_result(cached, upload, timings):
+        """Ответ из кэша результатов: (temp_id, filename, xslt_used, True)"""
+        temp_id, xslt_used = cached
+        metadata = temp_manager.get_metadata(temp_id) or {}
+        observe_conversion(timings, upload.size, metadata.get('content_size'), xslt_used,
+                           cached=True)
+        return temp_id, metadata.get('filename'), xslt_used, True
+    
+    def convert_upload(upload, original_name, timings):
+        """Конвертация без кэша с сохранением результата (и ссылки на него в кэше)"""
+        try:
+            # Без кэша результатов дерево уже построено инкрементальным парсером при приёме
+            with timings.stage('parse'):
+                xml_doc = upload.parse(converter)
+            
+            # Конвертируем
+            html_content, xslt_used = converter.convert(xml_doc=xml_doc, timings=timings)
+            
+            # Сохраняем во временный файл вместе с метаданными
+            temp_id, filename, filepath = temp_manager.create_temp_file(
+                html_content,
+                extension='.html',
+                prefix='moex_',
+                metadata={
+                    'original_name': original_name,
+                    'xslt_used': xslt_used
+                },
+                timings=timings
+            )
+        except Exception:
+            if metrics is not None:
+                metrics.observe_conversion(timings, upload.size, status='error')
+            raise
+        
+        if result_cache is not None:
+            try:
+                result_cache.put(upload.sha256, temp_id, xslt_used,
+                                 converter.stylesheet_version(xslt_used),
+                                 os.path.getsize(filepath))
+            except Exception as e:
+                app.logger.warning(f"Не удалось сохранить результат в кэш: {e}")
+        
+        if search_index is not None:
+            # Текст извлекается фоновым потоком из сохранённого артефакта
+            search_index.submit(temp_id, report_type(xslt_used, xml_doc),
+                                report_date(xml_doc, xslt_used), original_name)
+        
+        metadata = temp_manager.get_metadata(temp_id) or {}
+        observe_conversion(timings, upload.size, metadata.get('content_size'), xslt_used,
+                           cached=False)
+        return temp_id, filename, xslt_used, False
+    
+    def observe_conversion(timings, input_size, output_size, xslt_used, cached):
+        """Учёт успешной конвертации в метриках и журнале (output_size - размер HTML)"""
+        if metrics is not None:
+            metrics.observe_conversion(timings, input_size, output_size, xslt_used,
+                                       cached=cached)
+        app.logger.info(
+            f"Конвертация: {input_size} -> {output_size} байт, XSLT {xslt_used}, "
+            f"из кэша: {cached}, этапы: {timings.as_dict()}",
+            extra={
+                'timings': timings.as_dict(),
+                'input_size': input_size,
+                'output_size': output_size,
+                'stylesheet': xslt_used,
+                'cached': cached
+            }
+        )
+    
+    def negotiate_encoding(filepath):
+        """Кодирование артефакта и можно ли отдать его клиенту без распаковки"""
+        encoding = artifact_encoding(filepath)
+        return encoding, encoding is not None and bool(request.accept_encodings[encoding])
+    
+    def mark_encoding(response, encoding, compressed):
+        if compressed:
+            response.headers['Content-Encoding'] = encoding
+        if encoding is not None:
+            response.vary.add('Accept-Encoding')
+        return response
+    
+    def cache_privately(response):
+        """
+        Содержимое артефакта не меняется, поэтому браузер может кэшировать его
+        весь срок жизни файла; ETag позволяет отвечать 304 на повторные запросы
+        """
+        response.cache_control.max_age = app.config['TEMP_FILE_LIFETIME']
+        response.cache_control.public = False
+        response.cache_control.private = True
+        return response
+    
+    def send_artifact(temp_id, filepath, as_attachment=False, download_name=None, max_age=None):
+        """
+        Отдача HTML артефакта.
+        
+        Сжатый на диске артефакт клиенту, принимающему это кодирование
+        (Accept-Encoding), отдаётся как есть с Content-Encoding - без
+        повторного сжатия; остальным - распакованным на лету потоком.
+        """
+        encoding, compressed = negotiate_encoding(filepath)
+        
+        response = send_file(
+            filepath if encoding is None or compressed else open_artifact(filepath),
+            mimetype='text/html',
+            as_attachment=as_attachment,
+            download_name=download_name,
+            conditional=True,
+            # Содержимое артефакта неизменно, поэтому ETag - по ID и представлению
+            etag=f"{temp_id}-{encoding if compressed else 'identity'}",
+            max_age=max_age
+        )
+        return mark_encoding(response, encoding, compressed)
+    
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+    
+    @app.after_request
+    def observe_request(response):
+        started = g.get('request_started')
+        if metrics is not None and started is not None:
+            metrics.request_seconds.observe(
+                time.perf_counter() - started,
+                endpoint=request.endpoint or 'unknown',
+                method=request.method,
+                status=response.status_code
+            )
+        return response
+    
     @app.route('/')
     def index():
         """Главная страница"""
         return render_template('index.html')
     
     @app.route('/upload', methods=['POST'])
+    @admitted
+    @parse_uploads(when=parse_on_receipt)
     def upload_file():
         """Обработка загрузки файла"""
-        if 'xml_file' not in request.files:
+        # Приём файла (и, без кэша результатов, его разбор) происходит при обращении к request.files
+        timings = StageTimings()
+        with timings.stage('receive'):
+            files = request.files
+        
+        if 'xml_file' not in files:
             return render_template('error.html', 
                                  error="Файл не загружен"), 400
         
-        file = request.files['xml_file']
+        file = files['xml_file']
         
         if file.filename == '':
             return render_template('error.html',
@@ -31,33 +276,12 @@ def register_routes(app, converter, temp_manager):
                                  error="Недопустимый формат файла. Разрешены только .xml"), 400
         
         try:
-            # Читаем файл
-            xml_bytes = file.read()
+            # Файл уже принят на диск (размер проверен при приёме)
+            upload = receive_xml(file, parse=parse_on_receipt(request))
             
-            # Проверяем размер
-            if len(xml_bytes) > app.config['MAX_CONTENT_LENGTH']:
-                return render_template('error.html',
-                                     error=f"Файл слишком большой. Максимальный размер: "
-                                           f"{app.config['MAX_CONTENT_LENGTH'] // (1024*1024)}MB"), 400
-            
-            # Конвертируем
-            html_content, xslt_used = converter.convert(xml_bytes)
-            
-            # Сохраняем во временный файл
-            temp_id, filename, filepath = temp_manager.create_temp_file(
-                html_content, 
-                extension='.html',
-                prefix='moex_'
-            )
-            
-            # Записываем информацию о файле в сессию
-            file_info = {
-                'original_name': file.filename,
-                'converted_name': filename,
-                'temp_id': temp_id,
-                'timestamp': datetime.now().isoformat(),
-                'xslt_used': xslt_used
-            }
+            # Конвертируем (или берём готовый результат из кэша)
+            temp_id, filename, xslt_used, cached = convert_and_store(upload, file.filename,
+                                                                     timings)
             
             # Перенаправляем на страницу результата
             return redirect(url_for('show_result', temp_id=temp_id))
@@ -76,13 +300,70 @@ def register_routes(app, converter, temp_manager):
             return render_template('error.html',
                                  error="Файл не найден или устарел"), 404
         
-        # Читаем HTML результат
-        with open(filepath, 'r', encoding='utf-8') as f:
-            html_content = f.read()
-        
+        # Сам HTML не встраиваем в страницу: iframe загружает его отдельным запросом
+        # (большой результат - по страницам, см. show_result_view)
+        metadata = temp_manager.get_metadata(temp_id) or {}
         return render_template('result.html',
-                             html_content=html_content,
-                             temp_id=temp_id)
+                             temp_id=temp_id,
+                             pages=len(metadata.get('pages') or ()))
+    
+    @app.route('/result/<temp_id>/raw')
+    def show_result_raw(temp_id):
+        """Потоковая отдача HTML результата (для iframe на странице результата)"""
+        filepath = temp_manager.get_temp_file(temp_id)
+        
+        if not filepath:
+            return render_template('error.html',
+                                 error="Файл не найден или устарел"), 404
+        
+        return cache_privately(send_artifact(temp_id, filepath,
+                                             max_age=app.config['TEMP_FILE_LIFETIME']))
+    
+    @app.route('/result/<temp_id>/view')
+    def show_result_view(temp_id):
+        """
+        Просмотр большого результата по страницам (для iframe на странице результата).
+        
+        Отдаётся начало документа, первая страница и загрузчик, который
+        подгружает остальные страницы при прокрутке: время до первой
+        отрисовки не зависит от размера отчёта.
+        """
+        metadata = temp_manager.get_metadata(temp_id)
+        if metadata is not None and not metadata.get('pages'):
+            return redirect(url_for('show_result_raw', temp_id=temp_id))
+        
+        head = temp_manager.get_part(temp_id, 0)
+        first_page = temp_manager.get_page(temp_id, 1)
+        tail = temp_manager.get_part(temp_id, -1)
+        if head is None or first_page is None or tail is None:
+            return render_template('error.html',
+                                 error="Файл не найден или устарел"), 404
+        
+        loader = render_template('result_pages.html', temp_id=temp_id,
+                                 pages=len(metadata['pages']))
+        response = app.response_class(head + first_page + loader.encode('utf-8') + tail,
+                                      mimetype='text/html')
+        response.set_etag(f"{temp_id}-view")
+        return cache_privately(response).make_conditional(request)
+    
+    @app.route('/result/<temp_id>/page/<int:number>')
+    def show_result_page(temp_id, number):
+        """Страница результата (фрагмент HTML) для загрузчика show_result_view"""
+        filepath = temp_manager.get_temp_file(temp_id)
+        if not filepath:
+            return render_template('error.html',
+                                 error="Файл не найден или устарел"), 404
+        
+        encoding, compressed = negotiate_encoding(filepath)
+        page = temp_manager.get_page(temp_id, number, compressed=compressed)
+        if page is None:
+            return render_template('error.html',
+                                 error="Страница не найдена"), 404
+        
+        response = app.response_class(page, mimetype='text/html')
+        response.set_etag(f"{temp_id}-{number}-{encoding if compressed else 'identity'}")
+        mark_encoding(response, encoding, compressed)
+        return cache_privately(response).make_conditional(request)
     
     @app.route('/download/<temp_id>')
     def download_file(temp_id):
@@ -93,78 +374,466 @@ def register_routes(app, converter, temp_manager):
             return render_template('error.html',
                                  error="Файл не найден или устарел"), 404
         
-        # Генерируем имя для скачивания
-        original_name = request.args.get('name', 'converted')
+        # Генерируем имя для скачивания (по умолчанию - по имени исходного XML)
+        metadata = temp_manager.get_metadata(temp_id) or {}
+        original_name = request.args.get('name') or metadata.get('original_name') or 'converted'
+        original_name = os.path.splitext(os.path.basename(original_name))[0]
         download_name = generate_filename(original_name, suffix='converted')
         # Всегда предлагаем скачивание именно как HTML файл
         base, ext = os.path.splitext(download_name)
         if ext.lower() != '.html':
             download_name = f"{base}.html"
         
-        return send_file(
-            filepath,
-            as_attachment=True,
-            download_name=download_name,
-            mimetype='text/html'
-        )
+        return send_artifact(temp_id, filepath, as_attachment=True, download_name=download_name)
     
     @app.route('/api/convert', methods=['POST'])
+    @admitted
+    @parse_uploads(when=parse_on_receipt)
     def api_convert():
         """API endpoint для конвертации"""
-        if 'xml_file' not in request.files:
+        timings = StageTimings()
+        with timings.stage('receive'):
+            files = request.files
+        
+        if 'xml_file' not in files:
             return jsonify({'error': 'Файл не загружен'}), 400
         
-        file = request.files['xml_file']
+        file = files['xml_file']
         
         if not allowed_file(file.filename):
             return jsonify({'error': 'Недопустимый формат файла'}), 400
         
         try:
-            xml_bytes = file.read()
-            html_content, xslt_used = converter.convert(xml_bytes)
+            upload = receive_xml(file, parse=parse_on_receipt(request))
+            
+            # validate=1: проверка по схеме того же дерева, что пойдёт в конвертацию
+            validation = None
+            if validation_requested(request):
+                with timings.stage('parse'):
+                    xml_doc = upload.parse(converter)
+                xsd_url = converter.extract_xsd_url(xml_doc)
+                with timings.stage('validate'):
+                    is_valid, message = converter.validate_xml(xsd_url=xsd_url, xml_doc=xml_doc)
+                validation = {'valid': is_valid, 'message': message, 'schema': xsd_url}
             
-            # Создаем временный файл
-            temp_id, filename, filepath = temp_manager.create_temp_file(html_content)
+            temp_id, filename, xslt_used, cached = convert_and_store(upload, file.filename,
+                                                                     timings)
             
-            return jsonify({
+            result = {
                 'success': True,
                 'temp_id': temp_id,
                 'download_url': url_for('download_file', temp_id=temp_id, _external=True),
                 'preview_url': url_for('show_result', temp_id=temp_id, _external=True),
-                'xslt_used': xslt_used
-            })
+                'xslt_used': xslt_used,
+                'cached': cached
+            }
+            if validation is not None:
+                result['validation'] = validation
+            response = jsonify(result)
+            # Длительности этапов для DevTools браузера (включается в настройках)
+            if app.config['SERVER_TIMING']:
+                response.headers['Server-Timing'] = timings.server_timing()
+            return response
             
         except Exception as e:
             return jsonify({'error': str(e)}), 500
     
+    @app.route('/api/convert/batch', methods=['POST'])
+    @admitted
+    def api_convert_batch():
+        """Пакетная конвертация: несколько xml_file или zip-архив, ответ - zip с HTML"""
+        if job_queue is None:
+            return jsonify({'error': 'Пакетная конвертация отключена'}), 404
+        
+        # Для пакета действует собственный лимит размера запроса
+        request.max_content_length = app.config['BATCH_MAX_CONTENT_LENGTH']
+        
+        files = request.files.getlist('xml_file') + request.files.getlist('archive')
+        if not files:
+            return jsonify({'error': 'Файлы не загружены'}), 400
+        
+        batch_root = os.path.join(app.config['UPLOAD_FOLDER'], 'batch')
+        os.makedirs(batch_root, exist_ok=True)
+        work_dir = tempfile.mkdtemp(dir=batch_root)
+        
+        try:
+            zip_path, manifest = convert_batch(
+                converter, job_queue, files, work_dir,
+                max_files=app.config['BATCH_MAX_FILES'],
+                max_bytes=app.config['BATCH_MAX_CONTENT_LENGTH']
+            )
+        except BatchError as e:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            return jsonify({'error': str(e)}), 400
+        except Exception as e:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            app.logger.error(f"Ошибка пакетной конвертации: {str(e)}")
+            return jsonify({'error': str(e)}), 500
+        
+        # Открытый файл остаётся доступным после удаления каталога (POSIX);
+        # если удалить не удалось, каталог уберёт фоновая очистка
+        zip_file = open(zip_path, 'rb')
+        shutil.rmtree(work_dir, ignore_errors=True)
+        
+        response = send_file(
+            zip_file,
+            as_attachment=True,
+            download_name=f"moex_batch_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip",
+            mimetype='application/zip'
+        )
+        response.headers['X-Batch-Converted'] = str(manifest['converted'])
+        response.headers['X-Batch-Failed'] = str(manifest['failed'])
+        return response
+    
+    @app.route('/api/export', methods=['POST'])
+    @admitted
+    def api_export():
+        """Выгрузка таблиц записей отчёта в CSV / JSON Lines / Parquet без XSLT"""
+        if 'xml_file' not in request.files:
+            return jsonify({'error': 'Файл не загружен'}), 400
+        
+        file = request.files['xml_file']
+        
+        if not allowed_file(file.filename):
+            return jsonify({'error': 'Недопустимый формат файла'}), 400
+        
+        # Документ читается потоково из spool-файла, дерево не строится
+        upload = receive_xml(file)
+        upload.flush()
+        
+        export_root = os.path.join(app.config['UPLOAD_FOLDER'], 'export')
+        os.makedirs(export_root, exist_ok=True)
+        work_dir = tempfile.mkdtemp(dir=export_root)
+        
+        try:
+            path, mimetype, name, summary = export_report(
+                upload.path, work_dir,
+                fmt=request.args.get('format', 'csv').lower(),
+                table=request.args.get('table') or None
+            )
+        except ExportError as e:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            return jsonify({'error': str(e)}), 400
+        except Exception as e:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            app.logger.error(f"Ошибка экспорта: {str(e)}")
+            return jsonify({'error': str(e)}), 500
+        
+        # Открытый файл остаётся доступным после удаления каталога (POSIX)
+        export_file = open(path, 'rb')
+        shutil.rmtree(work_dir, ignore_errors=True)
+        
+        base = os.path.splitext(os.path.basename(file.filename))[0] or 'report'
+        response = send_file(
+            export_file,
+            as_attachment=True,
+            download_name=f"{base}_{name}",
+            mimetype=mimetype
+        )
+        response.headers['X-Export-Tables'] = str(len(summary))
+        response.headers['X-Export-Rows'] = str(sum(table['rows'] for table in summary.values()))
+        return response
+    
+    @app.route('/api/diff', methods=['POST'])
+    @admitted
+    def api_diff():
+        """Сравнение двух отчётов: добавленные, удалённые и изменённые записи в оформлении XSLT"""
+        # Два отчёта в одном запросе - собственный лимит размера
+        request.max_content_length = app.config['DIFF_MAX_CONTENT_LENGTH']
+        timings = StageTimings()
+        with timings.stage('receive'):
+            files = request.files
+        
+        if 'old_file' not in files or 'new_file' not in files:
+            return jsonify({'error': 'Нужно загрузить два файла: old_file и new_file'}), 400
+        
+        old_file = files['old_file']
+        new_file = files['new_file']
+        
+        if not allowed_file(old_file.filename) or not allowed_file(new_file.filename):
+            return jsonify({'error': 'Недопустимый формат файла'}), 400
+        
+        key = request.args.get('key') or app.config['DIFF_KEY_ATTRIBUTES']
+        key_attributes = [name.strip() for name in key.split(',') if name.strip()] if key else None
+        
+        # Отчёты читаются потоково из spool-файлов, деревья не строятся
+        old_upload = receive_xml(old_file)
+        new_upload = receive_xml(new_file)
+        old_upload.flush()
+        new_upload.flush()
+        
+        diff_root = os.path.join(app.config['UPLOAD_FOLDER'], 'diff')
+        os.makedirs(diff_root, exist_ok=True)
+        work_dir = tempfile.mkdtemp(dir=diff_root)
+        
+        try:
+            html_content, summary = diff_reports(converter, old_upload.path, new_upload.path,
+                                                 work_dir, key_attributes, timings)
+            temp_id, filename, filepath = temp_manager.create_temp_file(
+                html_content,
+                extension='.html',
+                prefix='moex_',
+                metadata={
+                    'original_name': f"{old_file.filename} - {new_file.filename}",
+                    'xslt_used': next(iter(summary['xslt_used'].values()), None),
+                    'diff': summary['records']
+                },
+                timings=timings
+            )
+        except DiffError as e:
+            return jsonify({'error': str(e)}), 400
+        except Exception as e:
+            app.logger.error(f"Ошибка сравнения отчётов: {str(e)}")
+            return jsonify({'error': str(e)}), 500
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        
+        app.logger.info(
+            f"Сравнение: {old_upload.size} и {new_upload.size} байт, записи: {summary['records']}, "
+            f"этапы: {timings.as_dict()}"
+        )
+        
+        result = {
+            'success': True,
+            'temp_id': temp_id,
+            'download_url': url_for('download_file', temp_id=temp_id, _external=True),
+            'preview_url': url_for('show_result', temp_id=temp_id, _external=True)
+        }
+        result.update(summary)
+        response = jsonify(result)
+        if app.config['SERVER_TIMING']:
+            response.headers['Server-Timing'] = timings.server_timing()
+        return response
+    
+    @app.route('/api/jobs', methods=['POST'])
+    # Задание выполняет пул процессов со своей очередью - здесь только лимит частоты
+    @admitted(inflight=False)
+    def api_submit_job():
+        """Постановка конвертации в очередь (ответ сразу, без ожидания результата)"""
+        if job_queue is None:
+            return jsonify({'error': 'Очередь заданий отключена'}), 404
+        
+        if 'xml_file' not in request.files:
+            return jsonify({'error': 'Файл не загружен'}), 400
+        
+        file = request.files['xml_file']
+        
+        if not allowed_file(file.filename):
+            return jsonify({'error': 'Недопустимый формат файла'}), 400
+        
+        # XML разбирает процесс пула, здесь только приём на диск и хэш
+        upload = receive_xml(file)
+        
+        # Готовый результат из кэша - задание сразу выполнено
+        cached = None
+        if result_cache is not None:
+            cached = result_cache.get(upload.sha256, converter.stylesheet_version)
+        
+        try:
+            if cached:
+                job_id = job_queue.record_done(cached[0], cached[1], file.filename)
+            else:
+                # spool-файл переносится в очередь без копирования
+                job_id = job_queue.submit(upload.detach(), file.filename)
+        except QueueFullError as e:
+            response = jsonify({'error': str(e)})
+            response.headers['Retry-After'] = '5'
+            return response, 503
+        
+        return jsonify({
+            'success': True,
+            'job_id': job_id,
+            'status_url': url_for('api_job_status', job_id=job_id, _external=True),
+            'result_url': url_for('api_job_result', job_id=job_id, _external=True)
+        }), 202
+    
+    @app.route('/api/jobs/<job_id>')
+    def api_job_status(job_id):
+        """Состояние задания конвертации"""
+        job = job_queue.get(job_id) if job_queue is not None else None
+        if job is None:
+            return jsonify({'error': 'Задание не найдено'}), 404
+        
+        result = {
+            'job_id': job['id'],
+            'status': job['status'],
+            'original_name': job['original_name'],
+            'created': job['created'],
+            'updated': job['updated']
+        }
+        if job['status'] == 'done':
+            result.update({
+                'temp_id': job['temp_id'],
+                'xslt_used': job['xslt_used'],
+                'download_url': url_for('download_file', temp_id=job['temp_id'], _external=True),
+                'preview_url': url_for('show_result', temp_id=job['temp_id'], _external=True)
+            })
+        elif job['status'] == 'failed':
+            result['error'] = job['error']
+        
+        return jsonify(result)
+    
+    @app.route('/api/jobs/<job_id>/result')
+    def api_job_result(job_id):
+        """Результат задания: перенаправление на скачивание HTML"""
+        job = job_queue.get(job_id) if job_queue is not None else None
+        if job is None:
+            return jsonify({'error': 'Задание не найдено'}), 404
+        
+        if job['status'] == 'failed':
+            return jsonify({'error': job['error'], 'status': job['status']}), 500
+        
+        if job['status'] != 'done':
+            response = jsonify({'error': 'Задание ещё выполняется', 'status': job['status']})
+            response.headers['Retry-After'] = '1'
+            return response, 409
+        
+        return redirect(url_for('download_file', temp_id=job['temp_id']))
+    
+    def stream_validation(req):
+        """Потоковая валидация: по запросу (mode=stream/tree) или для больших файлов"""
+        mode = req.args.get('mode')
+        if mode:
+            return mode == 'stream'
+        return (req.content_length or 0) > app.config['VALIDATE_STREAM_THRESHOLD']
+    
     @app.route('/api/validate', methods=['POST'])
+    @admitted
+    @parse_uploads(when=lambda req: not stream_validation(req))
     def api_validate():
-        """API для валидации XML"""
+        """API для валидации XML по схеме, указанной в документе"""
         if 'xml_file' not in request.files:
             return jsonify({'error': 'Файл не загружен'}), 400
         
         file = request.files['xml_file']
-        xml_bytes = file.read()
+        streaming = stream_validation(request)
+        upload = receive_xml(file, parse=not streaming)
         
-        is_valid, message = converter.validate_xml(xml_bytes)
+        if streaming:
+            # Большой файл проверяется по мере чтения с диска, дерево не строится
+            upload.flush()
+            xsd_url = converter.peek_xsd_url(upload.path)
+            is_valid, message = converter.validate_stream(upload.path, xsd_url)
+        else:
+            try:
+                xml_doc = upload.parse(converter)
+            except etree.XMLSyntaxError as e:
+                return jsonify({
+                    'valid': False,
+                    'message': f"Ошибка синтаксиса XML: {e}",
+                    'schema': None,
+                    'mode': 'tree'
+                })
+            xsd_url = converter.extract_xsd_url(xml_doc)
+            is_valid, message = converter.validate_xml(xsd_url=xsd_url, xml_doc=xml_doc)
         
         return jsonify({
             'valid': is_valid,
-            'message': message
+            'message': message,
+            'schema': xsd_url,
+            'mode': 'stream' if streaming else 'tree'
         })
     
+    @app.route('/api/cache/stats')
+    def api_cache_stats():
+        """Статистика попаданий в кэш XSLT и запросов к серверу MOEX"""
+        stats = {
+            'xslt': converter.xslt_cache.stats(),
+            'xsd': converter.xsd_cache.stats(),
+            'http': converter.fetcher.stats()
+        }
+        if result_cache is not None:
+            stats['results'] = result_cache.stats()
+        # Счётчики всех воркеров хоста из общего хранилища (текущий - самые свежие)
+        stats['worker'] = os.getpid()
+        if converter.shared_store is not None:
+            caches = {'xslt': converter.xslt_cache, 'xsd': converter.xsd_cache}
+            if result_cache is not None:
+                caches['results'] = result_cache
+            converter.shared_store.publish(caches)
+            stats['workers'] = converter.shared_store.worker_stats()
+        return jsonify(stats)
+    
+    @app.route('/api/search')
+    def api_search():
+        """Поиск по тексту сохранённых результатов (отчёты и строки с совпадениями)"""
+        if search_index is None:
+            return jsonify({'error': 'Поиск отключен'}), 404
+        
+        try:
+            limit = min(max(int(request.args.get('limit', 20)), 1), 100)
+            rows = min(max(int(request.args.get('rows', 5)), 1), 50)
+        except ValueError:
+            return jsonify({'error': 'Некорректные параметры limit/rows'}), 400
+        
+        started = time.perf_counter()
+        try:
+            results = search_index.search(request.args.get('q', ''), limit=limit, rows=rows,
+                                          report_type=request.args.get('type'),
+                                          trade_date=request.args.get('date'))
+        except SearchError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        for result in results:
+            result['created'] = datetime.fromtimestamp(result['created']).isoformat()
+            result['result_url'] = url_for('show_result', temp_id=result['temp_id'])
+        return jsonify({
+            'query': request.args.get('q', ''),
+            'results': results,
+            'took_ms': round((time.perf_counter() - started) * 1000, 2)
+        })
+    
+    @app.route('/api/search/stats')
+    def api_search_stats():
+        """Размер поискового индекса и очередь индексации текущего воркера"""
+        if search_index is None:
+            return jsonify({'error': 'Поиск отключен'}), 404
+        return jsonify(search_index.stats())
+    
+    @app.route('/metrics')
+    def metrics_endpoint():
+        """Метрики хоста (сумма по всем воркерам) в формате Prometheus"""
+        if metrics is None:
+            return jsonify({'error': 'Метрики отключены'}), 404
+        return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+    
     @app.route('/cleanup', methods=['POST'])
     def cleanup():
         """Очистка временных файлов (требуется аутентификация в продакшене)"""
         if not app.debug and not request.headers.get('X-Admin-Key') == app.config.get('ADMIN_KEY'):
             return jsonify({'error': 'Доступ запрещен'}), 403
         
-        deleted = temp_manager.cleanup()
+        deleted, deleted_bytes = temp_manager.cleanup(app.config['TEMP_FILE_LIFETIME'] / 3600)
+        if search_index is not None:
+            search_index.expire(app.config['TEMP_FILE_LIFETIME'])
         return jsonify({
             'success': True,
-            'deleted': deleted
+            'deleted': deleted,
+            'bytes': deleted_bytes
         })
     
+    @app.route('/api/janitor/stats')
+    def api_janitor_stats():
+        """Статистика фоновой очистки в текущем воркере"""
+        if janitor is None:
+            return jsonify({'error': 'Фоновая очистка отключена'}), 404
+        return jsonify(janitor.stats())
+    
+    @app.route('/api/admission/stats')
+    def api_admission_stats():
+        """Лимиты и текущая нагрузка хоста (счётчики отказов - текущего воркера)"""
+        if admission is None:
+            return jsonify({'error': 'Контроль допуска отключён'}), 404
+        return jsonify(admission.stats())
+    
+    @app.errorhandler(413)
+    def too_large(error):
+        limit = request.max_content_length or app.config['MAX_CONTENT_LENGTH']
+        message = f"Файл слишком большой. Максимальный размер: {limit // (1024*1024)}MB"
+        if request.path.startswith('/api/'):
+            return jsonify({'error': message}), 413
+        return render_template('error.html', error=message), 413
+    
     @app.errorhandler(404)
     def not_found(error):
         return render_template('error.html',
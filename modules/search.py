@@ -0,0 +1,405 @@
+# modules/search.py
+"""
+Полнотекстовый поиск по сохранённым результатам конвертации.
+
+Текст каждого отчёта (тело HTML без разметки, строка таблицы - строка
+текста, ячейки через " | ") при сохранении результата попадает в
+локальную SQLite с FTS5 - рядом с временными файлами. Текст режется на
+куски по chunk_rows строк: по найденному куску подсветкой FTS5
+выбираются совпавшие строки, а ранжирование и подсчёт совпадений идут
+по кускам, а не по целым отчётам в десятки мегабайт.
+
+Куски одного отчёта вставляются подряд с явными rowid, в таблице
+reports хранится их диапазон: удаление и выборка по отчёту - диапазон
+rowid, без просмотра индекса. Записи отчётов удаляются вместе
+с артефактами (expire из задач CleanupJanitor).
+"""
+import os
+import re
+import html
+import time
+import queue
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Метки совпадений в highlight() - символы, которых нет в тексте отчётов
+MATCH_START = '\x02'
+MATCH_END = '\x03'
+
+BODY_PATTERN = re.compile(rb'<body\b[^>]*>', re.I)
+BODY_END = re.compile(rb'</body\s*>', re.I)
+
+# Частые теги без атрибутов заменяются bytes.replace (на порядок быстрее
+# регулярного выражения), остальные - шаблонами ниже
+CELL_REPLACEMENTS = ((b'</td></tr>', b'\n'), (b'</th></tr>', b'\n'),
+                     (b'<td>', b''), (b'</td>', b'\t'), (b'<th>', b''), (b'</th>', b'\t'),
+                     (b'<tr>', b''), (b'</tr>', b'\n'))
+HIDDEN_MARKERS = (b'<!--', b'<script', b'<SCRIPT', b'<style', b'<STYLE')
+HIDDEN_PATTERN = re.compile(rb'<(script|style)\b.*?</\1\s*>|<!--.*?-->', re.I | re.S)
+BLOCK_PATTERN = re.compile(rb'</?(?:tr|p|div|br|h[1-6]|li|table|caption|thead|tbody|tfoot)\b[^>]*>',
+                           re.I)
+CELL_PATTERN = re.compile(rb'</(?:td|th)\s*>', re.I)
+TAG_PATTERN = re.compile(rb'<[^>]*>')
+# Пустые ячейки и отступы (шаблоны с конкретного символа, а не с класса - в разы быстрее)
+EMPTY_CELLS_PATTERN = re.compile(rb'\t[\t ]+')
+LINE_START_PATTERN = re.compile(rb'\n\s+')
+
+# Дата отчёта в имени стиля MOEX (CCX99_RU_23062025.xsl)
+STYLESHEET_DATE_PATTERN = re.compile(r'_(\d{2})(\d{2})(\d{4})(?:\D|$)')
+ISO_DATE_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2}')
+DATE_ATTRIBUTES = ('TradeDate', 'DocDate', 'ReportDate', 'Date')
+
+class SearchError(Exception):
+    """Некорректный поисковый запрос"""
+
+def fts5_available():
+    """Поддерживает ли SQLite интерпретатора FTS5"""
+    conn = sqlite3.connect(':memory:')
+    try:
+        conn.execute("CREATE VIRTUAL TABLE t USING fts5(body)")
+        return True
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        conn.close()
+
+def report_type(xslt_used, xml_doc=None):
+    """Тип отчёта: префикс имени стиля (CCX99_RU_23062025.xsl -> CCX99) или корневой тег"""
+    if xslt_used:
+        name = os.path.basename(str(xslt_used).replace('\\', '/'))
+        prefix = name.split('_', 1)[0].split('.', 1)[0]
+        if prefix:
+            return prefix.upper()
+    if xml_doc is not None:
+        return xml_doc.getroot().tag.upper()
+    return None
+
+def report_date(xml_doc=None, xslt_used=None):
+    """Дата торгов (YYYY-MM-DD): атрибут корня документа или дата в имени стиля"""
+    if xml_doc is not None:
+        attrib = xml_doc.getroot().attrib
+        candidates = [attrib.get(name) for name in DATE_ATTRIBUTES]
+        candidates += [value for name, value in attrib.items() if name.endswith('Date')]
+        for value in candidates:
+            match = ISO_DATE_PATTERN.match(value or '')
+            if match:
+                return match.group(0)
+    if xslt_used:
+        match = STYLESHEET_DATE_PATTERN.search(os.path.basename(str(xslt_used)))
+        if match:
+            day, month, year = match.groups()
+            return f"{year}-{month}-{day}"
+    return None
+
+def extract_text(content):
+    """
+    Текст HTML отчёта: список строк (строка таблицы - одна строка, ячейки через " | ").
+    """
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+
+    match = BODY_PATTERN.search(content)
+    start = match.end() if match else 0
+    match = BODY_END.search(content, start)
+    body = content[start:match.start() if match else len(content)]
+
+    if any(marker in body for marker in HIDDEN_MARKERS):
+        body = HIDDEN_PATTERN.sub(b'', body)
+    for old, new in CELL_REPLACEMENTS:
+        body = body.replace(old, new)
+    body = BLOCK_PATTERN.sub(b'\n', body)
+    body = CELL_PATTERN.sub(b'\t', body)
+    body = TAG_PATTERN.sub(b'', body)
+
+    # Построчная обработка в Python была бы основной частью времени
+    body = EMPTY_CELLS_PATTERN.sub(b'\t', body).replace(b'\t\n', b'\n')
+    body = LINE_START_PATTERN.sub(b'\n', body).strip(b' \t\r\n').replace(b'\t', b' | ')
+    if not body:
+        return []
+    return html.unescape(body.decode('utf-8', errors='replace')).split('\n')
+
+def build_query(text):
+    """
+    Запрос пользователя -> выражение MATCH FTS5.
+
+    Каждое слово - фраза в кавычках (коды вида USD000UTSTOM, даты и номера
+    счетов разбиваются токенизатором на части, фраза находит их целиком),
+    слова объединяются по И. Звёздочка в конце слова - поиск по префиксу.
+    """
+    terms = []
+    for word in (text or '').split():
+        prefix = word.endswith('*')
+        word = word.rstrip('*')
+        if not word.strip('"'):
+            continue
+        terms.append('"' + word.replace('"', '""') + '"' + ('*' if prefix else ''))
+    if not terms:
+        raise SearchError("Пустой поисковый запрос")
+    return ' '.join(terms)
+
+def _snippet_rows(text, limit):
+    """Строки куска с совпадениями, совпадения выделены <mark> (HTML экранирован)"""
+    rows = []
+    for line in text.split('\n'):
+        if MATCH_START not in line:
+            continue
+        rows.append(html.escape(line).replace(MATCH_START, '<mark>').replace(MATCH_END, '</mark>'))
+        if len(rows) >= limit:
+            break
+    return rows
+
+class SearchIndex:
+    """
+    Поисковый индекс результатов в SQLite (WAL, FTS5).
+
+    Соединение своё у каждого потока и процесса (после fork открывается
+    заново), поэтому индекс пишут и воркеры gunicorn, и процессы пула заданий.
+
+    В веб-процессе результат индексируется фоновым потоком (submit):
+    извлечение текста отчёта в 20 МБ занимает около секунды и не должно
+    задерживать ответ. Поток читает сохранённый артефакт по temp_id через
+    temp_manager. Процессы пула заданий индексируют сразу (add).
+    """
+
+    def __init__(self, db_path, temp_manager=None, chunk_rows=50, max_pending=1000):
+        self.db_path = db_path
+        self.temp_manager = temp_manager
+        self.chunk_rows = chunk_rows
+        self.max_pending = max_pending
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._stats = {'indexed': 0, 'dropped': 0, 'errors': 0}
+
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS reports (
+                temp_id TEXT PRIMARY KEY,
+                report_type TEXT,
+                trade_date TEXT,
+                original_name TEXT,
+                created REAL NOT NULL,
+                rows INTEGER NOT NULL,
+                first_chunk INTEGER NOT NULL,
+                last_chunk INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS reports_created ON reports (created);
+            CREATE INDEX IF NOT EXISTS reports_type_date ON reports (report_type, trade_date);
+            CREATE VIRTUAL TABLE IF NOT EXISTS report_text USING fts5(body);
+        """)
+
+    def _conn(self):
+        """Соединение текущего потока (после fork открывается заново)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def close(self):
+        """Закрытие соединения текущего потока (в мастере gunicorn перед fork)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            conn.close()
+        self._local.conn = None
+
+    # Индексация
+
+    def add(self, temp_id, content, report_type=None, trade_date=None, original_name=None):
+        """Индексация текста отчёта (HTML, str или bytes). Возвращает число строк"""
+        lines = extract_text(content)
+        chunks = ['\n'.join(lines[i:i + self.chunk_rows])
+                  for i in range(0, len(lines), self.chunk_rows)] or ['']
+
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._delete(conn, temp_id)
+            first = conn.execute("SELECT COALESCE(MAX(rowid), 0) + 1 FROM report_text").fetchone()[0]
+            conn.executemany("INSERT INTO report_text (rowid, body) VALUES (?, ?)",
+                             enumerate(chunks, first))
+            conn.execute(
+                "INSERT INTO reports (temp_id, report_type, trade_date, original_name, created, "
+                "rows, first_chunk, last_chunk) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (temp_id, report_type, trade_date, original_name, time.time(), len(lines),
+                 first, first + len(chunks) - 1)
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+        with self._lock:
+            self._stats['indexed'] += 1
+        return len(lines)
+
+    def submit(self, temp_id, report_type=None, trade_date=None, original_name=None):
+        """Индексация сохранённого артефакта в фоновом потоке процесса"""
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((temp_id, report_type, trade_date, original_name))
+        except queue.Full:
+            with self._lock:
+                self._stats['dropped'] += 1
+            logger.warning(f"Очередь индексации переполнена, отчёт {temp_id} не проиндексирован")
+
+    def _ensure_started(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+
+        with self._lock:
+            if self._pid == pid:
+                return
+            # После fork поток и очередь родителя в дочернем процессе не нужны
+            self._queue = queue.Queue(self.max_pending)
+            threading.Thread(target=self._loop, args=(self._queue,),
+                             name='moex-search-indexer', daemon=True).start()
+            self._pid = pid
+
+    def _loop(self, pending):
+        from .utils import open_artifact
+
+        while True:
+            temp_id, report_type, trade_date, original_name = pending.get()
+            try:
+                filepath = self.temp_manager.get_temp_file(temp_id)
+                if not filepath:
+                    continue
+                with open_artifact(filepath) as f:
+                    content = f.read()
+                self.add(temp_id, content, report_type, trade_date, original_name)
+            except Exception as e:
+                with self._lock:
+                    self._stats['errors'] += 1
+                logger.error(f"Ошибка индексации отчёта {temp_id}: {e}")
+
+    # Поиск
+
+    def search(self, text, limit=20, rows=5, report_type=None, trade_date=None):
+        """
+        Поиск отчётов: список словарей (temp_id, report_type, trade_date,
+        original_name, created, chunks - число кусков с совпадениями,
+        rows - до rows строк с совпадениями, самые релевантные куски первыми).
+
+        Отчёты, артефактов которых уже нет, пропускаются и удаляются из индекса.
+        """
+        expression = build_query(text)
+        conditions = ["report_text MATCH ?"]
+        params = [expression]
+        if report_type:
+            conditions.append("r.report_type = ?")
+            params.append(report_type.upper())
+        if trade_date:
+            conditions.append("r.trade_date = ?")
+            params.append(trade_date)
+
+        conn = self._conn()
+        try:
+            found = conn.execute(
+                "SELECT r.temp_id, r.report_type, r.trade_date, r.original_name, r.created, "
+                "r.first_chunk, r.last_chunk, COUNT(*) AS chunks, MIN(t.rank) AS score "
+                "FROM report_text t JOIN reports r "
+                "ON t.rowid BETWEEN r.first_chunk AND r.last_chunk "
+                f"WHERE {' AND '.join(conditions)} "
+                "GROUP BY r.temp_id ORDER BY score",
+                params
+            ).fetchall()
+        except sqlite3.OperationalError as e:
+            raise SearchError(f"Некорректный поисковый запрос: {e}")
+
+        results = []
+        stale = []
+        for temp_id, rtype, rdate, original_name, created, first, last, chunks, _ in found:
+            if len(results) >= limit:
+                break
+            if self.temp_manager is not None and not self.temp_manager.get_temp_file(temp_id):
+                stale.append(temp_id)
+                continue
+
+            snippets = []
+            for (body,) in conn.execute(
+                    "SELECT highlight(report_text, 0, ?, ?) FROM report_text "
+                    "WHERE report_text MATCH ? AND rowid BETWEEN ? AND ? ORDER BY rank LIMIT ?",
+                    (MATCH_START, MATCH_END, expression, first, last, rows)):
+                snippets.extend(_snippet_rows(body, rows - len(snippets)))
+                if len(snippets) >= rows:
+                    break
+
+            results.append({
+                'temp_id': temp_id,
+                'report_type': rtype,
+                'trade_date': rdate,
+                'original_name': original_name,
+                'created': created,
+                'chunks': chunks,
+                'rows': snippets
+            })
+
+        for temp_id in stale:
+            self.remove(temp_id)
+        return results
+
+    # Очистка
+
+    def _delete(self, conn, temp_id):
+        row = conn.execute("SELECT first_chunk, last_chunk FROM reports WHERE temp_id = ?",
+                           (temp_id,)).fetchone()
+        if row is None:
+            return False
+        conn.execute("DELETE FROM report_text WHERE rowid BETWEEN ? AND ?", row)
+        conn.execute("DELETE FROM reports WHERE temp_id = ?", (temp_id,))
+        return True
+
+    def remove(self, temp_id):
+        """Удаление отчёта из индекса"""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            removed = self._delete(conn, temp_id)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return removed
+
+    def expire(self, max_age_seconds):
+        """
+        Удаление отчётов старше max_age_seconds (задача CleanupJanitor).
+
+        Продлённый (touch) артефакт ещё существует - его запись остаётся
+        и проверяется снова через max_age_seconds. Возвращает число удалённых.
+        """
+        now = time.time()
+        conn = self._conn()
+        candidates = [row[0] for row in conn.execute(
+            "SELECT temp_id FROM reports WHERE created < ?", (now - max_age_seconds,))]
+
+        removed = 0
+        for temp_id in candidates:
+            if self.temp_manager is not None and self.temp_manager.get_temp_file(temp_id):
+                conn.execute("UPDATE reports SET created = ? WHERE temp_id = ?", (now, temp_id))
+            elif self.remove(temp_id):
+                removed += 1
+        return removed
+
+    def stats(self):
+        """Размер индекса и счётчики индексации текущего процесса"""
+        reports, lines = self._conn().execute(
+            "SELECT COUNT(*), COALESCE(SUM(rows), 0) FROM reports").fetchone()
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update({
+            'reports': reports,
+            'rows': lines,
+            'pending': self._queue.qsize() if self._queue is not None and self._pid == os.getpid() else 0,
+            'pid': os.getpid()
+        })
+        return stats
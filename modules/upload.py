@@ -0,0 +1,193 @@
+# modules/upload.py
+import os
+import hashlib
+import tempfile
+from flask import Request, current_app
+from lxml import etree
+from werkzeug.exceptions import RequestEntityTooLarge
+from .utils import allowed_file, extract_encoding_from_xml
+from .converter import XML_PROLOG_SIZE, create_xml_parser
+
+# Размер блока при чтении загрузки, пришедшей не через XMLSpool
+CHUNK_SIZE = 64 * 1024
+
+class XMLSpool:
+    """
+    Приёмник загружаемого XML.
+
+    Werkzeug пишет сюда multipart-часть по мере поступления: данные уходят
+    в файл на диске, попутно считаются размер и sha256, а при parse=True
+    ими же кормится инкрементальный парсер lxml. Целиком в памяти файл
+    не собирается; после записи объект читается как обычный файл.
+    """
+
+    def __init__(self, spool_dir, max_size=None, parse=False):
+        os.makedirs(spool_dir, exist_ok=True)
+        self.file = tempfile.NamedTemporaryFile(dir=spool_dir, prefix='upload_',
+                                                suffix='.xml', delete=False)
+        self.path = self.file.name
+        self.max_size = max_size
+        self.size = 0
+        self._hash = hashlib.sha256()
+        self._parse = parse
+        self._head = b''
+        self._parser = None
+        self._parse_error = None
+        self._xml_doc = None
+        self._detached = False
+
+    @property
+    def sha256(self):
+        """sha256 загруженных байтов (hex)"""
+        return self._hash.hexdigest()
+
+    def write(self, data):
+        self.size += len(data)
+        # Отказываем сразу, не дописывая файл до конца
+        if self.max_size is not None and self.size > self.max_size:
+            raise RequestEntityTooLarge()
+
+        self._hash.update(data)
+        self.file.write(data)
+        if self._parse and self._parse_error is None:
+            self._feed(data)
+        return len(data)
+
+    def _feed(self, data):
+        try:
+            if self._parser is None:
+                # Кодировку определяем по заголовку, поэтому сначала набираем пролог
+                self._head += data
+                if len(self._head) < XML_PROLOG_SIZE:
+                    return
+                data, self._head = self._head, b''
+                self._parser = create_xml_parser(extract_encoding_from_xml(data))
+            self._parser.feed(data)
+        except etree.XMLSyntaxError as e:
+            self._parse_error = e
+            self._parser = None
+
+    def parse(self, converter):
+        """
+        Дерево документа.
+
+        Берётся из инкрементального парсера; если он не использовался или
+        не справился (например, кодировка в заголовке указана неверно),
+        spool-файл разбирается заново с диска.
+        """
+        if self._xml_doc is not None:
+            return self._xml_doc
+
+        if self._parse and self._parse_error is None:
+            try:
+                if self._parser is None:
+                    # Документ короче пролога
+                    self._parser = create_xml_parser(extract_encoding_from_xml(self._head))
+                    self._parser.feed(self._head)
+                    self._head = b''
+                self._xml_doc = self._parser.close().getroottree()
+                return self._xml_doc
+            except etree.XMLSyntaxError as e:
+                self._parse_error = e
+            finally:
+                self._parser = None
+
+        self.file.flush()
+        self._xml_doc = converter.parse_xml(self.path)
+        return self._xml_doc
+
+    def detach(self):
+        """
+        Передача spool-файла новому владельцу.
+
+        Возвращает путь; при закрытии объекта файл больше не удаляется.
+        """
+        self.file.close()
+        self._detached = True
+        return self.path
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def readline(self, size=-1):
+        return self.file.readline(size)
+
+    def seek(self, offset, whence=0):
+        return self.file.seek(offset, whence)
+
+    def tell(self):
+        return self.file.tell()
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self._parser = None
+        self._xml_doc = None
+        if not self.file.closed:
+            self.file.close()
+        if not self._detached:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+def parse_uploads(view=None, when=None):
+    """
+    Разбирать загружаемые в view XML инкрементально, по мере поступления.
+
+    when(request) -> bool позволяет решать это для каждого запроса
+    (например, не строить дерево при потоковой валидации).
+    """
+    def decorator(view):
+        view.parse_uploads = when or True
+        return view
+    return decorator(view) if view is not None else decorator
+
+def spool_upload(file, spool_dir, max_size=None, parse=False):
+    """
+    XMLSpool загруженного файла.
+
+    Обычно файл уже принят в XMLSpool (см. UploadRequest); иначе поток
+    копируется в него блоками.
+    """
+    if isinstance(file.stream, XMLSpool):
+        return file.stream
+
+    spool = XMLSpool(spool_dir, max_size=max_size, parse=parse)
+    try:
+        while True:
+            chunk = file.stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            spool.write(chunk)
+    except Exception:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool
+
+class UploadRequest(Request):
+    """
+    Запрос, загружаемые XML которого принимаются в XMLSpool.
+
+    Для view, помеченных parse_uploads, XML разбирается ещё во время
+    приёма, так что после загрузки дерево уже готово.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        if not filename or not allowed_file(filename):
+            return super()._get_file_stream(total_content_length, content_type,
+                                            filename, content_length)
+
+        view = current_app.view_functions.get(self.endpoint)
+        parse = getattr(view, 'parse_uploads', False)
+        if callable(parse):
+            parse = parse(self)
+        return XMLSpool(current_app.config['UPLOAD_SPOOL_FOLDER'],
+                        max_size=self.max_content_length,
+                        parse=bool(parse))
@@ -1,12 +1,36 @@
 # modules/utils.py
 import re
 import os
+import io
+import json
+import gzip
+import codecs
+import glob
+import time
 import uuid
 import tempfile
 import shutil
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from pathlib import Path
 
+from .paging import split_pages
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+try:
+    import zstandard
+except ImportError:  # сжатие zstd необязательно
+    zstandard = None
+
+# Сжатие артефактов на диске: суффикс файла по кодированию (оно же Content-Encoding)
+ARTIFACT_SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+# Размер фрагмента при записи и потоковой распаковке артефактов
+ARTIFACT_CHUNK_SIZE = 1024 * 1024
+
 def generate_filename(original_name, suffix=''):
     """Генерация уникального имени файла"""
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
@@ -26,27 +50,77 @@ def allowed_file(filename, allowed_extensions=None):
            Path(filename).suffix.lower() in allowed_extensions
 
 def cleanup_old_files(directory, max_age_hours=1):
-    """Удаление старых файлов"""
+    """Удаление старых файлов; возвращает (число файлов, байт)"""
     if not os.path.exists(directory):
-        return 0
+        return 0, 0
     
     cutoff_time = datetime.now() - timedelta(hours=max_age_hours)
     deleted_count = 0
+    deleted_bytes = 0
     
-    for filename in os.listdir(directory):
-        filepath = os.path.join(directory, filename)
-        try:
-            file_mtime = datetime.fromtimestamp(os.path.getmtime(filepath))
-            if file_mtime < cutoff_time:
-                os.remove(filepath)
-                deleted_count += 1
-        except (OSError, Exception):
-            continue
+    # Файлы разложены по подкаталогам, поэтому обходим дерево целиком
+    for root, dirnames, filenames in os.walk(directory):
+        # Служебные каталоги (файлы блокировок общего кэша, корзины времени) не обходим:
+        # mtime файла блокировки не меняется, и старый файл удалялся бы из-под flock
+        dirnames[:] = [name for name in dirnames if not name.startswith('.')]
+        for filename in filenames:
+            # Служебные файлы (блокировки, базы SQLite) не трогаем
+            if filename.startswith('.'):
+                continue
+            filepath = os.path.join(root, filename)
+            try:
+                stat = os.stat(filepath)
+                if datetime.fromtimestamp(stat.st_mtime) < cutoff_time:
+                    os.remove(filepath)
+                    deleted_count += 1
+                    deleted_bytes += stat.st_size
+            except (OSError, Exception):
+                continue
     
-    return deleted_count
+    return deleted_count, deleted_bytes
+
+@contextmanager
+def file_lock(path, blocking=True):
+    """
+    Межпроцессная блокировка на файле (flock).
+    
+    Возвращает True, если блокировка получена. Без fcntl (Windows)
+    блокировка не выполняется и всегда возвращается True.
+    """
+    if fcntl is None:
+        yield True
+        return
+    
+    with open(path, 'a') as f:
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        try:
+            fcntl.flock(f, flags)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def process_alive(pid):
+    """Существует ли процесс pid на этом хосте"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
 
 def extract_encoding_from_xml(xml_bytes):
     """Извлечение кодировки из заголовка XML"""
+    # BOM однозначно задаёт кодировку
+    if xml_bytes.startswith(codecs.BOM_UTF8):
+        return 'utf-8'
+    if xml_bytes.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return 'utf-16'
+    
     try:
         header = xml_bytes[:100].decode('ascii', errors='ignore')
         match = re.search(r'encoding=[\'"]([^\'"]+)[\'"]', header)
@@ -56,6 +130,51 @@ def extract_encoding_from_xml(xml_bytes):
         pass
     return 'windows-1251'  # значение по умолчанию для MOEX
 
+# 1) Частые "типографские" кракозябры (кавычки/тире), которые нередко встречаются отдельно.
+TYPOGRAPHY_FIXES = {
+    'â€”': '—',
+    'â€“': '–',
+    'â€˜': '‘',
+    'â€™': '’',
+    'â€œ': '“',
+    'â€\u009d': '”',
+    'â€\u009c': '“',
+    'â€\u0099': '’',
+    'â€\u0094': '—',
+    'â€\u0093': '–',
+    'вЂњ': '“',
+    'вЂќ': '”',
+    'вЂ™': '’',
+    'вЂ”': '—',
+    'вЂ–': '–',
+}
+
+# 2) Основная проблема: куски текста вида "РќР°Рё..." (UTF‑8 байты прочитали как cp1251).
+# Важно: в одном HTML могут быть и корректные русские слова (например "БИК"),
+# поэтому перекодируем ТОЛЬКО те фрагменты, которые явно похожи на моджибейк.
+#
+# Этот паттерн ловит характерные последовательности чередования "Р/С + кириллица"
+# (не меньше четырёх пар). Первые четыре пары развёрнуты: с квантором {4,}
+# движок re проверяет строку в несколько раз медленнее.
+MOJIBAKE_PAIR = '[РС][\u0400-\u04FF]'
+MOJIBAKE_PATTERN = re.compile(MOJIBAKE_PAIR * 4 + f'(?:{MOJIBAKE_PAIR})*')
+
+TYPOGRAPHY_PATTERN = re.compile('|'.join(re.escape(marker) for marker in TYPOGRAPHY_FIXES))
+TYPOGRAPHY_MARKERS = ('â€', 'вЂ')
+
+def _fix_typography(match):
+    return TYPOGRAPHY_FIXES[match.group(0)]
+
+def _fix_mojibake(match):
+    frag = match.group(0)
+    # Пробуем самый частый вариант, затем резервный
+    for src in ('cp1251', 'latin1'):
+        try:
+            return frag.encode(src).decode('utf-8')
+        except (UnicodeEncodeError, UnicodeDecodeError):
+            continue
+    return frag
+
 def fix_encoding_issues(text):
     """
     Исправление типичных проблем с "кракозябрами" после конвертации.
@@ -63,90 +182,361 @@ def fix_encoding_issues(text):
     Важно: эта функция НЕ должна портить уже корректный UTF-8 текст.
     Самая частая проблема для MOEX-отчётов: результат (UTF-8) где-то был
     ошибочно интерпретирован как cp1251, и в HTML попадают строки вида "РќР°...".
+    
+    Шаблоны скомпилированы заранее, каждое исправление выполняется одним
+    проходом и только если быстрая проверка нашла его признаки. Для чистого
+    HTML (обычный случай) исходная строка возвращается без копирования.
     """
 
     if not text:
         return text
 
-    def _try_recode_fragment(s: str, src: str, dst: str) -> str | None:
-        try:
-            return s.encode(src).decode(dst)
-        except (UnicodeEncodeError, UnicodeDecodeError):
-            return None
+    # 1) Типографские кракозябры: дешёвая проверка подстрок, замена одним проходом
+    if any(marker in text for marker in TYPOGRAPHY_MARKERS):
+        text = TYPOGRAPHY_PATTERN.sub(_fix_typography, text)
+
+    # 2) Моджибейк кириллицы: без совпадений sub возвращает ту же строку, без копии
+    return MOJIBAKE_PATTERN.sub(_fix_mojibake, text)
+
+def artifact_compression(name):
+    """Кодирование артефактов по настройке ('gzip', 'zstd' или None без сжатия)"""
+    name = (name or '').lower()
+    if name in ('', 'none', 'identity'):
+        return None
+    if name not in ARTIFACT_SUFFIXES:
+        raise Exception(f"Неизвестный способ сжатия артефактов: {name}")
+    if name == 'zstd' and zstandard is None:
+        raise Exception("Для сжатия zstd требуется пакет zstandard")
+    return name
+
+def artifact_encoding(filepath):
+    """Кодирование артефакта по суффиксу файла (None - без сжатия)"""
+    for encoding, suffix in ARTIFACT_SUFFIXES.items():
+        if filepath.endswith(suffix):
+            return encoding
+    return None
+
+def _compressed_writer(f, encoding, level):
+    if encoding == 'gzip':
+        # mtime=0: одинаковое содержимое даёт одинаковые байты
+        return gzip.GzipFile(fileobj=f, mode='wb', compresslevel=level, mtime=0)
+    return zstandard.ZstdCompressor(level=level).stream_writer(f, closefd=False)
+
+def _compress(data, encoding, level):
+    """Сжатие небольшого фрагмента отдельным членом gzip / кадром zstd"""
+    if not data:
+        return b''
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=level, mtime=0)
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+def _decompress(data, encoding):
+    if encoding == 'gzip':
+        return gzip.decompress(data)
+    if encoding == 'zstd':
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return data
 
-    # 1) Частые "типографские" кракозябры (кавычки/тире), которые нередко встречаются отдельно.
-    text = (
-        text.replace('â€”', '—')
-            .replace('â€“', '–')
-            .replace('â€˜', '‘')
-            .replace('â€™', '’')
-            .replace('â€œ', '“')
-            .replace('â€\u009d', '”')
-            .replace('â€\u009c', '“')
-            .replace('â€\u0099', '’')
-            .replace('â€\u0094', '—')
-            .replace('â€\u0093', '–')
-            .replace('вЂњ', '“')
-            .replace('вЂќ', '”')
-            .replace('вЂ™', '’')
-            .replace('вЂ”', '—')
-            .replace('вЂ–', '–')
-    )
-
-    # 2) Основная проблема: куски текста вида "РќР°Рё..." (UTF‑8 байты прочитали как cp1251).
-    # Важно: в одном HTML могут быть и корректные русские слова (например "БИК"),
-    # поэтому перекодируем ТОЛЬКО те фрагменты, которые явно похожи на моджибейк.
-    #
-    # Этот паттерн ловит характерные последовательности чередования "Р/С + кириллица".
-    mojibake_pattern = re.compile(r'(?:[РС][\u0400-\u04FF]){4,}')
-
-    def _fix_match(m: re.Match) -> str:
-        frag = m.group(0)
-        # Пробуем самый частый вариант
-        fixed = _try_recode_fragment(frag, 'cp1251', 'utf-8')
-        if fixed:
-            return fixed
-        # Резервный вариант
-        fixed = _try_recode_fragment(frag, 'latin1', 'utf-8')
-        if fixed:
-            return fixed
-        return frag
-
-    return mojibake_pattern.sub(_fix_match, text)
+def open_artifact(filepath):
+    """Чтение артефакта (бинарный файловый объект, сжатые данные распаковываются на лету)"""
+    encoding = artifact_encoding(filepath)
+    if encoding == 'gzip':
+        return gzip.open(filepath, 'rb')
+    if encoding == 'zstd':
+        # Разбитый на страницы артефакт - последовательность кадров
+        return io.BufferedReader(
+            zstandard.ZstdDecompressor().stream_reader(open(filepath, 'rb'), closefd=True,
+                                                       read_across_frames=True),
+            buffer_size=ARTIFACT_CHUNK_SIZE)
+    return open(filepath, 'rb')
+
+# Идентификатор временного файла - строка UUID4
+TEMP_ID_PATTERN = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
 
 class TemporaryFileManager:
-    """Менеджер временных файлов"""
+    """
+    Менеджер временных файлов.
+    
+    Путь к файлу однозначно выводится из temp_id: файлы раскладываются по
+    подкаталогам по первым двум символам идентификатора
+    (<temp_dir>/<ab>/moex_<ab...>.html), рядом лежат метаданные в .json.
+    Поиск файла не требует обхода каталога и не зависит от числа файлов.
+    
+    Для очистки каждый файл регистрируется в "корзине" по времени создания
+    (<temp_dir>/.expiry/<начало интервала>/moex_<id>): при истечении срока
+    обрабатываются только просроченные корзины, без обхода всех файлов.
+    
+    С compression ('gzip' или 'zstd') файл хранится сжатым
+    (moex_<id>.html.gz / .html.zst): HTML отчётов сжимается в 10-20 раз.
+    Такой файл можно отдавать клиенту как есть с Content-Encoding,
+    а прочитать - через open_artifact().
     
-    def __init__(self, temp_dir):
+    С page_rows HTML результата разбивается на страницы по page_rows строк
+    таблиц (modules/paging.py). Каждая часть пишется отдельным членом gzip
+    (кадром zstd): файл остаётся обычным сжатым HTML, а смещения частей
+    в метаданных позволяют прочитать одну страницу (get_page), не
+    распаковывая остальные.
+    """
+    
+    def __init__(self, temp_dir, bucket_seconds=300, compression=None, compression_level=4,
+                 page_rows=0):
         self.temp_dir = temp_dir
+        self.bucket_seconds = bucket_seconds
+        self.compression = artifact_compression(compression)
+        self.compression_level = compression_level
+        self.page_rows = page_rows
+        # Сначала ищем файл в текущем формате, затем в остальных (смена настройки на лету)
+        suffixes = [''] + list(ARTIFACT_SUFFIXES.values())
+        if self.compression:
+            suffixes.remove(ARTIFACT_SUFFIXES[self.compression])
+            suffixes.insert(0, ARTIFACT_SUFFIXES[self.compression])
+        self._suffixes = suffixes
+        self.expiry_dir = os.path.join(temp_dir, '.expiry')
         os.makedirs(temp_dir, exist_ok=True)
     
-    def create_temp_file(self, content, extension='.html', prefix='moex_'):
-        """Создание временного файла"""
+    def _shard_dir(self, temp_id):
+        return os.path.join(self.temp_dir, temp_id[:2])
+    
+    def _base_path(self, temp_id, prefix):
+        return os.path.join(self._shard_dir(temp_id), f"{prefix}{temp_id}")
+    
+    def create_temp_file(self, content, extension='.html', prefix='moex_', metadata=None,
+                         timings=None):
+        """
+        Создание временного файла (и файла метаданных рядом с ним).
+        
+        В timings (StageTimings), если передан, записываются длительности
+        записи файла и метаданных.
+        """
         temp_id = str(uuid.uuid4())
         filename = f"{prefix}{temp_id}{extension}"
-        filepath = os.path.join(self.temp_dir, filename)
+        os.makedirs(self._shard_dir(temp_id), exist_ok=True)
+        base_path = self._base_path(temp_id, prefix)
+        filepath = base_path + extension
+        if self.compression:
+            filepath += ARTIFACT_SUFFIXES[self.compression]
+        
+        started = time.perf_counter()
+        content_size, paging = self._write_content(filepath, content, paginate=extension == '.html')
+        written = time.perf_counter()
         
-        with open(filepath, 'w', encoding='utf-8') as f:
-            f.write(content)
+        info = dict(metadata or {})
+        info.update({
+            'temp_id': temp_id,
+            'filename': filename,
+            'created': datetime.now().isoformat(),
+            'size': os.path.getsize(filepath),
+            'content_size': content_size,
+            'encoding': self.compression
+        })
+        if paging is not None:
+            info.update(paging)
+        with open(base_path + '.json', 'w', encoding='utf-8') as f:
+            json.dump(info, f, ensure_ascii=False)
+        
+        self._register_expiry(temp_id, prefix)
+        
+        if timings is not None:
+            timings.record('store', written - started)
+            timings.record('store_metadata', time.perf_counter() - written)
         
         return temp_id, filename, filepath
     
-    def get_temp_file(self, temp_id, prefix='moex_'):
-        """Получение пути к временному файлу по ID"""
-        for filename in os.listdir(self.temp_dir):
-            if filename.startswith(prefix) and temp_id in filename:
-                return os.path.join(self.temp_dir, filename)
+    def _write_content(self, filepath, content, paginate=False):
+        """
+        Запись HTML (сжатого, если задано) по фрагментам.
+        
+        Возвращает размер в UTF-8 и разметку страниц для метаданных
+        ({'parts': [[смещение, длина], ...], 'pages': [[открывающие теги,
+        закрывающие теги], ...]}) или None, если HTML не разбит на страницы.
+        """
+        data = content.encode('utf-8')
+        split = split_pages(data, self.page_rows) if paginate else None
+        offsets = split[0] if split else [0, len(data)]
+        view = memoryview(data)
+        parts = []
+        with open(filepath, 'wb') as f:
+            for start, end in zip(offsets, offsets[1:]):
+                position = f.tell()
+                writer = _compressed_writer(f, self.compression, self.compression_level) \
+                    if self.compression else f
+                for chunk in range(start, end, ARTIFACT_CHUNK_SIZE):
+                    writer.write(view[chunk:min(chunk + ARTIFACT_CHUNK_SIZE, end)])
+                if writer is not f:
+                    writer.close()
+                parts.append([position, f.tell() - position])
+        
+        if split is None:
+            return len(data), None
+        return len(data), {
+            'parts': parts,
+            'pages': [[opening.decode('utf-8'), closing.decode('utf-8')]
+                      for opening, closing in split[1]]
+        }
+    
+    def get_temp_file(self, temp_id, prefix='moex_', extension='.html'):
+        """
+        Получение пути к временному файлу по ID.
+        
+        Путь может оканчиваться на .gz/.zst (см. artifact_encoding);
+        содержимое читается через open_artifact().
+        """
+        if not TEMP_ID_PATTERN.fullmatch(temp_id or ''):
+            return None
+        
+        base_path = self._base_path(temp_id, prefix) + extension
+        for suffix in self._suffixes:
+            if os.path.exists(base_path + suffix):
+                return base_path + suffix
         return None
     
+    def _read_part(self, filepath, part):
+        offset, length = part
+        with open(filepath, 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+    
+    def get_part(self, temp_id, index, prefix='moex_'):
+        """
+        Часть разбитого на страницы HTML (распакованная): 0 - начало документа
+        до <body> включительно, -1 - конец документа. None, если части нет.
+        """
+        filepath = self.get_temp_file(temp_id, prefix)
+        parts = (self.get_metadata(temp_id, prefix) or {}).get('parts')
+        if not filepath or not parts or not -len(parts) <= index < len(parts):
+            return None
+        return _decompress(self._read_part(filepath, parts[index]), artifact_encoding(filepath))
+    
+    def get_page(self, temp_id, number, compressed=False, prefix='moex_'):
+        """
+        Страница number (с 1) разбитого на страницы HTML - самостоятельный фрагмент
+        тела документа. None, если такой страницы нет.
+        
+        С compressed=True страница сжатого артефакта не распаковывается: сжатые
+        открывающие теги, член gzip (кадр zstd) страницы как есть и сжатые
+        закрывающие теги - тоже корректный поток gzip (zstd).
+        """
+        filepath = self.get_temp_file(temp_id, prefix)
+        metadata = self.get_metadata(temp_id, prefix) or {}
+        pages = metadata.get('pages')
+        if not filepath or not pages or not 1 <= number <= len(pages):
+            return None
+        
+        opening, closing = (tags.encode('utf-8') for tags in pages[number - 1])
+        data = self._read_part(filepath, metadata['parts'][number])
+        encoding = artifact_encoding(filepath)
+        if compressed and encoding is not None:
+            level = self.compression_level
+            return _compress(opening, encoding, level) + data + _compress(closing, encoding, level)
+        return opening + _decompress(data, encoding) + closing
+    
+    def get_metadata(self, temp_id, prefix='moex_'):
+        """Метаданные временного файла (исходное имя, XSLT, время создания)"""
+        if not TEMP_ID_PATTERN.fullmatch(temp_id or ''):
+            return None
+        
+        try:
+            with open(self._base_path(temp_id, prefix) + '.json', 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+    
+    def touch(self, temp_id, prefix='moex_'):
+        """Продление жизни файла (обновление mtime); False, если файла уже нет"""
+        filepath = self.get_temp_file(temp_id, prefix)
+        if not filepath:
+            return False
+        try:
+            os.utime(filepath)
+            meta_path = self._base_path(temp_id, prefix) + '.json'
+            if os.path.exists(meta_path):
+                os.utime(meta_path)
+            # Файл переезжает в текущую корзину; старая запись будет пропущена по mtime
+            self._register_expiry(temp_id, prefix)
+        except OSError:
+            return False
+        return True
+    
     def cleanup(self, max_age_hours=1):
-        """Очистка старых файлов"""
+        """Очистка старых файлов полным обходом; возвращает (число файлов, байт)"""
         return cleanup_old_files(self.temp_dir, max_age_hours)
     
+    def expire(self, max_age_seconds, max_buckets=None):
+        """
+        Инкрементальная очистка по корзинам времени.
+        
+        Обрабатывает только корзины, целиком вышедшие за срок жизни
+        (не больше max_buckets за вызов). Возвращает (число файлов, байт).
+        """
+        if not os.path.isdir(self.expiry_dir):
+            return 0, 0
+        
+        cutoff = time.time() - max_age_seconds
+        deleted_files = 0
+        deleted_bytes = 0
+        processed = 0
+        
+        buckets = sorted(int(name) for name in os.listdir(self.expiry_dir) if name.isdigit())
+        for bucket in buckets:
+            if bucket + self.bucket_seconds > cutoff:
+                break
+            if max_buckets is not None and processed >= max_buckets:
+                break
+            
+            bucket_dir = os.path.join(self.expiry_dir, str(bucket))
+            for marker in os.listdir(bucket_dir):
+                files, size = self._expire_artifact(marker, cutoff)
+                deleted_files += files
+                deleted_bytes += size
+                try:
+                    os.remove(os.path.join(bucket_dir, marker))
+                except OSError:
+                    pass
+            
+            try:
+                os.rmdir(bucket_dir)
+            except OSError:
+                pass
+            processed += 1
+        
+        return deleted_files, deleted_bytes
+    
+    def _register_expiry(self, temp_id, prefix):
+        bucket = int(time.time()) // self.bucket_seconds * self.bucket_seconds
+        bucket_dir = os.path.join(self.expiry_dir, str(bucket))
+        os.makedirs(bucket_dir, exist_ok=True)
+        with open(os.path.join(bucket_dir, f"{prefix}{temp_id}"), 'w'):
+            pass
+    
+    def _expire_artifact(self, marker, cutoff):
+        """Удаление всех файлов артефакта, если он не продлевался после cutoff"""
+        temp_id = marker[-36:]
+        if not TEMP_ID_PATTERN.fullmatch(temp_id):
+            return 0, 0
+        
+        deleted_files = 0
+        deleted_bytes = 0
+        for filepath in glob.glob(os.path.join(self._shard_dir(temp_id), f"{marker}*")):
+            try:
+                stat = os.stat(filepath)
+                if stat.st_mtime >= cutoff:
+                    # Файл продлён (touch) - он зарегистрирован в более поздней корзине
+                    continue
+                os.remove(filepath)
+                deleted_files += 1
+                deleted_bytes += stat.st_size
+            except OSError:
+                continue
+        
+        return deleted_files, deleted_bytes
+    
     def delete_file(self, temp_id, prefix='moex_'):
         """Удаление файла по ID"""
         filepath = self.get_temp_file(temp_id, prefix)
         if filepath and os.path.exists(filepath):
             os.remove(filepath)
+            meta_path = self._base_path(temp_id, prefix) + '.json'
+            if os.path.exists(meta_path):
+                os.remove(meta_path)
             return True
-        return False
\ No newline at end of file
+        return False
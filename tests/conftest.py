@@ -0,0 +1,38 @@
+# tests/conftest.py
+"""Приложение с временными каталогами и локальным набором стилей (без сети)"""
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from config import config, DevelopmentConfig
+from benchmarks.run import STYLESHEETS_DIR
+
+@pytest.fixture
+def make_app(tmp_path, monkeypatch):
+    """make_app(**overrides) - приложение create_app с настройками поверх тестовых"""
+    def make_app(**overrides):
+        uploads = tmp_path / 'uploads'
+        settings = {
+            'TESTING': True,
+            'UPLOAD_FOLDER': str(uploads),
+            'UPLOAD_SPOOL_FOLDER': str(uploads / 'spool'),
+            'SHARED_CACHE_PATH': str(uploads / '.cache.sqlite3'),
+            'JOB_DB_PATH': str(uploads / '.jobs.sqlite3'),
+            'SEARCH_DB_PATH': str(uploads / '.search.sqlite3'),
+            'ADMISSION_DB_PATH': str(uploads / '.admission.sqlite3'),
+            'METRICS_DB_PATH': str(uploads / '.metrics.sqlite3'),
+            'XSLT_CACHE_DIR': str(tmp_path / 'xslt_cache'),
+            'XSLT_BUNDLE_PATH': str(STYLESHEETS_DIR),
+            'XSLT_OFFLINE': True,
+            'JANITOR_ENABLED': False,
+            'ADMISSION_ENABLED': False,
+        }
+        settings.update(overrides)
+        monkeypatch.setitem(config, 'testing', type('TestingConfig', (DevelopmentConfig,), settings))
+
+        from app import create_app
+        return create_app('testing')
+    return make_app
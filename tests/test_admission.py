@@ -0,0 +1,43 @@
+# tests/test_admission.py
+"""Клиенты контроля допуска: ключи API из списка, адрес клиента за прокси"""
+import io
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from modules.admission import AdmissionControl, AdmissionRejected
+
+def test_unknown_api_keys_share_address_bucket(tmp_path):
+    admission = AdmissionControl(str(tmp_path / 'admission.sqlite3'), rate=0.01, burst=2,
+                                 api_keys=['partner'])
+
+    # Смена ключа не даёт новой корзины: неизвестные ключи считаются по IP
+    for key in ('a', 'b'):
+        admission.admit(admission.client_id(key, '10.0.0.1'), inflight=False)
+    with pytest.raises(AdmissionRejected) as rejected:
+        admission.admit(admission.client_id('c', '10.0.0.1'), inflight=False)
+    assert rejected.value.status == 429
+
+    # У ключа из списка своя корзина
+    partner = admission.client_id('partner', '10.0.0.1')
+    assert partner.startswith('key:') and 'partner' not in partner
+    admission.admit(partner, inflight=False)
+    admission.close()
+
+def test_client_address_behind_proxy(make_app):
+    app = make_app(ADMISSION_ENABLED=True, ADMISSION_RATE_PER_MINUTE=0.6, ADMISSION_BURST=1,
+                   TRUSTED_PROXIES=1)
+    client = app.test_client()
+
+    def post(forwarded_for):
+        return client.post('/api/convert', data={'xml_file': (io.BytesIO(b'<a/>'), 'a.xml')},
+                           content_type='multipart/form-data',
+                           headers={'X-Forwarded-For': forwarded_for})
+
+    # Пользователи за одним прокси получают разные корзины
+    assert post('192.0.2.1').status_code != 429
+    assert post('192.0.2.2').status_code != 429
+    assert post('192.0.2.1').status_code == 429
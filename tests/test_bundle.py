@@ -0,0 +1,55 @@
+# tests/test_bundle.py
+"""Локальный набор стилей: включаемые файлы внутри zip-архива"""
+import sys
+import zipfile
+from pathlib import Path
+
+from lxml import etree
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from modules.bundle import load_stylesheet_bundle
+from modules.converter import MOEXConverter
+
+XSLT_BASE = 'http://moex.invalid/XSLT/'
+XSD_BASE = 'http://moex.invalid/XSD/'
+
+MAIN_XSL = b'''<?xml version="1.0" encoding="utf-8"?>
+<xsl:stylesheet version="1.0" xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
+  <xsl:include href="common/header.xsl"/>
+  <xsl:template match="/"><html><xsl:call-template name="header"/></html></xsl:template>
+</xsl:stylesheet>'''
+
+HEADER_XSL = b'''<?xml version="1.0" encoding="utf-8"?>
+<xsl:stylesheet version="1.0" xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
+  <xsl:template name="header"><h1>MOEX</h1></xsl:template>
+</xsl:stylesheet>'''
+
+REPORT_XSD = b'''<?xml version="1.0" encoding="utf-8"?>
+<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema">
+  <xs:include schemaLocation="types.xsd"/>
+  <xs:element name="DOC" type="DocType"/>
+</xs:schema>'''
+
+TYPES_XSD = b'''<?xml version="1.0" encoding="utf-8"?>
+<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema">
+  <xs:simpleType name="DocType"><xs:restriction base="xs:string"/></xs:simpleType>
+</xs:schema>'''
+
+def test_zip_bundle_resolves_includes(tmp_path):
+    bundle = tmp_path / 'bundle.zip'
+    with zipfile.ZipFile(bundle, 'w') as archive:
+        archive.writestr('XSLT/report.xsl', MAIN_XSL)
+        archive.writestr('XSLT/common/header.xsl', HEADER_XSL)
+        archive.writestr('XSD/report.xsd', REPORT_XSD)
+        archive.writestr('XSD/types.xsd', TYPES_XSD)
+
+    converter = MOEXConverter(XSLT_BASE, XSD_BASE, cache_dir=str(tmp_path / 'cache'),
+                              offline=True)
+    loaded = load_stylesheet_bundle(converter, str(bundle))
+
+    assert loaded['errors'] == []
+    transform = converter.get_transform(XSLT_BASE + 'report.xsl')
+    assert '<h1>MOEX</h1>' in str(transform(etree.XML(b'<DOC/>')))
+    schema = converter.xsd_cache.get(XSD_BASE + 'report.xsd')
+    assert schema.validate(etree.XML(b'<DOC>text</DOC>'))
@@ -0,0 +1,41 @@
+# tests/test_fetcher.py
+"""Повторы ResourceFetcher против локальной замены сервера MOEX"""
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.stub_server import StubServer
+from modules.fetcher import ResourceFetcher, FetchError
+
+@pytest.fixture
+def stylesheets(tmp_path):
+    for name in ('hung.xsl', 'flaky.xsl'):
+        (tmp_path / name).write_bytes(b'<xsl:stylesheet/>')
+    return tmp_path
+
+def test_read_timeout_is_not_retried(stylesheets):
+    # Зависший стиль держит запрос один таймаут, а не (retries + 1) таймаутов
+    with StubServer(stylesheets, delays={'hung.xsl': 3}) as server:
+        fetcher = ResourceFetcher(timeout=1, connect_timeout=1, retries=3, backoff=0.01)
+        started = time.perf_counter()
+        with pytest.raises(FetchError):
+            fetcher.fetch(server.url('XSLT/hung.xsl'))
+        elapsed = time.perf_counter() - started
+        fetcher.close()
+
+    assert server.requests['hung.xsl'] == 1
+    assert elapsed < 2
+
+def test_error_statuses_are_retried(stylesheets):
+    with StubServer(stylesheets, fail_first=2, fail_status=503) as server:
+        fetcher = ResourceFetcher(timeout=5, retries=3, backoff=0.01)
+        content, etag, _ = fetcher.fetch(server.url('XSLT/flaky.xsl'))
+        fetcher.close()
+
+    assert content == b'<xsl:stylesheet/>'
+    assert etag
+    assert server.requests['flaky.xsl'] == 3
@@ -0,0 +1,46 @@
+# tests/test_janitor.py
+"""Полный обход очистки: служебные каталоги и учёт освобождённого места"""
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from modules.cache import SharedCacheStore
+from modules.janitor import CleanupJanitor
+from modules.utils import TemporaryFileManager
+
+def age(path, seconds):
+    old = time.time() - seconds
+    os.utime(path, (old, old))
+
+def test_full_sweep_keeps_lock_files(tmp_path):
+    temp_manager = TemporaryFileManager(str(tmp_path))
+    store = SharedCacheStore(str(tmp_path / '.cache.sqlite3'))
+    with store.lock('result:abc'):
+        pass
+    lock_files = [os.path.join(store.lock_dir, name) for name in os.listdir(store.lock_dir)]
+    for path in lock_files:
+        age(path, 7200)
+
+    janitor = CleanupJanitor(temp_manager, max_age_seconds=3600)
+    janitor.run_once(full_sweep=True)
+
+    assert lock_files and all(os.path.exists(path) for path in lock_files)
+    store.close()
+
+def test_full_sweep_bytes_are_reclaimed(tmp_path):
+    temp_manager = TemporaryFileManager(str(tmp_path))
+    # Файл вне корзин времени (например, оставшийся от упавшего процесса)
+    stray = tmp_path / 'ab' / 'moex_stray.html'
+    stray.parent.mkdir()
+    stray.write_bytes(b'x' * 5000)
+    age(stray, 7200)
+
+    janitor = CleanupJanitor(temp_manager, max_age_seconds=3600)
+
+    assert janitor.run_once(full_sweep=True) == (1, 5000)
+    assert not stray.exists()
+    assert janitor.stats()['files_reclaimed'] == 1
+    assert janitor.stats()['bytes_reclaimed'] == 5000
@@ -0,0 +1,55 @@
+# tests/test_jobs.py
+"""Очистка заданий, оставшихся от упавших процессов"""
+import os
+import sys
+import time
+import sqlite3
+from pathlib import Path
+from concurrent.futures import Future
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from modules.jobs import JobQueue, LOST_JOB_ERROR
+
+def make_queue(tmp_path):
+    return JobQueue(db_path=str(tmp_path / 'jobs.sqlite3'), spool_dir=str(tmp_path / 'jobs'),
+                    converter_options={}, temp_dir=str(tmp_path))
+
+def insert_job(queue, job_id, status, created, pid=None):
+    with sqlite3.connect(queue.db_path) as conn:
+        conn.execute("INSERT INTO jobs (id, status, created, updated, pid) VALUES (?, ?, ?, ?, ?)",
+                     (job_id, status, created, created, pid))
+    spool = Path(queue.spool_dir) / f"{job_id}.xml"
+    spool.write_bytes(b'<a/>')
+    return spool
+
+def test_purge_fails_lost_jobs(tmp_path):
+    queue = make_queue(tmp_path)
+    now = time.time()
+    dead_pid = 2 ** 22 + 1
+    spools = {
+        'a' * 32: insert_job(queue, 'a' * 32, 'running', now, pid=dead_pid),
+        'b' * 32: insert_job(queue, 'b' * 32, 'queued', now - 7200),
+        'c' * 32: insert_job(queue, 'c' * 32, 'queued', now),
+        'd' * 32: insert_job(queue, 'd' * 32, 'running', now, pid=os.getpid()),
+    }
+
+    queue.purge(3600)
+
+    statuses = {job_id: queue.get(job_id)['status'] for job_id in spools}
+    assert statuses == {'a' * 32: 'failed', 'b' * 32: 'failed',
+                        'c' * 32: 'queued', 'd' * 32: 'running'}
+    assert queue.get('a' * 32)['error'] == LOST_JOB_ERROR
+    assert [job_id for job_id, spool in spools.items() if spool.exists()] == ['c' * 32, 'd' * 32]
+
+def test_cancelled_future_fails_job(tmp_path):
+    queue = make_queue(tmp_path)
+    spool = insert_job(queue, 'e' * 32, 'queued', time.time())
+    future = Future()
+    future.cancel()
+
+    queue._on_done('e' * 32, future)
+
+    job = queue.get('e' * 32)
+    assert (job['status'], job['error']) == ('failed', LOST_JOB_ERROR)
+    assert not spool.exists()
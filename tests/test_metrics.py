@@ -0,0 +1,95 @@
+# tests/test_metrics.py
+"""Метрики хоста: сумма по процессам, монотонность после их завершения, метка stylesheet"""
+import os
+import sys
+import multiprocessing
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from modules.metrics import (ConversionMetrics, MetricsStore, StageTimings, CacheEventCounter,
+                             cache_collector, MAX_STYLESHEET_LABELS)
+
+BASE = 'https://ftp.moex.com/pub/Reports/Currency/XSLT/'
+
+def conversions(text, stylesheet='CCX99.xsl'):
+    line = (f'moex_conversions_total{{stylesheet="{stylesheet}",status="ok",'
+            f'cached="false"}} ')
+    values = [row[len(line):] for row in text.splitlines() if row.startswith(line)]
+    return int(values[0]) if values else 0
+
+def convert(metrics, count):
+    for _ in range(count):
+        metrics.observe_conversion(StageTimings(), 1024, 2048, BASE + 'CCX99.xsl')
+
+def child(db_path):
+    # Отдельный процесс публикует свои значения и завершается
+    metrics = ConversionMetrics(MetricsStore(db_path), xslt_base_url=BASE)
+    convert(metrics, 5)
+    metrics.store.publish(metrics._metrics)
+
+def test_values_are_summed_across_processes(tmp_path):
+    db_path = str(tmp_path / 'metrics.sqlite3')
+    first = ConversionMetrics(MetricsStore(db_path), xslt_base_url=BASE)
+    second = ConversionMetrics(MetricsStore(db_path), xslt_base_url=BASE)
+    convert(first, 2)
+    convert(second, 3)
+    second.store.publish(second._metrics)
+
+    # Любой воркер отдаёт сумму
+    assert conversions(first.render()) == 5
+    assert conversions(second.render()) == 5
+    assert 'moex_conversion_input_bytes_count 5' in first.render()
+
+def test_values_of_finished_processes_are_kept(tmp_path):
+    db_path = str(tmp_path / 'metrics.sqlite3')
+    metrics = ConversionMetrics(MetricsStore(db_path), xslt_base_url=BASE)
+    convert(metrics, 1)
+
+    process = multiprocessing.get_context('spawn').Process(target=child, args=(db_path,))
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+    assert conversions(metrics.render()) == 6
+
+    # Снимок завершившегося процесса складывается в одну запись, сумма не меняется
+    assert metrics.store.purge(3600) > 0
+    assert conversions(metrics.render()) == 6
+    assert metrics.store.purge(3600) == 0
+    convert(metrics, 1)
+    assert conversions(metrics.render()) == 7
+
+def test_stylesheet_label_is_bounded():
+    metrics = ConversionMetrics(xslt_base_url=BASE)
+
+    assert metrics.stylesheet_label(BASE + 'CCX99.xsl') == 'CCX99.xsl'
+    assert metrics.stylesheet_label('http://example.com/evil.xsl') == 'other'
+    for number in range(MAX_STYLESHEET_LABELS * 2):
+        metrics.stylesheet_label(f"{BASE}R{number}.xsl")
+    assert metrics.stylesheet_label(BASE + 'NEW.xsl') == 'other'
+    assert metrics.stylesheet_label(BASE + 'CCX99.xsl') == 'CCX99.xsl'
+
+class FakeCache:
+    def __init__(self, hits, size):
+        self.counters = {'hits': hits, 'misses': 1, 'size': size, 'max_entries': 32}
+
+    def stats(self):
+        return dict(self.counters)
+
+def test_cache_events_are_summed_across_processes(tmp_path):
+    db_path = str(tmp_path / 'metrics.sqlite3')
+    workers = []
+    for hits in (3, 4):
+        metrics = ConversionMetrics(MetricsStore(db_path))
+        caches = {'xslt': FakeCache(hits, size=2)}
+        metrics.register(CacheEventCounter('moex_cache_events_total', 'События кэша', caches))
+        metrics.register_collector(cache_collector('cache', caches))
+        workers.append(metrics)
+    workers[1].store.publish(workers[1]._metrics)
+
+    text = workers[0].render()
+    assert 'moex_cache_events_total{cache="xslt",event="hits"} 7' in text
+    assert 'moex_cache_events_total{cache="xslt",event="misses"} 2' in text
+    assert 'event="size"' not in text
+    # Размер кэша - gauge процесса с меткой worker, не сумма
+    assert f'moex_cache_entries{{worker="{os.getpid()}",cache="xslt"}} 2' in text
@@ -0,0 +1,61 @@
+# tests/test_upload.py
+"""Приём загрузок: XML разбирается только при промахе кэша результатов"""
+import io
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.generate import generate_report
+from modules.upload import XMLSpool
+from modules.converter import MOEXConverter
+
+@pytest.fixture
+def client(make_app):
+    with make_app().test_client() as client:
+        yield client
+
+@pytest.fixture
+def parses(monkeypatch):
+    """Счётчики разбора: при приёме (feed) и из spool-файла (parse_xml)"""
+    counts = {'feed': 0, 'file': 0}
+    feed, parse_xml = XMLSpool._feed, MOEXConverter.parse_xml
+
+    def counting_feed(self, data):
+        counts['feed'] += 1
+        return feed(self, data)
+
+    def counting_parse_xml(self, *args, **kwargs):
+        counts['file'] += 1
+        return parse_xml(self, *args, **kwargs)
+
+    monkeypatch.setattr(XMLSpool, '_feed', counting_feed)
+    monkeypatch.setattr(MOEXConverter, 'parse_xml', counting_parse_xml)
+    return counts
+
+def post(client, url, report):
+    return client.post(url, data={'xml_file': (io.BytesIO(report), 'report.xml')},
+                       content_type='multipart/form-data')
+
+@pytest.mark.parametrize('url', ['/api/convert', '/upload'])
+def test_cache_hit_does_not_parse(client, parses, url):
+    report = generate_report(20 * 1024)
+
+    response = post(client, url, report)
+    assert response.status_code in (200, 302)
+    assert parses == {'feed': 0, 'file': 1}
+
+    response = post(client, url, report)
+    assert response.status_code in (200, 302)
+    if url == '/api/convert':
+        assert response.get_json()['cached'] is True
+    assert parses == {'feed': 0, 'file': 1}
+
+def test_validation_parses_while_receiving(client, parses):
+    response = post(client, '/api/convert?validate=1', generate_report(20 * 1024))
+
+    assert response.status_code == 200
+    assert parses['feed'] > 0
+    assert parses['file'] == 0